@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Сравнение парсеров conntrack: время разбора и пиковый RSS.
+
+    python bench/bench_parser.py --lines 100000
+
+Каждый режим запускается в отдельном процессе, чтобы пиковый RSS
+одного не влиял на другой:
+
+ - legacy : прежний парсер (три regex на строку) по всей строке вывода
+ - string : parse_conntrack() по всей строке вывода
+ - stream : ConntrackTotals, вывод читается кусками по 64 KiB
+ - delta  : FlowSample (прирост по flow), тоже потоково
+"""
+
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault("TG_BOT_TOKEN", "bench")
+
+MODES = ("legacy", "string", "stream", "delta")
+CHUNK = 65536
+
+RE_SRC = re.compile(r"src=(\d+\.\d+\.\d+\.\d+)")
+RE_DST = re.compile(r"dst=(\d+\.\d+\.\d+\.\d+)")
+RE_BYTES = re.compile(r"bytes=(\d+)")
+
+
+def legacy_parse(output: str, subnet: str):
+    """Парсер из исходной версии бота (для сравнения)."""
+    result = {}
+    for line in output.splitlines():
+        if subnet not in line:
+            continue
+        m_bytes = RE_BYTES.search(line)
+        if not m_bytes:
+            continue
+        size = int(m_bytes.group(1))
+        m_src = RE_SRC.search(line)
+        m_dst = RE_DST.search(line)
+        if m_src:
+            ip = m_src.group(1)
+            if ip.startswith(subnet):
+                result.setdefault(ip, {"in": 0, "out": 0})
+                result[ip]["out"] += size
+        if m_dst:
+            ip = m_dst.group(1)
+            if ip.startswith(subnet):
+                result.setdefault(ip, {"in": 0, "out": 0})
+                result[ip]["in"] += size
+    return result
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_mode(mode: str, dump: str) -> dict:
+    import wol_bot_conntrack as bot
+
+    base = peak_rss_kb()
+    t0 = time.perf_counter()
+
+    if mode in ("legacy", "string"):
+        # как раньше: stdout.read().decode() целиком
+        with open(dump, "rb") as f:
+            out = f.read().decode(errors="ignore")
+        if mode == "legacy":
+            result = legacy_parse(out, bot.TRAFFIC_LAN_SUBNET)
+        else:
+            result = bot.parse_conntrack(out)
+        devices = len(result)
+    else:
+        if mode == "stream":
+            sink = bot.ConntrackTotals()
+        else:
+            sink = bot.FlowTracker().begin()
+        splitter = bot.LineSplitter(sink.feed_line)
+        with open(dump, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK)
+                if not chunk:
+                    break
+                splitter.feed(chunk)
+        splitter.close()
+        devices = len(sink.result if mode == "stream" else sink.deltas)
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "mode": mode,
+        "seconds": round(elapsed, 4),
+        "peak_rss_delta_kb": peak_rss_kb() - base,
+        "devices": devices,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lines", type=int, default=100_000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--run", choices=MODES, help=argparse.SUPPRESS)
+    ap.add_argument("--dump", help="готовый файл дампа (иначе генерируется)")
+    ap.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = ap.parse_args()
+
+    if args.run:
+        print(json.dumps(run_mode(args.run, args.dump)))
+        return
+
+    from conntrack_dump import write_dump
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = args.dump
+        if not dump:
+            dump = os.path.join(tmp, "conntrack.txt")
+            write_dump(dump, args.lines, args.seed)
+
+        results = []
+        for mode in MODES:
+            out = subprocess.run(
+                [sys.executable, __file__, "--run", mode, "--dump", dump],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(out))
+
+    if args.json:
+        print(json.dumps({"lines": args.lines, "results": results}, indent=2))
+        return
+
+    print(f"{args.lines} строк conntrack")
+    print(f"{'режим':<8} {'время, с':>10} {'пик RSS, KiB':>14} {'устройств':>10}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['seconds']:>10.3f} {r['peak_rss_delta_kb']:>14} {r['devices']:>10}")
+
+
+if __name__ == "__main__":
+    main()
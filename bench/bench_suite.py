@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Набор воспроизводимых замеров бота без сети и без Telegram.
+
+    python bench/bench_suite.py --out results.json
+    python bench/bench_suite.py --lines 1000,10000 --devices 10,100 --compare results.json
+
+ - parse_conntrack  : разбор дампа conntrack (IPv4 и IPv6, TCP/UDP) целиком
+ - collect_conntrack: прогон сбора с подменой SSH (FakeSSH) — разбор потоком,
+                      таблица соседей, дельты по flow и запись в БД;
+                      первый прогон (все flow новые) отдельно от следующих
+ - запросы «📊 Трафик»: каждая агрегирующая функция, render_traffic и
+                      обработчики show_traffic / «⬅ Назад» через FakeTelegram
+                      на базе с историей за --days дней для --devices устройств
+ - cleanup_old      : очистка по срокам хранения на копии той же базы
+ - startup          : запуск интерпретатора с импортом бота в отдельном
+                      процессе (import — только сам импорт модуля)
+
+Дампы и базы генерируются с --seed, поэтому прогоны разных версий бота
+сравнимы между собой: --out сохраняет результат в JSON, --compare
+выводит изменение медианы относительно сохранённого результата.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+SUBNET = "10.0."
+SUBNET6 = "2001:db8:1::"
+
+# до импорта бота: настройки читаются при импорте, wol.env их не перекрывает
+os.environ.update({
+    "TG_BOT_TOKEN": "bench",
+    "ADMIN_USER_IDS": "1",
+    "ROUTERS": "",
+    "ROUTER_IP": "10.0.0.1",
+    "TRAFFIC_LAN_SUBNET": "10.0.0.0/16,2001:db8:1::/64",
+    "TRAFFIC_GREP_PATTERN": "",
+    "TRAFFIC_DB_PATH": os.path.join(tempfile.gettempdir(), "wolbot-bench-unused.db"),
+    "TRAFFIC_EVENTS_ENABLED": "false",
+    # очистку меряем отдельно — сбор не должен запускать её в фоне
+    "TRAFFIC_PRUNE_THRESHOLD": str(10 ** 12),
+})
+
+from conntrack_dump import generate_lines, neighbor_lines  # noqa: E402
+from fakes import FakeSSH, FakeTelegram  # noqa: E402
+from traffic_db import create_db  # noqa: E402
+
+import wol_bot_conntrack as bot  # noqa: E402
+
+RESULTS = []
+
+
+def record(name: str, params: dict, runs: list, **extra):
+    RESULTS.append({
+        "name": name,
+        "params": params,
+        "median": round(statistics.median(runs), 6),
+        "min": round(min(runs), 6),
+        "runs": len(runs),
+        **extra,
+    })
+
+
+async def measure(fn, repeat: int, setup=None, teardown=None) -> list:
+    """Время repeat вызовов await fn(); setup / teardown — вне замера."""
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            await setup()
+        t0 = time.perf_counter()
+        await fn()
+        runs.append(time.perf_counter() - t0)
+        if teardown:
+            await teardown()
+    return runs
+
+
+async def use_db(path: str):
+    """Переключить бота на другую базу (как periodic_setup при запуске)."""
+    if bot.DB.writer is not None:
+        await bot.DB.close()
+    bot.DB = bot.TrafficDB(path)
+    await bot.DB.open()
+    await bot.init_db()
+    bot.REPORT_CACHE.clear()
+
+
+def dump_bytes(lines: int, devices: int, seed: int, round: int = 0) -> bytes:
+    return "".join(generate_lines(
+        lines, seed, subnet=SUBNET, devices=devices, subnet6=SUBNET6,
+        ipv6_share=0.2, unreplied_share=0.05, round=round,
+    )).encode()
+
+
+# ---------------------------------------------------------------------
+# Замеры
+# ---------------------------------------------------------------------
+
+async def bench_parse(lines: int, args):
+    devices = min(max(lines // 100, 10), 500)
+    text = dump_bytes(lines, devices, args.seed).decode()
+
+    async def run():
+        bot.parse_conntrack(text, bot.DEFAULT_LAN)
+
+    runs = await measure(run, args.repeat)
+    record("parse_conntrack", {"lines": lines}, runs,
+           lines_per_sec=round(lines / statistics.median(runs)))
+
+
+async def bench_collect(lines: int, args, tmp: str):
+    devices = min(max(lines // 100, 10), 500)
+    dumps = [dump_bytes(lines, devices, args.seed, r) for r in range(args.repeat + 1)]
+    neigh = "".join(neighbor_lines(devices, SUBNET, SUBNET6)).encode()
+    ssh = FakeSSH({"conntrack -L": dumps, bot.NEIGHBOR_COMMAND: [neigh]}, latency=args.ssh_latency)
+    ssh.install(bot)
+
+    path = os.path.join(tmp, f"collect_{lines}.db")
+    await use_db(path)
+    # новый роутер: пустое состояние flow, кэш соседей не заполнен
+    bot.ROUTERS = bot.parse_routers("")
+
+    async def run():
+        await bot.collect_conntrack(bot.ROUTERS)
+
+    params = {"lines": lines, "devices": devices}
+    record("collect_conntrack_first", params, await measure(run, 1))
+    record("collect_conntrack", params, await measure(run, args.repeat),
+           flows=bot.ROUTERS[0].stats["flows"])
+
+    await bot.DB.close()
+    os.remove(path)
+
+
+async def bench_queries(devices: int, args, tmp: str):
+    path = os.path.join(args.db_dir or tmp, f"traffic_{devices}dev_{args.days}d_s{args.seed}_{date.today()}.db")
+    if not os.path.exists(path):
+        t0 = time.perf_counter()
+        counts = await create_db(bot, path, devices, args.days, args.seed, subnet=SUBNET)
+        print(f"база {os.path.basename(path)}: {counts}, {time.perf_counter() - t0:.1f} с", file=sys.stderr)
+
+    await use_db(path)
+    now = datetime.now()
+    prev = now + bot.relativedelta(months=-1)
+    params = {"devices": devices, "days": args.days}
+
+    queries = {
+        "today_per_device": bot.today_per_device,
+        "yesterday_total": bot.yesterday_total,
+        "month_total": lambda: bot.month_total(now.year, now.month),
+        "month_per_device": lambda: bot.month_per_device(prev.year, prev.month),
+        "year_total": bot.year_total,
+        "render_traffic_current": lambda: bot.render_traffic(0),
+        "render_traffic_month": lambda: bot.render_traffic(-1),
+    }
+    for name, fn in queries.items():
+        record(name, params, await measure(fn, args.repeat))
+
+    tg = FakeTelegram()
+
+    async def cold():
+        bot.REPORT_CACHE.clear()
+
+    async def show():
+        await bot.show_traffic(tg.update("📊 Трафик"), tg.context)
+
+    async def back():
+        await bot.callback_handler(tg.callback("traffic_prev:-1"), tg.context)
+
+    record("show_traffic", params, await measure(show, args.repeat, setup=cold))
+    record("show_traffic_cached", params, await measure(show, args.repeat))
+    record("callback_traffic_prev", params, await measure(back, args.repeat, setup=cold))
+    await bot.DB.close()
+
+    # очистка меняет базу — каждый раз на свежей копии
+    work = os.path.join(tmp, "cleanup.db")
+    removed = []
+
+    async def setup():
+        shutil.copyfile(path, work)
+        await use_db(work)
+
+    async def run():
+        removed.append((await bot.cleanup_old(pause=0))["rows"])
+
+    async def teardown():
+        await bot.DB.close()
+        os.remove(work)
+
+    record("cleanup_old", params, await measure(run, args.repeat, setup, teardown), rows=removed[-1])
+
+
+async def bench_startup(args):
+    """Холодный старт: новый процесс python, импорт бота (без сети и БД)."""
+    code = (
+        "import time; t = time.perf_counter(); import wol_bot_conntrack; "
+        "print(time.perf_counter() - t)"
+    )
+    total, imports = [], []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        total.append(time.perf_counter() - t0)
+        imports.append(float(out.stdout.split()[-1]))
+    record("startup", {}, total)
+    record("startup_import", {}, imports)
+
+
+# ---------------------------------------------------------------------
+# Отчёт и сравнение
+# ---------------------------------------------------------------------
+
+def key_of(r: dict) -> str:
+    return r["name"] + " " + " ".join(f"{k}={v}" for k, v in sorted(r["params"].items()))
+
+
+def print_results(results: list, baseline: dict = None, threshold: float = 1.1):
+    print(f"{'замер':<52} {'медиана, мс':>12} {'мин, мс':>10}" + (f" {'было, мс':>10} {'изм.':>8}" if baseline else ""))
+    for r in results:
+        key = key_of(r)
+        line = f"{key:<52} {r['median'] * 1000:>12.2f} {r['min'] * 1000:>10.2f}"
+        old = (baseline or {}).get(key)
+        if old:
+            ratio = r["median"] / old["median"] if old["median"] else float("inf")
+            mark = "  медленнее" if ratio > threshold else ("  быстрее" if ratio < 1 / threshold else "")
+            line += f" {old['median'] * 1000:>10.2f} {ratio:>7.2f}x{mark}"
+        print(line)
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(s: str) -> list:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+async def run_all(args) -> None:
+    await bench_startup(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in args.lines:
+            await bench_parse(lines, args)
+        for lines in args.lines:
+            await bench_collect(lines, args, tmp)
+        for devices in args.devices:
+            await bench_queries(devices, args, tmp)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int_list, default=[1000, 10000, 50000, 200000],
+                    help="размеры дампа conntrack, через запятую")
+    ap.add_argument("--devices", type=int_list, default=[10, 100, 500],
+                    help="число устройств в базе с историей, через запятую")
+    ap.add_argument("--days", type=int, default=730, help="глубина истории в базе, дней")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--ssh-latency", type=float, default=0.0,
+                    help="задержка FakeSSH перед выводом, с")
+    ap.add_argument("--db-dir", help="каталог для сгенерированных баз (переиспользуются в тот же день)")
+    ap.add_argument("--out", help="сохранить результат в JSON")
+    ap.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--threshold", type=float, default=1.1,
+                    help="во сколько раз медленнее считать регрессией")
+    ap.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = ap.parse_args()
+
+    # служебный вывод бота (print) не должен смешиваться с результатом
+    with contextlib.redirect_stdout(sys.stderr):
+        asyncio.run(run_all(args))
+    bot.COLLECT_EXECUTOR.shutdown()
+
+    report = {
+        "version": git_version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "json")},
+        "results": RESULTS,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        baseline = {key_of(r): r for r in old["results"]}
+        print(f"сравнение с {old.get('version')} от {old.get('date')}")
+    print_results(RESULTS, baseline, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
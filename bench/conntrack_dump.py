@@ -0,0 +1,86 @@
+"""
+Генератор синтетического вывода `conntrack -L -o extended,id`
+и таблицы соседей роутера (`ip neigh`) для тех же устройств.
+"""
+
+import random
+
+PROTOS = [("tcp", 6), ("udp", 17)]
+TCP_STATES = ["ESTABLISHED", "TIME_WAIT", "SYN_SENT", "CLOSE_WAIT"]
+WAN = "203.0.113.5"
+
+
+def device_ip(subnet: str, i: int) -> str:
+    """i-е устройство подсети: "192.168.1." → .2, .3...; "10.0." → 10.0.0.2 ... 10.0.1.2 ..."""
+    if subnet.count(".") >= 3:
+        return f"{subnet}{i + 2}"
+    return f"{subnet}{i // 250}.{i % 250 + 2}"
+
+
+def device_ip6(subnet6: str, i: int) -> str:
+    return f"{subnet6}{i + 2:x}"
+
+
+def device_mac(i: int) -> str:
+    return f"02:00:00:00:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"
+
+
+def _remote(rnd: random.Random, v6: bool) -> str:
+    if v6:
+        return f"2a00:{rnd.randint(0x1000, 0xffff):x}:{rnd.randint(0, 0xffff):x}::{rnd.randint(1, 0xffff):x}"
+    return f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+
+
+def generate_lines(n: int, seed: int = 1, subnet: str = "192.168.1.", devices: int = 50,
+                   subnet6: str = None, ipv6_share: float = 0.0, unreplied_share: float = 0.0,
+                   round: int = 0):
+    """
+    Генерирует n строк conntrack (LAN → интернет, с учётом байтов).
+
+    subnet6 / ipv6_share — доля IPv6-соединений (через тот же MAC устройства),
+    unreplied_share — доля UDP без ответа ([UNREPLIED], bytes=0 в ответе).
+    round — номер опроса: те же соединения (id, адреса, порты), счётчики
+    растут с каждым опросом, как на живом роутере.
+    """
+    rnd = random.Random(seed)
+    grow = round + 1
+    for i in range(n):
+        proto, num = rnd.choice(PROTOS)
+        dev = rnd.randrange(devices)
+        v6 = subnet6 is not None and rnd.random() < ipv6_share
+        lan = device_ip6(subnet6, dev) if v6 else device_ip(subnet, dev)
+        remote = _remote(rnd, v6)
+        sport = rnd.randint(1024, 65535)
+        dport = rnd.choice((443, 80, 53, 123, 5222, 3478))
+        tx = rnd.randint(60, 5_000_000) * grow
+        rx = rnd.randint(60, 50_000_000) * grow
+        unreplied = proto == "udp" and unreplied_share > 0 and rnd.random() < unreplied_share
+        if unreplied:
+            rx = 0
+        state = f"{rnd.choice(TCP_STATES)} " if proto == "tcp" else ""
+        # без NAT для IPv6: ответ приходит прямо на адрес устройства
+        reply_dst = lan if v6 else WAN
+        flags = "[UNREPLIED] " if unreplied else ""
+        assured = "" if unreplied else "[ASSURED] "
+        family = "ipv6     10" if v6 else "ipv4     2"
+        yield (
+            f"{family} {proto:<8} {num} {rnd.randint(1, 432000)} {state}"
+            f"src={lan} dst={remote} sport={sport} dport={dport} packets={tx // 1400 + 1} bytes={tx} "
+            f"{flags}src={remote} dst={reply_dst} sport={dport} dport={sport} packets={rx // 1400 + (not unreplied)} bytes={rx} "
+            f"{assured}mark=0 use=1 id={1000000 + i}\n"
+        )
+
+
+def write_dump(path: str, n: int, seed: int = 1, **kw):
+    with open(path, "w") as f:
+        for line in generate_lines(n, seed, **kw):
+            f.write(line)
+
+
+def neighbor_lines(devices: int, subnet: str = "192.168.1.", subnet6: str = None):
+    """Вывод `ip neigh` для устройств generate_lines: IPv4 и IPv6 адрес на один MAC."""
+    for i in range(devices):
+        mac = device_mac(i)
+        yield f"{device_ip(subnet, i)} dev br-lan lladdr {mac} REACHABLE\n"
+        if subnet6 is not None:
+            yield f"{device_ip6(subnet6, i)} dev br-lan lladdr {mac} STALE\n"
@@ -0,0 +1,157 @@
+"""
+Заглушки для запуска бота без сети: SSH (подмена _ssh_stream) и Telegram
+(Update / CallbackQuery / Bot с записью вызовов вместо запросов к API).
+"""
+
+import itertools
+import time
+from types import SimpleNamespace
+
+CHUNK = 65536
+
+
+class FakeSSH:
+    """
+    Вместо _ssh_stream: по подстроке команды отдаёт заранее заготовленный
+    вывод кусками по CHUNK байт, как канал paramiko.
+
+        ssh = FakeSSH({"conntrack -L": [dump0, dump1], bot.NEIGHBOR_COMMAND: [neigh]})
+        ssh.install(bot)
+
+    Список выводов для команды отдаётся по кругу — каждый вызов следующий.
+    latency — задержка перед первым куском (время «запуска команды» на роутере).
+    """
+
+    def __init__(self, outputs: dict, latency: float = 0.0):
+        self.outputs = {k: itertools.cycle(v) for k, v in outputs.items()}
+        self.latency = latency
+        self.calls = []
+
+    def __call__(self, host, user, key, cmd, on_chunk, timeout=None):
+        self.calls.append((host, cmd))
+        for pattern, outputs in self.outputs.items():
+            if pattern in cmd:
+                data = next(outputs)
+                break
+        else:
+            return False, f"fake ssh: нет вывода для {cmd!r}"
+
+        if self.latency:
+            time.sleep(self.latency)
+        view = memoryview(data)
+        for i in range(0, len(data), CHUNK):
+            on_chunk(bytes(view[i:i + CHUNK]))
+        return True, ""
+
+    def install(self, bot):
+        bot._ssh_stream = self
+
+
+class FakeBot:
+    """Bot API: все вызовы записываются, сообщения получают возрастающие id."""
+
+    rate_limiter = None
+
+    def __init__(self):
+        self.calls = []
+        self._ids = itertools.count(1)
+
+    def _message(self, chat_id, text=None):
+        return FakeMessage(self, chat_id, next(self._ids), text)
+
+    async def send_message(self, chat_id, text, **kw):
+        self.calls.append(("send_message", chat_id, text))
+        return self._message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kw):
+        self.calls.append(("edit_message_text", chat_id, text))
+        return self._message(chat_id, text)
+
+    async def send_photo(self, chat_id, photo, **kw):
+        self.calls.append(("send_photo", chat_id, None))
+        return self._message(chat_id)
+
+    async def send_document(self, chat_id, document, **kw):
+        self.calls.append(("send_document", chat_id, None))
+        return self._message(chat_id)
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(("delete_message", chat_id, message_id))
+        return True
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls.append(("delete_messages", chat_id, list(message_ids)))
+        return True
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, message_id: int, text: str = None):
+        self._bot = bot
+        self.chat_id = chat_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.message_id = message_id
+        self.text = text
+
+    async def reply_text(self, text, **kw):
+        return await self._bot.send_message(self.chat_id, text, **kw)
+
+    async def edit_text(self, text, **kw):
+        self.text = text
+        return await self._bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kw)
+
+    async def reply_photo(self, photo, **kw):
+        return await self._bot.send_photo(self.chat_id, photo, **kw)
+
+    async def reply_document(self, document, **kw):
+        return await self._bot.send_document(self.chat_id, document, **kw)
+
+    async def delete(self):
+        return await self._bot.delete_message(self.chat_id, self.message_id)
+
+
+class FakeCallbackQuery:
+    def __init__(self, message: FakeMessage, data: str):
+        self.message = message
+        self.data = data
+
+    async def answer(self, text=None, **kw):
+        return True
+
+    async def edit_message_text(self, text, **kw):
+        return await self.message.edit_text(text, **kw)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kw):
+        return True
+
+
+class FakeTelegram:
+    """
+    Чат одного пользователя: update() / callback() строят входящие
+    события, context — общий для всех вызовов, как у Application.
+    """
+
+    def __init__(self, user_id: int = 1, chat_id: int = 1):
+        self.bot = FakeBot()
+        self.user = SimpleNamespace(id=user_id)
+        self.chat_id = chat_id
+        self.context = SimpleNamespace(
+            bot=self.bot, chat_data={}, user_data={}, bot_data={}, args=[], job_queue=None,
+        )
+
+    def update(self, text: str = ""):
+        message = self.bot._message(self.chat_id, text)
+        return SimpleNamespace(
+            effective_user=self.user,
+            effective_chat=message.chat,
+            message=message,
+            callback_query=None,
+        )
+
+    def callback(self, data: str):
+        message = self.bot._message(self.chat_id)
+        return SimpleNamespace(
+            effective_user=self.user,
+            effective_chat=message.chat,
+            message=None,
+            callback_query=FakeCallbackQuery(message, data),
+        )
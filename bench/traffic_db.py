@@ -0,0 +1,106 @@
+"""
+Генератор базы трафика с историей: устройства, сырые замеры, почасовые,
+дневные и месячные агрегаты — как у бота, проработавшего `days` дней.
+
+    create_db(bot, "/tmp/traffic.db", devices=100, days=730)
+
+Схему создаёт сам бот (init_db), данные пишутся напрямую через sqlite3.
+Сырые замеры и почасовые агрегаты генерируются на `extra_days` дольше
+сроков хранения — чтобы cleanup_old было что удалять.
+Одинаковые параметры, seed и now дают одинаковую базу.
+"""
+
+import random
+import sqlite3
+
+from conntrack_dump import device_ip, device_mac
+
+DAY = 86400
+# доля дневного трафика по часам (UTC): ночью мало, вечером пик
+PROFILE = [1, 1, 1, 1, 1, 2, 3, 4, 5, 5, 5, 5, 6, 6, 6, 6, 7, 8, 9, 10, 10, 8, 5, 2]
+
+
+def _split(total: int, weights) -> list:
+    """Разбить total на целые части пропорционально weights (сумма сохраняется)."""
+    s = sum(weights)
+    parts = [total * w // s for w in weights]
+    parts[-1] += total - sum(parts)
+    return parts
+
+
+async def create_db(bot, path: str, devices: int, days: int = 730, seed: int = 1,
+                    subnet: str = "10.0.", interval: int = 600, extra_days: int = 7,
+                    now: int = None) -> dict:
+    """Создаёт базу по path (файл должен не существовать). Возвращает число строк по таблицам."""
+    bot.DB = bot.TrafficDB(path)
+    await bot.DB.open()
+    await bot.init_db()
+    await bot.DB.close()
+
+    rnd = random.Random(seed)
+    now = now or int(bot.time.time())
+    today = bot.bucket_start(now, DAY)
+    raw_days = min(bot.TRAFFIC_RAW_RETENTION_DAYS + extra_days, days)
+    hourly_days = min(bot.TRAFFIC_HOURLY_RETENTION_DAYS + extra_days, days)
+
+    # у каждого устройства свой средний объём в день и своя активность
+    base = [int(rnd.lognormvariate(20, 1.5)) for _ in range(devices)]
+    active = [rnd.uniform(0.3, 1.0) for _ in range(devices)]
+    counts = {"devices": devices, "traffic_stats": 0, "traffic_hourly": 0, "traffic_daily": 0}
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA synchronous=OFF")
+    with con:
+        con.executemany(
+            "INSERT INTO devices (id, mac, ip, name, last_seen, router, subnet) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (i + 1, device_mac(i), device_ip(subnet, i), f"device-{i + 1}", now,
+                 bot.DEFAULT_ROUTER, subnet)
+                for i in range(devices)
+            ),
+        )
+
+        for back in range(days, -1, -1):
+            day = today - back * DAY
+            # сегодня — только прошедшие часы
+            hours = 24 if back else (now - today) // 3600 + 1
+            daily, hourly, raw = [], [], []
+            for dev in range(devices):
+                if rnd.random() > active[dev]:
+                    continue
+                total = int(base[dev] * rnd.uniform(0.2, 2.0) * hours / 24)
+                rx = total * rnd.randint(70, 95) // 100
+                tx = total - rx
+                daily.append((day, dev + 1, rx, tx))
+                if back > hourly_days:
+                    continue
+
+                weights = PROFILE[:hours]
+                for h, (hrx, htx) in enumerate(zip(_split(rx, weights), _split(tx, weights))):
+                    hour = day + h * 3600
+                    hourly.append((hour, dev + 1, hrx, htx))
+                    if back > raw_days:
+                        continue
+                    slots = 3600 // interval
+                    for k, (srx, stx) in enumerate(zip(_split(hrx, [1] * slots), _split(htx, [1] * slots))):
+                        ts = hour + k * interval
+                        if ts <= now:
+                            raw.append((dev + 1, ts, srx, stx))
+
+            con.executemany("INSERT INTO traffic_daily (day, device_id, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)", daily)
+            con.executemany("INSERT INTO traffic_hourly (hour, device_id, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)", hourly)
+            con.executemany("INSERT INTO traffic_stats (device_id, ts, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)", raw)
+            counts["traffic_daily"] += len(daily)
+            counts["traffic_hourly"] += len(hourly)
+            counts["traffic_stats"] += len(raw)
+
+        # месячные агрегаты — свёртка дневных (месяцы по UTC, как у бота)
+        cur = con.execute("""
+            INSERT INTO traffic_monthly (month, device_id, rx_bytes, tx_bytes)
+            SELECT CAST(strftime('%s', day, 'unixepoch', 'start of month') AS INTEGER),
+                   device_id, SUM(rx_bytes), SUM(tx_bytes)
+            FROM traffic_daily GROUP BY 1, 2
+        """)
+        counts["traffic_monthly"] = cur.rowcount
+    con.close()
+    return counts
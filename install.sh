@@ -32,6 +32,7 @@ read -rp "Введите путь к SSH ключу OMV: " OMV_KEY
 read -rp "Введите IP роутера OpenWrt: " RT_IP
 read -rp "Введите SSH user роутера: " RT_USER
 read -rp "Введите путь к SSH ключу роутера: " RT_KEY
+read -rp "Установить на роутер агент сбора трафика wolbot-ct? (y/N): " RT_AGENT
 
 # ------------------------------
 # Генерация .env
@@ -53,6 +54,7 @@ ROUTER_SSH_KEY="$RT_KEY"
 TRAFFIC_LAN_SUBNET="192.168.1."
 TRAFFIC_GREP_PATTERN="192.168.1."
 TRAFFIC_COLLECTION_ENABLED="true"
+TRAFFIC_AGENT_MODE="auto"
 TRAFFIC_COLLECTION_INTERVAL="600"
 TRAFFIC_DB_PATH="$DATA_DIR/traffic_stats.db"
 TRAFFIC_RETENTION_DAYS="730"
@@ -72,6 +74,22 @@ echo ""
 echo "=== Копирую wol_bot_conntrack.py ==="
 curl -fsSL "https://raw.githubusercontent.com/m33ph/wol_bot/main/wol_bot_conntrack.py" -o "$INSTALL_DIR/wol_bot_conntrack.py"
 
+# ------------------------------
+# Агент сбора трафика на роутере (необязательно)
+# ------------------------------
+
+if [[ "${RT_AGENT,,}" == "y" || "${RT_AGENT,,}" == "yes" ]]; then
+    echo ""
+    echo "=== Устанавливаю wolbot-ct на роутер ==="
+    curl -fsSL "https://raw.githubusercontent.com/m33ph/wol_bot/main/router/wolbot-ct.sh" -o "$INSTALL_DIR/wolbot-ct.sh"
+    if ssh -i "$RT_KEY" -o StrictHostKeyChecking=accept-new "$RT_USER@$RT_IP" \
+        'cat > /usr/bin/wolbot-ct && chmod +x /usr/bin/wolbot-ct' < "$INSTALL_DIR/wolbot-ct.sh"; then
+        echo "Агент установлен: бот будет получать с роутера только компактные счётчики."
+    else
+        echo "Не удалось установить агент — бот будет использовать полный дамп conntrack."
+    fi
+fi
+
 # ------------------------------
 # Создание venv и установка зависимостей
 # ------------------------------
@@ -83,7 +101,7 @@ source "$INSTALL_DIR/venv/bin/activate"
 
 echo "=== Устанавливаю зависимости ==="
 pip install -U pip wheel
-pip install python-telegram-bot==20.7 python-dotenv wakeonlan paramiko python-dateutil aiosqlite
+pip install "python-telegram-bot[job-queue]==20.8" python-dotenv wakeonlan paramiko python-dateutil aiosqlite
 
 deactivate
 
@@ -0,0 +1,83 @@
+#!/bin/sh
+# ---------------------------------------------------------------------
+# wolbot-ct — агент сбора трафика для wol_bot на роутере OpenWrt
+#
+# Разбирает conntrack прямо на роутере и отдаёт по SSH только
+# компактные строки, по одной на соединение (flow):
+#
+#     WOLBOT-CT 1
+#     <id>|<proto>|<src>|<sport>|<dst>|<dport> <lan_ip> <rx> <tx>
+#
+# Ключ flow совпадает с тем, что строит бот из полного дампа,
+# поэтому переключение между режимами не сбивает подсчёт.
+#
+# Установка: install.sh копирует файл в /usr/bin/wolbot-ct
+# Запуск:    wolbot-ct 192.168.1.          — текущая таблица
+#            wolbot-ct events 192.168.1.   — поток завершённых соединений
+#                                            (финальные счётчики, DESTROY)
+#            wolbot-ct 192.168.1.,10.0.    — несколько подсетей через запятую
+#
+# Подсети сверяются по текстовым префиксам; точную проверку по CIDR
+# делает бот. Подсеть не по границе октета (/20, /12) или шире /8
+# префиксом не описать — для неё бот агент не вызывает, а разбирает
+# полный дамп conntrack.
+# ---------------------------------------------------------------------
+
+MODE="dump"
+if [ "$1" = "events" ]; then
+    MODE="events"
+    shift
+fi
+PREFIX="${1:-192.168.1.}"
+
+AWK='
+BEGIN { np = split(p, pfx, ",") }
+function inlan(a,    k) {
+    for (k = 1; k <= np; k++) if (index(a, pfx[k]) == 1) return 1
+    return 0
+}
+{
+    for (k = 1; k <= np; k++) if (index($0, pfx[k])) break
+    if (k > np) next
+    # у событий впереди метка "[DESTROY]" — убираем, поля пересчитаются
+    if (substr($1, 1, 1) == "[") sub(/^ *\[[A-Z]+\] */, "")
+    src = ""; dst = ""; sport = ""; dport = ""; rsrc = ""
+    ob = ""; rb = ""; id = ""; nsrc = 0
+    for (i = 1; i <= NF; i++) {
+        f = $i
+        if (substr(f, 1, 4) == "src=") {
+            nsrc++
+            if (nsrc == 1) src = substr(f, 5)
+            else if (nsrc == 2) rsrc = substr(f, 5)
+        } else if (substr(f, 1, 4) == "dst=") {
+            if (dst == "") dst = substr(f, 5)
+        } else if (substr(f, 1, 6) == "sport=") {
+            if (nsrc == 1 && sport == "") sport = substr(f, 7)
+        } else if (substr(f, 1, 6) == "dport=") {
+            if (nsrc == 1 && dport == "") dport = substr(f, 7)
+        } else if (substr(f, 1, 6) == "bytes=") {
+            if (ob == "") ob = substr(f, 7)
+            else if (rb == "") rb = substr(f, 7)
+        } else if (substr(f, 1, 3) == "id=") {
+            id = substr(f, 4)
+        }
+    }
+    if (ob == "" || rb == "") next
+
+    # в LAN: исходящее соединение, входящее, либо проброс порта (DNAT)
+    if (inlan(src))       { ip = src;  rx = rb; tx = ob }
+    else if (inlan(dst))  { ip = dst;  rx = ob; tx = rb }
+    else if (inlan(rsrc)) { ip = rsrc; rx = ob; tx = rb }
+    else next
+
+    print id "|" $3 "|" src "|" sport "|" dst "|" dport " " ip " " rx " " tx
+    if (ev) fflush()
+}'
+
+echo "WOLBOT-CT 1"
+
+if [ "$MODE" = "events" ]; then
+    conntrack -E -e DESTROY -o extended,id 2>/dev/null | awk -v p="$PREFIX" -v ev=1 "$AWK"
+else
+    conntrack -L -o extended,id 2>/dev/null | awk -v p="$PREFIX" -v ev=0 "$AWK"
+fi
@@ -0,0 +1,40 @@
+"""
+Общая подготовка тестов: настройки бота до импорта (как в bench/bench_suite.py)
+и временная база на каждый тест.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+
+# до импорта бота: настройки читаются при импорте, wol.env их не перекрывает
+os.environ.update({
+    "TG_BOT_TOKEN": "test",
+    "ADMIN_USER_IDS": "1",
+    "ROUTERS": "",
+    "ROUTER_IP": "10.0.0.1",
+    "TRAFFIC_LAN_SUBNET": "10.0.0.0/16",
+    "TRAFFIC_GREP_PATTERN": "",
+    "TRAFFIC_NEIGHBOR_TTL": "0",
+    "TRAFFIC_DB_PATH": os.path.join(tempfile.gettempdir(), "wolbot-test-unused.db"),
+    "TRAFFIC_EVENTS_ENABLED": "false",
+    "TRAFFIC_PRUNE_THRESHOLD": str(10 ** 12),
+})
+
+import wol_bot_conntrack as bot  # noqa: E402
+
+
+async def open_db(tmp: str, name: str = "traffic.db"):
+    """Бот на новой базе в каталоге tmp (закрыть — bot.DB.close())."""
+    bot.DB = bot.TrafficDB(os.path.join(tmp, name))
+    await bot.DB.open()
+    await bot.init_db()
+    await bot.DEVICES.load()
+    bot.REPORT_CACHE.clear()
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from support import bot
+from traffic_db import create_db
+
+
+class CleanupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "traffic.db")
+        await create_db(bot, self.path, devices=5, days=120, seed=1, extra_days=20)
+        bot.DB = bot.TrafficDB(self.path)
+        await bot.DB.open()
+        await bot.init_db()
+
+    async def asyncTearDown(self):
+        await bot.DB.close()
+        self.tmp.cleanup()
+
+    async def pragma(self, name: str) -> int:
+        (value,) = await bot.DB.fetchone(f"PRAGMA {name}")
+        return value
+
+    async def test_incremental_vacuum_frees_all_pages(self):
+        pages = await self.pragma("page_count")
+        result = await bot.cleanup_old(pause=0)
+
+        self.assertGreater(result["rows"], 0)
+        self.assertGreater(result["freed_pages"], 1)
+        # свободных страниц не осталось, файл уменьшился ровно на освобождённые
+        self.assertEqual(await self.pragma("freelist_count"), 0)
+        self.assertEqual(await self.pragma("page_count"), pages - result["freed_pages"])
+
+
+if __name__ == "__main__":
+    unittest.main()
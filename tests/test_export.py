@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from support import bot, open_db
+from traffic_db import create_db
+
+
+class ImportRawTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        await create_db(bot, os.path.join(self.tmp.name, "source.db"), devices=3, days=3, seed=1)
+        await open_db(self.tmp.name, "source.db")
+        self.file = os.path.join(self.tmp.name, "raw.csv.gz")
+        await bot.export_traffic(self.file, ["raw"])
+        await bot.DB.close()
+
+    async def asyncTearDown(self):
+        await bot.DB.close()
+        self.tmp.cleanup()
+
+    async def totals(self):
+        result = {}
+        for table in ("traffic_stats", "traffic_hourly", "traffic_daily", "traffic_monthly"):
+            result[table] = await bot.DB.fetchone(f"SELECT SUM(rx_bytes), SUM(tx_bytes) FROM {table}")
+        return result
+
+    async def test_rollups_follow_raw(self):
+        await open_db(self.tmp.name, "target.db")
+        counts = await bot.import_traffic(self.file)
+        self.assertEqual(list(counts), ["raw"])
+
+        totals = await self.totals()
+        self.assertGreater(totals["traffic_stats"][0], 0)
+        for table in ("traffic_hourly", "traffic_daily", "traffic_monthly"):
+            self.assertEqual(totals[table], totals["traffic_stats"], table)
+
+        # повторная загрузка заменяет замеры — агрегаты не удваиваются
+        await bot.import_traffic(self.file)
+        self.assertEqual(await self.totals(), totals)
+
+    async def test_reimport_into_source_keeps_rollups(self):
+        await open_db(self.tmp.name, "source.db")
+        before = await self.totals()
+        await bot.import_traffic(self.file)
+        self.assertEqual(await self.totals(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import asyncio
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from support import bot, open_db
+
+FLOWS = 20000
+
+
+def flow(i: int):
+    return f"{i}|tcp|10.0.{i // 250}.{i % 250 + 2}|40000|203.0.113.9|443", f"10.0.{i // 250}.{i % 250 + 2}"
+
+
+class SaveSampleTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        await open_db(self.tmp.name)
+        self.router = bot.parse_routers("")[0]
+
+    async def asyncTearDown(self):
+        await bot.DB.close()
+        self.tmp.cleanup()
+
+    def sample(self, rx: int, tx: int):
+        sample = self.router.tracker.begin()
+        for i in range(FLOWS):
+            key, ip = flow(i)
+            sample.add(key, ip, rx, tx)
+        return sample
+
+    async def totals(self):
+        return await bot.DB.fetchone("SELECT COUNT(*), SUM(rx_bytes), SUM(tx_bytes) FROM traffic_stats")
+
+    async def test_settle_during_save(self):
+        """События DESTROY во время записи снимка не ломают запись и не теряют прирост."""
+        sample = self.sample(1000, 100)
+        stop = threading.Event()
+        settled = []
+
+        def events():
+            # поток событий: flow завершаются, пока снимок пишется в БД
+            for i in range(FLOWS):
+                if stop.is_set():
+                    break
+                key, ip = flow(i)
+                settled.append(self.router.tracker.settle(key, ip, 1500, 150))
+                # события идут вперемешку с записью, а не пачкой до неё
+                time.sleep(0.00002)
+
+        # частые переключения потоков — чтобы settle попадал внутрь обходов снимка
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        thread = threading.Thread(target=events)
+        thread.start()
+        try:
+            written = await bot.save_sample(self.router, sample)
+        finally:
+            stop.set()
+            await asyncio.to_thread(thread.join)
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(written, len(sample.deltas))
+        count, rx, tx = await self.totals()
+        self.assertEqual((rx, tx), (1000 * FLOWS, 100 * FLOWS))
+        # завершившиеся flow досчитаны от значения снимка, а не с нуля
+        self.assertTrue(settled)
+        self.assertTrue(all(d == (500, 50) for d in settled))
+        # база трекера — снимок без завершившихся flow
+        self.assertEqual(len(self.router.tracker.flows), FLOWS - len(settled))
+        self.assertIsNone(self.router.tracker.current)
+
+    async def test_failed_save_keeps_baseline(self):
+        """Запись не удалась — счётчики не сдвигаются, прирост посчитает следующий опрос."""
+        await bot.save_sample(self.router, self.sample(1000, 100))
+
+        save_cycle = bot.save_cycle
+
+        async def broken(*args, **kw):
+            raise RuntimeError("database is locked")
+
+        bot.save_cycle = broken
+        try:
+            with self.assertRaises(RuntimeError):
+                await bot.save_sample(self.router, self.sample(2000, 200))
+        finally:
+            bot.save_cycle = save_cycle
+        self.assertIsNone(self.router.tracker.current)
+
+        await bot.save_sample(self.router, self.sample(3000, 300))
+        count, rx, tx = await self.totals()
+        self.assertEqual((rx, tx), (3000 * FLOWS, 300 * FLOWS))
+
+
+    async def test_only_changed_flows_rewritten(self):
+        """Повторный опрос переписывает в conntrack_flows только изменившиеся flow."""
+
+        def sample(grown: int, skip: int = -1):
+            # 20 устройств, много соединений у каждого
+            sample = self.router.tracker.begin()
+            for i in range(FLOWS):
+                if i != skip:
+                    sample.add(f"{i}|tcp|x", f"10.0.0.{i % 20 + 2}", 2000 if i < grown else 1000, 100)
+            return sample
+
+        await bot.save_sample(self.router, sample(0))
+        changes = bot.DB.writer.total_changes
+        # flow 0 пропал, 1..9 выросли, остальные простаивают
+        await bot.save_sample(self.router, sample(10, skip=0))
+        # 9 flow, 1 удалённый, строки трафика и устройств — но не вся таблица
+        self.assertLess(bot.DB.writer.total_changes - changes, 200)
+
+        state = await bot.load_flow_state(self.router.name)
+        self.assertEqual(state, self.router.tracker.flows)
+        self.assertEqual(len(state), FLOWS - 1)
+        self.assertEqual(state["5|tcp|x"][1], 2000)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from support import bot
+
+
+class LiveRatesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.live = bot.LiveRates()
+        self.router = bot.ROUTERS[0]
+        self.tracker = self.live.trackers[self.router.name]
+        self.calls = []
+        self.rx = 0
+
+    async def run_ssh_lines(self, host, user, key, cmd, on_line, executor=None, abort=None, timeout=None):
+        self.calls.append((executor, abort))
+        self.rx += 1000
+        on_line(bot.AGENT_HEADER)
+        on_line(f"1|tcp|10.0.0.5|40000|203.0.113.9|443 10.0.0.5 {self.rx} 0".encode())
+        await asyncio.sleep(0.01)
+        return True, ""
+
+    async def test_viewers_share_one_dump(self):
+        with mock.patch.object(bot, "run_ssh_lines", self.run_ssh_lines):
+            await asyncio.gather(*(self.live.sample() for _ in range(5)))
+            # свежий снимок отдаётся готовым
+            await self.live.sample()
+        self.assertEqual(len(self.calls), 1)
+        ((executor, abort),) = self.calls
+        self.assertIs(executor, bot.COLLECT_EXECUTOR)
+        self.assertTrue(abort.is_set())
+
+    async def test_failed_sample_keeps_baseline(self):
+        with mock.patch.object(bot, "run_ssh_lines", self.run_ssh_lines):
+            await self.live._sample_all()
+        baseline = dict(self.tracker.flows)
+
+        async def hung(host, user, key, cmd, on_line, executor=None, abort=None, timeout=None):
+            self.calls.append((executor, abort))
+            on_line(bot.AGENT_HEADER)
+            on_line(b"1|tcp|10.0.0.5|40000|203.0.113.9|443 10.0.0.5 999999 0")
+            await asyncio.sleep(10)
+
+        with mock.patch.object(bot, "run_ssh_lines", hung), mock.patch.object(bot, "TRAFFIC_ROUTER_TIMEOUT", 0.05):
+            rates, failed = await self.live._sample_all()
+        self.assertEqual(failed, [self.router.name])
+        self.assertTrue(self.calls[-1][1].is_set())
+        # недочитанный снимок не стал точкой отсчёта — всплеска не будет
+        self.assertEqual(self.tracker.flows, baseline)
+        self.assertIsNone(self.tracker.current)
+
+        with mock.patch.object(bot, "run_ssh_lines", self.run_ssh_lines):
+            rates, failed = await self.live._sample_all()
+        ((ip, rx, _),) = rates.values()
+        self.assertEqual(ip, "10.0.0.5")
+        self.assertLess(rx, 999999)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from support import bot
+
+
+def lines(a: int, b: int):
+    return [f"2025-01-01 12:00:{i:02d} " + ("ошибка" if i % 10 == 7 else "сбор трафика") + f" #{i}"
+            for i in range(a, b)]
+
+
+class ReadLogPageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "bot.log")
+        # маленькие блоки и страницы: границы блоков и страниц приходятся на середину строк
+        for name, value in (("LOG_BLOCK", 50), ("LOG_PAGE_CHARS", 200), ("LOG_BACKUPS", 2)):
+            patcher = mock.patch.object(bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write(self, path, rows):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("".join(r + "\n" for r in rows))
+
+    def pages_older(self, match=None):
+        """Листание «⬅ Раньше» от конца до начала; страницы в порядке показа."""
+        pages = []
+        offset = -1
+        while True:
+            page, start, end, size = bot.read_log_page(self.path, offset, True, match)
+            pages.append(page)
+            if start == 0:
+                return pages
+            offset = start
+
+    def pages_newer(self, match=None):
+        pages = []
+        offset = 0
+        while True:
+            page, start, end, size = bot.read_log_page(self.path, offset, False, match)
+            pages.append(page)
+            if end + 1 >= size:
+                return pages
+            offset = end
+
+    def test_first_page_is_tail(self):
+        rows = lines(0, 60)
+        self.write(self.path, rows)
+        page, start, end, size = bot.read_log_page(self.path, -1)
+        self.assertEqual(end, size)
+        self.assertGreater(start, 0)
+        self.assertEqual(page, rows[-len(page):])
+        self.assertLessEqual(sum(len(r) + 1 for r in page), bot.LOG_PAGE_CHARS)
+
+    def test_last_page_reaches_start(self):
+        rows = lines(0, 60)
+        self.write(self.path, rows)
+        pages = self.pages_older()
+        self.assertGreater(len(pages), 3)
+        self.assertEqual(pages[-1][0], rows[0])
+        self.assertEqual([r for p in reversed(pages) for r in p], rows)
+        # вперёд — те же строки, без пропусков и повторов на стыках
+        self.assertEqual([r for p in self.pages_newer() for r in p], rows)
+
+    def test_filter(self):
+        rows = lines(0, 60)
+        self.write(self.path, rows)
+        match = bot.log_matcher("error")
+        self.assertEqual([r for p in reversed(self.pages_older(match)) for r in p],
+                         [r for r in rows if "ошибка" in r])
+
+        page, start, end, size = bot.read_log_page(self.path, -1, True, bot.log_matcher("text:нет такого"))
+        self.assertEqual(page, [])
+        self.assertEqual(start, 0)
+
+    def test_page_crosses_rotated_file(self):
+        rows = lines(0, 60)
+        self.write(self.path + ".2", rows[:10])
+        self.write(self.path + ".1", rows[10:32])
+        self.write(self.path, rows[32:])
+        pages = self.pages_older()
+        self.assertEqual([r for p in reversed(pages) for r in p], rows)
+        # хотя бы одна страница начинается в path.1 и кончается в path
+        self.assertTrue(any(rows[31] in p and rows[32] in p for p in pages))
+        self.assertEqual([r for p in self.pages_newer() for r in p], rows)
+
+        _, _, _, size = bot.read_log_page(self.path, -1)
+        self.assertEqual(size, sum(os.path.getsize(self.path + s) for s in ("", ".1", ".2")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+
+from support import bot
+
+LAN = bot.parse_subnets("192.168.1.0/24,2001:db8:1::/64")
+
+# (строка conntrack -L -o extended,id, ожидаемый (flow_key, lan_ip, rx, tx) или None)
+FLOW_LINES = [
+    # исходящее TCP из LAN
+    ("ipv4     2 tcp      6 431999 ESTABLISHED src=192.168.1.50 dst=93.184.216.34 sport=51234 dport=443 "
+     "packets=10 bytes=1234 src=93.184.216.34 dst=203.0.113.5 sport=443 dport=51234 packets=12 bytes=5678 "
+     "[ASSURED] mark=0 use=1 id=3735928559",
+     ("3735928559|tcp|192.168.1.50|51234|93.184.216.34|443", "192.168.1.50", 5678, 1234)),
+    # без ответа: [UNREPLIED] перед второй группой
+    ("ipv4     2 udp      17 29 src=192.168.1.50 dst=8.8.8.8 sport=5353 dport=53 packets=1 bytes=60 "
+     "[UNREPLIED] src=8.8.8.8 dst=203.0.113.5 sport=53 dport=5353 packets=0 bytes=0 mark=0 use=1 id=123",
+     ("123|udp|192.168.1.50|5353|8.8.8.8|53", "192.168.1.50", 0, 60)),
+    # ICMP: своего id= в кортеже, портов нет
+    ("ipv4     2 icmp     1 29 src=192.168.1.50 dst=1.1.1.1 type=8 code=0 id=17 packets=1 bytes=84 "
+     "src=1.1.1.1 dst=203.0.113.5 type=0 code=0 id=17 packets=1 bytes=84 mark=0 use=1 id=999",
+     ("999|icmp|192.168.1.50||1.1.1.1|", "192.168.1.50", 84, 84)),
+    ("ipv6     10 tcp      6 7439 ESTABLISHED src=2001:db8:1::50 dst=2606:4700::1111 sport=40000 dport=443 "
+     "packets=5 bytes=500 src=2606:4700::1111 dst=2001:db8:1::50 sport=443 dport=40000 packets=7 bytes=7000 "
+     "[ASSURED] mark=0 use=1 id=42",
+     ("42|tcp|2001:db8:1::50|40000|2606:4700::1111|443", "2001:db8:1::50", 7000, 500)),
+    # проброс порта: LAN-адрес только в ответе
+    ("ipv4     2 tcp      6 86399 ESTABLISHED src=198.51.100.7 dst=203.0.113.5 sport=55555 dport=8080 "
+     "packets=3 bytes=300 src=192.168.1.60 dst=198.51.100.7 sport=80 dport=55555 packets=4 bytes=4000 "
+     "[ASSURED] mark=0 use=1 id=77",
+     ("77|tcp|198.51.100.7|55555|203.0.113.5|8080", "192.168.1.60", 300, 4000)),
+    # входящее в LAN
+    ("ipv4     2 tcp      6 86399 ESTABLISHED src=198.51.100.7 dst=192.168.1.61 sport=1 dport=22 "
+     "packets=3 bytes=300 src=192.168.1.61 dst=198.51.100.7 sport=22 dport=1 packets=4 bytes=4000 "
+     "[ASSURED] mark=0 use=1 id=78",
+     ("78|tcp|198.51.100.7|1|192.168.1.61|22", "192.168.1.61", 300, 4000)),
+    # старый conntrack без колонки семейства
+    ("tcp      6 431999 ESTABLISHED src=192.168.1.50 dst=93.184.216.34 sport=51234 dport=443 packets=10 "
+     "bytes=1234 src=93.184.216.34 dst=203.0.113.5 sport=443 dport=51234 packets=12 bytes=5678 "
+     "[ASSURED] mark=0 use=1 id=1",
+     ("1|tcp|192.168.1.50|51234|93.184.216.34|443", "192.168.1.50", 5678, 1234)),
+    # ни одного адреса LAN
+    ("ipv4     2 tcp      6 300 ESTABLISHED src=10.9.9.9 dst=1.1.1.1 sport=1 dport=2 packets=1 bytes=1 "
+     "src=1.1.1.1 dst=10.9.9.9 sport=2 dport=1 packets=1 bytes=1 mark=0 use=1 id=5", None),
+    # link-local вне LAN
+    ("ipv6     10 udp      17 29 src=fe80::1 dst=ff02::fb sport=5353 dport=5353 packets=1 bytes=100 "
+     "[UNREPLIED] src=ff02::fb dst=fe80::1 sport=5353 dport=5353 packets=0 bytes=0 mark=0 use=1 id=9", None),
+    ("conntrack v1.4.6 (conntrack-tools): 57 flow entries have been shown.", None),
+    ("", None),
+]
+
+NEIGHBORS = """\
+192.168.1.50 dev br-lan lladdr AA:BB:CC:DD:EE:01 REACHABLE
+192.168.1.51 dev br-lan lladdr aa:bb:cc:dd:ee:02 STALE
+192.168.1.52 dev br-lan  FAILED
+192.168.1.53 dev br-lan  INCOMPLETE
+2001:db8:1::50 dev br-lan lladdr aa:bb:cc:dd:ee:01 DELAY
+fe80::1 dev br-lan lladdr aa:bb:cc:dd:ee:03 router STALE
+fe80::2%br-lan dev br-lan lladdr aa:bb:cc:dd:ee:04 STALE
+192.168.1.54 dev br-lan lladdr 00:00:00:00:00:00 PERMANENT
+IP address       HW type     Flags       HW address            Mask     Device
+192.168.1.55     0x1         0x2         aa:bb:cc:dd:ee:05     *        br-lan
+192.168.1.56     0x1         0x0         00:00:00:00:00:00     *        br-lan
+1700000000 aa:bb:cc:dd:ee:02 192.168.1.51 laptop 01:aa:bb:cc:dd:ee:02
+1700000000 aa:bb:cc:dd:ee:05 192.168.1.55 * 01:aa:bb:cc:dd:ee:05
+"""
+
+# адрес → (mac, имя из dhcp.leases) или None — записи нет
+NEIGHBOR_CASES = [
+    ("192.168.1.50", ("aa:bb:cc:dd:ee:01", None)),    # MAC в нижнем регистре
+    ("192.168.1.51", ("aa:bb:cc:dd:ee:02", "laptop")),
+    ("192.168.1.52", None),                           # FAILED — без lladdr
+    ("192.168.1.53", None),                           # INCOMPLETE
+    ("2001:db8:1::50", ("aa:bb:cc:dd:ee:01", None)),
+    ("fe80::1", ("aa:bb:cc:dd:ee:03", None)),         # флаг router перед состоянием
+    ("fe80::2", ("aa:bb:cc:dd:ee:04", None)),         # адрес с зоной
+    ("192.168.1.54", None),                           # нулевой MAC
+    ("192.168.1.55", ("aa:bb:cc:dd:ee:05", None)),    # /proc/net/arp, имя "*"
+    ("192.168.1.56", None),                           # /proc/net/arp, неполная запись
+]
+
+
+class ParseFlowLineTest(unittest.TestCase):
+    def test_lines(self):
+        for line, expected in FLOW_LINES:
+            with self.subTest(line=line[:60]):
+                self.assertEqual(bot.parse_flow_line(line, LAN), expected)
+
+
+class ParseNeighborsTest(unittest.TestCase):
+    def test_entries(self):
+        table = bot.parse_neighbors(NEIGHBORS)
+        for ip, expected in NEIGHBOR_CASES:
+            with self.subTest(ip=ip):
+                self.assertEqual(table.get(bot.pack_ip(ip)), expected)
+        self.assertEqual(len(table), sum(1 for _, e in NEIGHBOR_CASES if e is not None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from support import bot
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append(text)
+        return SimpleNamespace(message_id=len(self.replies), chat_id=1, edit_text=self.edit_text)
+
+    async def edit_text(self, text, reply_markup=None):
+        self.replies.append(text)
+
+
+def update(uid: int):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=uid), message=FakeMessage())
+
+
+class RebootRouterTest(unittest.IsolatedAsyncioTestCase):
+    async def reboot(self, uid: int):
+        calls = []
+
+        async def run_ssh(host, user, key, cmd):
+            calls.append((host, cmd))
+            return True, ""
+
+        u = update(uid)
+        with mock.patch.object(bot, "run_ssh", run_ssh):
+            await bot.reboot_router(u, SimpleNamespace(chat_data={}))
+        return calls, u.message.replies
+
+    async def test_denied_for_unknown_user(self):
+        calls, replies = await self.reboot(uid=2)
+        self.assertEqual(calls, [])
+        self.assertEqual(replies, ["Доступ запрещён."])
+
+    async def test_admin_reboots_router(self):
+        calls, _ = await self.reboot(uid=1)
+        self.assertEqual(calls, [(bot.ROUTER_IP, "reboot")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import ipaddress
+import unittest
+
+from support import bot
+
+
+class ParseRoutersTest(unittest.TestCase):
+    def test_ipv4(self):
+        (r,) = bot.parse_routers("main=root@192.168.1.1:/home/u/.ssh/key:192.168.1.0/24,10.0.0.0/20")
+        self.assertEqual((r.name, r.user, r.host, r.key), ("main", "root", "192.168.1.1", "/home/u/.ssh/key"))
+        self.assertTrue(r.lan.lookup("10.0.15.1"))
+        self.assertFalse(r.lan.lookup("10.0.16.1"))
+
+    def test_ipv6_subnets(self):
+        routers = bot.parse_routers(
+            "main=root@192.168.1.1:/key:192.168.1.0/24,2001:db8::/64; ap=root@192.168.2.1:/ap_key:fd00:1::/64"
+        )
+        main, ap = routers
+        self.assertEqual((main.host, main.key), ("192.168.1.1", "/key"))
+        self.assertEqual(main.lan.lookup("2001:db8::5"), ipaddress.ip_network("2001:db8::/64"))
+        self.assertTrue(main.lan.lookup("192.168.1.7"))
+        self.assertEqual((ap.name, ap.host, ap.key), ("ap", "192.168.2.1", "/ap_key"))
+        self.assertTrue(ap.lan.lookup("fd00:1::abcd"))
+        self.assertFalse(ap.lan.lookup("192.168.1.7"))
+
+    def test_ipv6_host(self):
+        (r,) = bot.parse_routers("v6=root@[fd00::1]:/key:fd00::/64")
+        self.assertEqual((r.host, r.key), ("fd00::1", "/key"))
+        self.assertTrue(r.lan.lookup("fd00::99"))
+
+    def test_defaults(self):
+        (r,) = bot.parse_routers("ap=10.0.0.2")
+        self.assertEqual((r.host, r.user, r.key), ("10.0.0.2", bot.ROUTER_SSH_USER, bot.ROUTER_SSH_KEY))
+        self.assertIs(r.lan, bot.DEFAULT_LAN)
+
+        (r,) = bot.parse_routers("ap=admin@10.0.0.2::10.1.0.0/24")
+        self.assertEqual((r.user, r.key), ("admin", bot.ROUTER_SSH_KEY))
+        self.assertTrue(r.lan.lookup("10.1.0.5"))
+
+
+class AgentCommandTest(unittest.TestCase):
+    def test_prefixes_passed_to_agent(self):
+        (r,) = bot.parse_routers("main=10.0.0.1::192.168.1.0/24,10.0.0.0/16")
+        self.assertIn("'10.0.,192.168.1.'", r.dump_command())
+
+    def test_wide_subnet_skips_agent(self):
+        # у 10.0.0.0/7 нет текстового префикса — только полный дамп
+        (r,) = bot.parse_routers("main=10.0.0.1::192.168.1.0/24,10.0.0.0/7")
+        self.assertEqual(r.dump_command(), "conntrack -L -o extended,id | cat || true")
+        self.assertNotIn(bot.TRAFFIC_AGENT_COMMAND, r.events.command())
+
+
+    def test_unaligned_subnets_skip_agent(self):
+        # "10.0." у 10.0.0.0/20 подходит и к 10.0.200.x, "172." у /12 — к 172.200.x
+        for cidr in ("10.0.0.0/20", "172.16.0.0/12", "2001:db8::/64", "192.168.1.5/32"):
+            with self.subTest(cidr=cidr):
+                (r,) = bot.parse_routers(f"main=10.0.0.1::192.168.1.0/24,{cidr}")
+                self.assertFalse(r.lan.exact)
+                self.assertNotIn(bot.TRAFFIC_AGENT_COMMAND, r.dump_command())
+                self.assertNotIn(bot.TRAFFIC_AGENT_COMMAND, r.events.command())
+
+    def test_aligned_subnets_use_agent(self):
+        for cidr in ("10.0.0.0/16", "172.16.0.0/16", "2001:db8:1:2::/64"):
+            with self.subTest(cidr=cidr):
+                (r,) = bot.parse_routers(f"main=10.0.0.1::{cidr}")
+                self.assertTrue(r.lan.exact)
+                self.assertIn(bot.TRAFFIC_AGENT_COMMAND, r.dump_command())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+from support import bot
+
+
+class FakeMessage:
+    def __init__(self):
+        self.markup = None
+
+    async def edit_text(self, text, reply_markup=None):
+        self.markup = reply_markup
+
+
+class FakeQuery:
+    def __init__(self, data: str):
+        self.data = data
+        self.message = FakeMessage()
+
+    async def edit_message_text(self, text, reply_markup=None):
+        pass
+
+
+def servers(*names):
+    return [bot.Server(name, "", f"10.0.0.{i + 2}", "u", "/key") for i, name in enumerate(names)]
+
+
+class ForceButtonTest(unittest.IsolatedAsyncioTestCase):
+    async def run_busy(self, all_servers, busy):
+        async def host(run, s):
+            if s.name in busy:
+                run.skipped.append(s.name)
+
+        run = bot.ShutdownRun(all_servers, FakeMessage())
+        with mock.patch.object(bot.ShutdownRun, "host", host):
+            await run.run()
+        return [b.callback_data for row in run.msg.markup.inline_keyboard for b in row]
+
+    async def test_only_skipped_names(self):
+        data = await self.run_busy(servers("nas", "media", "backup"), {"nas", "backup"})
+        self.assertEqual(data, ["shutdown:force:nas,backup"])
+
+    async def test_long_names_get_own_buttons(self):
+        names = [f"server-with-a-long-name-{i}" for i in range(3)]
+        data = await self.run_busy(servers(*names), set(names))
+        self.assertEqual(data, [f"shutdown:force:{n}" for n in names])
+
+    async def test_force_callback_targets_listed_servers(self):
+        started = []
+        with mock.patch.object(bot, "SERVERS", servers("nas", "media", "backup")), \
+                mock.patch.object(bot, "shutdown_servers", lambda s, msg, force=False: started.append((s, force))):
+            await bot.shutdown_callback(FakeQuery("shutdown:force:nas,backup"), None, "shutdown:force:nas,backup")
+        ((targets, force),) = started
+        self.assertEqual([s.name for s in targets], ["nas", "backup"])
+        self.assertTrue(force)
+
+
+if __name__ == "__main__":
+    unittest.main()
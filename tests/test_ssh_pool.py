@@ -0,0 +1,48 @@
+import threading
+import unittest
+from unittest import mock
+
+from support import bot
+
+
+class FakeTransport:
+    def is_active(self):
+        return True
+
+
+class FakeClient:
+    def get_transport(self):
+        return FakeTransport()
+
+    def close(self):
+        pass
+
+
+class SSHPoolTest(unittest.TestCase):
+    def test_open_sessions_under_concurrency(self):
+        pool = bot.SSHPool(keepalive=0, connect_timeout=1)
+        hosts = [f"10.0.0.{i}" for i in range(2, 22)]
+
+        def worker():
+            for _ in range(50):
+                for host in hosts:
+                    pool.client(host, "root", "/key")
+                    pool.stats()
+                    pool.drop(host, "root", "/key")
+
+        with mock.patch.object(pool, "connect", lambda host, user, key: FakeClient()):
+            threads = [threading.Thread(target=worker) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(pool.stats()["open_sessions"], 0)
+
+            client, reused = pool.client(hosts[0], "root", "/key")
+            self.assertFalse(reused)
+            self.assertEqual(pool.client(hosts[0], "root", "/key"), (client, True))
+            self.assertEqual(pool.stats()["open_sessions"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
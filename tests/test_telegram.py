@@ -0,0 +1,115 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from telegram.error import RetryAfter
+
+from support import bot
+
+
+class BuildApplicationTest(unittest.TestCase):
+    def test_request_pool_size(self):
+        app = bot.build_application()
+        get_updates, request = app.bot._request
+        self.assertIsInstance(request, bot.TimedRequest)
+        limits = request._client_kwargs["limits"]
+        self.assertEqual(limits.max_connections, bot.TG_POOL_SIZE)
+        self.assertGreater(bot.TG_POOL_SIZE, 1)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(bot.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_queue(self):
+        bucket = bot.TokenBucket(2, 3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+        # дальше — в очередь по 1 / rate секунд
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+
+    def test_refill(self):
+        bucket = bot.TokenBucket(2, 3)
+        for _ in range(3):
+            bucket.reserve()
+        self.clock.now += 1
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.5])
+        # запас не копится выше burst
+        self.clock.now += 100
+        self.assertTrue(bucket.idle())
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_block(self):
+        bucket = bot.TokenBucket(2, 3)
+        bucket.block(5)
+        self.assertEqual(bucket.reserve(), 5.5)
+
+    def test_zero_rate_is_unlimited(self):
+        bucket = bot.TokenBucket(0, 1)
+        self.assertEqual([bucket.reserve() for _ in range(5)], [0.0] * 5)
+
+    def test_zero_chat_rates(self):
+        with mock.patch.object(bot, "TG_RATE_CHAT", 0), mock.patch.object(bot, "TG_RATE_GROUP", 0):
+            limiter = bot.OutboundLimiter()
+            self.assertIsNone(limiter._chat_bucket(42))
+            self.assertIsNone(limiter._chat_bucket(-100123))
+            self.assertIsNone(limiter._chat_bucket("@channel"))
+        self.assertIsNotNone(bot.OutboundLimiter()._chat_bucket(42))
+
+
+class RetryAfterTest(unittest.IsolatedAsyncioTestCase):
+    async def send(self, limiter, chat_id, errors: int):
+        calls = []
+
+        async def callback():
+            calls.append(1)
+            if len(calls) <= errors:
+                raise RetryAfter(7)
+            return "ok"
+
+        sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        with mock.patch.object(asyncio, "sleep", sleep):
+            result = await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, None)
+        return result, len(calls), sleeps
+
+    async def test_retry_waits_for_chat(self):
+        limiter = bot.OutboundLimiter()
+        result, calls, sleeps = await self.send(limiter, 42, errors=1)
+        self.assertEqual((result, calls), ("ok", 2))
+        self.assertEqual(limiter.counters["retries"], 1)
+        # повтор встал за блокировкой чата, общий bucket не тронут
+        self.assertGreaterEqual(sleeps[-1], 7)
+        self.assertFalse(limiter.global_bucket.reserve() > 0)
+
+    async def test_gives_up_after_max_retries(self):
+        limiter = bot.OutboundLimiter()
+        with self.assertRaises(RetryAfter):
+            await self.send(limiter, 42, errors=bot.TG_MAX_RETRIES + 1)
+        self.assertEqual(limiter.counters["failed"], 1)
+        self.assertEqual(limiter.counters["retries"], bot.TG_MAX_RETRIES)
+
+    async def test_retry_without_chat_limit(self):
+        with mock.patch.object(bot, "TG_RATE_CHAT", 0):
+            limiter = bot.OutboundLimiter()
+            result, calls, sleeps = await self.send(limiter, 42, errors=1)
+        self.assertEqual((result, calls), ("ok", 2))
+        self.assertEqual(sleeps, [7.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+
+from support import bot
+
+SECRET = "s3cret"
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        self.server = await asyncio.start_server(bot.webhook_handler(self.app, SECRET), "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def post(self, body: bytes) -> str:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(
+            f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\n"
+            f"Host: localhost\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        status = (await reader.readline()).decode().strip()
+        writer.close()
+        return status
+
+    async def test_update_queued(self):
+        status = await self.post(json.dumps({"update_id": 1}).encode())
+        self.assertEqual(status, "HTTP/1.1 200 OK")
+        self.assertEqual((await self.app.update_queue.get()).update_id, 1)
+
+    async def test_non_object_rejected(self):
+        for body in (b"[1, 2]", b"42", b'"text"', b"null", b"{not json"):
+            self.assertEqual(await self.post(body), "HTTP/1.1 400 Bad Request", body)
+        self.assertTrue(self.app.update_queue.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,16 +18,39 @@ Telegram WOL Bot + OpenWrt Router Control + Traffic Stats via conntrack
 """
 
 import asyncio
+import bisect
+import calendar
+import csv
+import functools
+import gzip
+import hmac
+import io
+import ipaddress
+import json
+import multiprocessing
 import os
+import random
 import sys
 import re
+import secrets
+import shlex
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from array import array
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Tuple, List
+from typing import TYPE_CHECKING, Dict, Tuple, List
+from urllib.parse import urlparse
 
-import paramiko
 import aiosqlite
-from wakeonlan import send_magic_packet
 from dotenv import load_dotenv
 from dateutil.relativedelta import relativedelta
 
@@ -37,15 +60,25 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    PersistenceInput,
     filters,
 )
 
+# paramiko (самый тяжёлый импорт) и wakeonlan загружаются при первом
+# SSH-подключении / WOL, а не при запуске
+if TYPE_CHECKING:
+    import paramiko
+
 # ---------------------------------------------------------------------
 # Загружаем .env
 # ---------------------------------------------------------------------
@@ -63,28 +96,124 @@ SERVER_IP = os.getenv("SERVER_IP", "")
 SSH_USER_OMV = os.getenv("SSH_USER_OMV", "")
 SSH_KEY_OMV = os.getenv("SSH_KEY_OMV", "")
 
+# Несколько серверов:
+#   SERVERS="omv=AA:BB:CC:DD:EE:FF,192.168.1.10; nas=11:22:33:44:55:66,192.168.1.11,root,/home/YOU/.ssh/nas_key"
+# (пользователь и ключ SSH — необязательно, по умолчанию SSH_USER_OMV / SSH_KEY_OMV).
+# Пусто — один сервер из SERVER_MAC / SERVER_IP.
+SERVERS_CONFIG = os.getenv("SERVERS", "")
+DEFAULT_SERVER = "server"
+# WOL: WOL_BURST пакетов с интервалом WOL_BURST_INTERVAL с на WOL_BROADCAST
+# и напрямую на IP сервера; затем ждём, пока откроется TCP-порт WOL_PROBE_PORT,
+# проверяя всё реже (до WOL_PROBE_MAX_DELAY с), но не дольше WOL_BOOT_TIMEOUT с
+WOL_BURST = int(os.getenv("WOL_BURST", "3"))
+WOL_BURST_INTERVAL = float(os.getenv("WOL_BURST_INTERVAL", "0.2"))
+WOL_BROADCAST = os.getenv("WOL_BROADCAST", "255.255.255.255")
+WOL_PROBE_PORT = int(os.getenv("WOL_PROBE_PORT", "22"))
+WOL_PROBE_MAX_DELAY = int(os.getenv("WOL_PROBE_MAX_DELAY", "15"))
+WOL_BOOT_TIMEOUT = int(os.getenv("WOL_BOOT_TIMEOUT", "300"))
+# Выключение: команда запускается в фоне на сервере; перед ней проверяются
+# сеансы (who) и процессы резервного копирования SHUTDOWN_BUSY_PROCESSES,
+# после — ждём, пока сервер перестанет отвечать, не дольше SHUTDOWN_VERIFY_TIMEOUT с
+SHUTDOWN_COMMAND = os.getenv("SHUTDOWN_COMMAND", "sudo -n shutdown -h now")
+SHUTDOWN_BUSY_PROCESSES = [
+    x.strip() for x in os.getenv("SHUTDOWN_BUSY_PROCESSES", "rsync,borg,restic,rsnapshot,duplicity").split(",")
+    if x.strip()
+]
+SHUTDOWN_VERIFY_TIMEOUT = int(os.getenv("SHUTDOWN_VERIFY_TIMEOUT", "180"))
+
 ROUTER_IP = os.getenv("ROUTER_IP", "")
 ROUTER_SSH_USER = os.getenv("ROUTER_SSH_USER", "")
 ROUTER_SSH_KEY = os.getenv("ROUTER_SSH_KEY", "")
 
+# Подсети LAN: CIDR IPv4 / IPv6 через запятую ("192.168.1.0/24,fd00:1::/64")
+# или старый префикс ("192.168.1.")
 TRAFFIC_LAN_SUBNET = os.getenv("TRAFFIC_LAN_SUBNET", "192.168.1.")
-TRAFFIC_GREP_PATTERN = os.getenv("TRAFFIC_GREP_PATTERN", TRAFFIC_LAN_SUBNET)
+TRAFFIC_GREP_PATTERN = os.getenv("TRAFFIC_GREP_PATTERN", "")
+
+# Несколько роутеров / точек доступа:
+#   ROUTERS="main=root@192.168.1.1:/home/YOU/.ssh/router_key:192.168.1.0/24;ap=root@192.168.2.1:/home/YOU/.ssh/ap_key:192.168.2.0/24"
+# Пусто — один роутер из ROUTER_IP / ROUTER_SSH_USER / ROUTER_SSH_KEY.
+ROUTERS_CONFIG = os.getenv("ROUTERS", "")
+DEFAULT_ROUTER = "main"
+# Устройство определяется по MAC из таблицы соседей и аренд DHCP роутера;
+# таблица кэшируется на TRAFFIC_NEIGHBOR_TTL секунд (0 — учёт по IP, как раньше)
+TRAFFIC_NEIGHBOR_TTL = int(os.getenv("TRAFFIC_NEIGHBOR_TTL", "300"))
+TRAFFIC_MAX_PARALLEL = int(os.getenv("TRAFFIC_MAX_PARALLEL", "4"))
+TRAFFIC_ROUTER_TIMEOUT = int(os.getenv("TRAFFIC_ROUTER_TIMEOUT", "90"))
+# предельное время одного прогона сбора по всем роутерам
+TRAFFIC_RUN_DEADLINE = int(os.getenv("TRAFFIC_RUN_DEADLINE", "120"))
+# случайный сдвиг запуска по таймеру, с
+TRAFFIC_COLLECTION_JITTER = int(os.getenv("TRAFFIC_COLLECTION_JITTER", "15"))
+# недоступный роутер опрашивается всё реже, но не реже раза в столько секунд
+TRAFFIC_BACKOFF_MAX = int(os.getenv("TRAFFIC_BACKOFF_MAX", "3600"))
 TRAFFIC_COLLECTION_ENABLED = os.getenv("TRAFFIC_COLLECTION_ENABLED", "true").lower() == "true"
+TRAFFIC_AGENT_MODE = os.getenv("TRAFFIC_AGENT_MODE", "auto").lower()
+TRAFFIC_AGENT_COMMAND = os.getenv("TRAFFIC_AGENT_COMMAND", "wolbot-ct")
 TRAFFIC_COLLECTION_INTERVAL = int(os.getenv("TRAFFIC_COLLECTION_INTERVAL", "600"))
+TRAFFIC_EVENTS_ENABLED = os.getenv("TRAFFIC_EVENTS_ENABLED", "false").lower() == "true"
+TRAFFIC_EVENTS_FLUSH_INTERVAL = int(os.getenv("TRAFFIC_EVENTS_FLUSH_INTERVAL", "60"))
 TRAFFIC_DB_PATH = os.getenv("TRAFFIC_DB_PATH", "/home/user/wol_bot_data/traffic_stats.db")
 TRAFFIC_RETENTION_DAYS = int(os.getenv("TRAFFIC_RETENTION_DAYS", "730"))
+TRAFFIC_RAW_RETENTION_DAYS = int(os.getenv("TRAFFIC_RAW_RETENTION_DAYS", "31"))
+TRAFFIC_HOURLY_RETENTION_DAYS = int(os.getenv("TRAFFIC_HOURLY_RETENTION_DAYS", "90"))
+TRAFFIC_PRUNE_INTERVAL = int(os.getenv("TRAFFIC_PRUNE_INTERVAL", "86400"))
+TRAFFIC_PRUNE_THRESHOLD = int(os.getenv("TRAFFIC_PRUNE_THRESHOLD", "50000"))
+TRAFFIC_PRUNE_BATCH = int(os.getenv("TRAFFIC_PRUNE_BATCH", "2000"))
+# chat_data / bot_data (id сообщений для авто-удаления) пишутся в ту же БД
+# не чаще раза в столько секунд и при остановке; 0 — не сохранять
+BOT_STATE_INTERVAL = int(os.getenv("BOT_STATE_INTERVAL", "60"))
+
+SSH_POOL_ENABLED = os.getenv("SSH_POOL_ENABLED", "true").lower() == "true"
+SSH_KEEPALIVE_INTERVAL = int(os.getenv("SSH_KEEPALIVE_INTERVAL", "30"))
+SSH_CONNECT_TIMEOUT = int(os.getenv("SSH_CONNECT_TIMEOUT", "10"))
+SSH_COMMAND_TIMEOUT = int(os.getenv("SSH_COMMAND_TIMEOUT", "60"))
+SSH_STREAM_CHUNK = int(os.getenv("SSH_STREAM_CHUNK", "65536"))
 
 LOG_PATH = os.getenv("LOG_PATH", "/home/user/wol_bot_data/wol_bot_conntrack.log")
+# ротация LOG_PATH по размеру (0 — не ротировать), сколько старых файлов хранить
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "3"))
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", "300"))
 KEEP_CHAT_MESSAGES = int(os.getenv("KEEP_CHAT_MESSAGES", "4"))
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "32"))
+# «⚡ Сейчас»: период замера скорости и сколько секунд обновлять сообщение
+LIVE_INTERVAL = int(os.getenv("LIVE_INTERVAL", "5"))
+LIVE_DURATION = int(os.getenv("LIVE_DURATION", "60"))
+# сколько устройств рисовать на графике отдельно (остальные — «другие»)
+CHART_TOP_DEVICES = int(os.getenv("CHART_TOP_DEVICES", "10"))
+# устройств на странице «📋 Устройства»
+DEVICES_PAGE_SIZE = int(os.getenv("DEVICES_PAGE_SIZE", "10"))
+
+# Замеры времени (гистограммы) и счётчики; METRICS_PORT=0 — без HTTP /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_BIND = os.getenv("METRICS_BIND", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Лимиты исходящих запросов к Bot API (токенов в секунду; 0 — без лимитов).
+# В группах у Telegram свой лимит — TG_RATE_GROUP сообщений в минуту.
+TG_RATE_GLOBAL = float(os.getenv("TG_RATE_GLOBAL", "25"))
+TG_RATE_CHAT = float(os.getenv("TG_RATE_CHAT", "1"))
+TG_RATE_GROUP = float(os.getenv("TG_RATE_GROUP", "20"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# соединений к Bot API для всех запросов, кроме getUpdates (как у ApplicationBuilder)
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "256"))
+
+# Получение обновлений: "polling" (по умолчанию) или "webhook".
+# Вебхук слушает WEBHOOK_LISTEN:WEBHOOK_PORT по HTTP (TLS — на reverse proxy);
+# WEBHOOK_URL — публичный адрес для setWebhook, пусто — не регистрировать
+# (локальная проверка). WEBHOOK_SECRET пуст — случайный при каждом запуске.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "") or urlparse(WEBHOOK_URL).path or "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
 # ---------------------------------------------------------------------
 # Проверки
 # ---------------------------------------------------------------------
 
-if not TG_BOT_TOKEN:
-    print("ERROR: TG_BOT_TOKEN not set")
-    sys.exit(1)
-
 IP_RE = re.compile(r"^(\d{1,3}\.){3}\d{1,3}$")
 
 
@@ -96,6 +225,23 @@ def is_allowed(uid: int) -> bool:
     return (not ADMIN_USER_IDS) or (uid in ADMIN_USER_IDS)
 
 
+_BACKGROUND = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Фоновая задача; ссылка хранится, пока задача не завершится."""
+    task = asyncio.create_task(coro)
+    _BACKGROUND.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task: asyncio.Task):
+    _BACKGROUND.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print("Ошибка фоновой задачи:", scrub(str(task.exception())))
+
+
 def scrub(text: str) -> str:
     """Удаление приватных путей из логов."""
     text = re.sub(r"/home/[^\s]+", "[PATH]", text)
@@ -103,259 +249,2612 @@ def scrub(text: str) -> str:
     return text
 
 
-async def run_ssh(host: str, user: str, key: str, cmd: str) -> Tuple[bool, str]:
-    """SSH-выполнение команды (OMV или OpenWrt)."""
+# ---------------------------------------------------------------------
+# Метрики: гистограммы времени и счётчики (формат Prometheus)
+# ---------------------------------------------------------------------
 
-    def _run():
+# верхние границы корзин гистограмм, секунды
+HIST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metrics:
+    """
+    Гистограммы времени, счётчики и текущие значения в памяти процесса.
+
+    Запись — один bisect и одно обновление списка под lock (вызывается
+    и из SSH-потоков). Ключ серии — (имя, метки), метки — кортеж пар.
+    При enabled=False запись ничего не делает, а timed() возвращает
+    функцию без обёртки.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # (имя, метки) → [счётчики по корзинам + Inf, сумма, количество]
+        self._hist: Dict[tuple, list] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._gauges: Dict[tuple, float] = {}
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()):
+        if not self.enabled:
+            return
+        i = bisect.bisect_left(HIST_BUCKETS, seconds)
+        with self._lock:
+            h = self._hist.get((name, labels))
+            if h is None:
+                h = self._hist[(name, labels)] = [[0] * (len(HIST_BUCKETS) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def inc(self, name: str, value: float = 1, labels: tuple = ()):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def set(self, name: str, value: float, labels: tuple = ()):
+        if not self.enabled:
+            return
+        self._gauges[(name, labels)] = value
+
+    def timed(self, name: str, **labels):
+        """Декоратор async-функции: время выполнения и число ошибок."""
+        label_pairs = tuple(sorted(labels.items()))
+
+        def wrap(fn):
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            async def timed_fn(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    self.inc(name.replace("_seconds", "_errors_total"), labels=label_pairs)
+                    raise
+                finally:
+                    self.observe(name, time.perf_counter() - t0, label_pairs)
+
+            return timed_fn
+
+        return wrap
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition."""
+        with self._lock:
+            hist = {k: (list(h[0]), h[1], h[2]) for k, h in self._hist.items()}
+            counters = dict(self._counters)
+        gauges = dict(self._gauges)
+
+        out = []
+        typed = set()
+        for (name, labels), (buckets, total, count) in sorted(hist.items()):
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(HIST_BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                out.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            out.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            out.append(f"{name}_count{self._labels(labels)} {count}")
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in sorted(series.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f"# TYPE {name} {kind}")
+                out.append(f"{name}{self._labels(labels)} {value:g}")
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> List[tuple]:
+        """[(имя{метки}, количество, среднее мс, p95 мс)] — для /stats."""
+        with self._lock:
+            hist = {k: (list(h[0]), h[1], h[2]) for k, h in self._hist.items()}
+        rows = []
+        for (name, labels), (buckets, total, count) in sorted(hist.items()):
+            # p95 — верхняя граница корзины, в которую он попал
+            need, acc, p95 = count * 0.95, 0, float("inf")
+            for bound, n in zip(HIST_BUCKETS + (float("inf"),), buckets):
+                acc += n
+                if acc >= need:
+                    p95 = bound
+                    break
+            short = name.replace("wolbot_", "").replace("_seconds", "")
+            rows.append((short + self._labels(labels), count, total / count * 1000, p95 * 1000))
+        return rows
+
+
+METRICS = Metrics(METRICS_ENABLED)
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API с замером времени каждого вызова по методу."""
+
+    async def do_request(self, url: str, *args, **kwargs):
+        t0 = time.perf_counter()
         try:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            METRICS.observe(
+                "wolbot_telegram_api_seconds", time.perf_counter() - t0,
+                (("method", url.rsplit("/", 1)[-1]),)
+            )
+
+
+async def read_http_request(reader: asyncio.StreamReader, max_body: int = 0):
+    """
+    Минимальный разбор HTTP/1.x запроса: (метод, путь без query,
+    заголовки с именами в нижнем регистре, тело). Тело — только по
+    Content-Length и не больше max_body; иначе ValueError.
+    """
+    request = await asyncio.wait_for(reader.readline(), 5)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), 5)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= 100:
+            raise ValueError("слишком много заголовков")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise ValueError("chunked не поддерживается")
+    length = int(headers.get("content-length") or 0)
+    if length < 0 or length > max_body:
+        raise ValueError(f"тело запроса {length} байт")
+    body = await asyncio.wait_for(reader.readexactly(length), 10) if length else b""
+
+    parts = request.decode("latin-1").split()
+    method = parts[0] if parts else ""
+    path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+    return method, path, headers, body
+
+
+async def write_http_response(writer: asyncio.StreamWriter, status: str, body: bytes = b"",
+                              content_type: str = "text/plain; charset=utf-8"):
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP: GET /metrics → текст Prometheus, остальное — 404."""
+    try:
+        method, path, _, _ = await read_http_request(reader)
+        if method == "GET" and path == "/metrics":
+            status, body = "200 OK", METRICS.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        await write_http_response(writer, status, body, "text/plain; version=0.0.4; charset=utf-8")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# ---------------------------------------------------------------------
+# Исходящие запросы к Telegram: очередь с token bucket и повтор после 429
+# ---------------------------------------------------------------------
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst подряд; rate <= 0 — без лимита."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self) -> float:
+        """
+        Занять токен. Возвращает, сколько секунд ждать отправки: токены
+        уходят в минус, поэтому запросы встают в очередь в порядке вызова.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def block(self, seconds: float):
+        """Telegram ответил 429: ближайшие seconds секунд токенов нет."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """
+    Все запросы бота к Bot API (кроме getUpdates) проходят здесь:
+    ждут токена общего bucket (TG_RATE_GLOBAL в секунду) и bucket своего
+    чата (TG_RATE_CHAT в секунду, в группах — TG_RATE_GROUP в минуту).
+
+    На 429 (RetryAfter) чат — или весь бот, если чата у запроса нет —
+    замолкает на retry_after секунд, и запрос повторяется до TG_MAX_RETRIES
+    раз с паузой не меньше retry_after и растущей с каждой попыткой.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_RATE_GLOBAL, int(max(TG_RATE_GLOBAL, 1)))
+        self.chats: Dict[object, TokenBucket] = {}
+        self.counters = {"requests": 0, "queued": 0, "retries": 0, "failed": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        """Bucket чата; None, если для чатов такого вида лимит выключен (0)."""
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            group = not str(chat_id).lstrip("-").isdigit() or int(chat_id) < 0
+            rate = TG_RATE_GROUP / 60 if group else TG_RATE_CHAT
+            if rate <= 0:
+                return None
+            if len(self.chats) >= 1024:
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle()}
+            bucket = self.chats[chat_id] = TokenBucket(rate, TG_CHAT_BURST)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        self.counters["requests"] += 1
+        attempt = 0
+        while True:
+            wait = self.global_bucket.reserve()
+            if bucket is not None:
+                wait = max(wait, bucket.reserve())
+            if wait > 0:
+                self.counters["queued"] += 1
+                METRICS.observe("wolbot_telegram_wait_seconds", wait)
+                await asyncio.sleep(wait)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > TG_MAX_RETRIES:
+                    self.counters["failed"] += 1
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                delay = max(float(retry_after), 2.0 ** (attempt - 1))
+                if bucket is not None:
+                    bucket.block(delay)
+                elif chat_id is not None:
+                    # у чата нет лимита (TG_RATE_CHAT / TG_RATE_GROUP = 0) — ждёт только сам запрос
+                    await asyncio.sleep(delay)
+                else:
+                    self.global_bucket.block(delay)
+                self.counters["retries"] += 1
+                METRICS.inc("wolbot_telegram_retries_total", labels=(("method", endpoint),))
+                print(f"Telegram: лимит запросов ({endpoint}), повтор через {delay:.0f} с")
+
+
+# ---------------------------------------------------------------------
+# SSH: кэш ключей и пул постоянных соединений
+# ---------------------------------------------------------------------
+
+_PKEY_CACHE: Dict[str, tuple] = {}
+
+
+def load_pkey(key: str):
+    """
+    Загружает приватный ключ (Ed25519 → RSA) один раз.
+    Повторно читаем файл только если он изменился (mtime).
+    """
+    if not key or not os.path.exists(key):
+        return None
+
+    mtime = os.path.getmtime(key)
+    cached = _PKEY_CACHE.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    import paramiko
+
+    pkey = None
+    for loader in (paramiko.Ed25519Key, paramiko.RSAKey):
+        try:
+            pkey = loader.from_private_key_file(key)
+            break
+        except Exception:
+            pass
+
+    _PKEY_CACHE[key] = (mtime, pkey)
+    return pkey
+
+
+class StreamAborted(Exception):
+    """Чтение вывода прервано вызывающим (истёк срок прогона)."""
 
-            pkey = None
-            if os.path.exists(key):
-                # Пробуем Ed25519 → RSA
-                for loader in (paramiko.Ed25519Key, paramiko.RSAKey):
-                    try:
-                        pkey = loader.from_private_key_file(key)
-                        break
-                    except Exception:
-                        pass
 
-            client.connect(hostname=host, username=user, pkey=pkey, timeout=10)
+class SSHPool:
+    """
+    Одно постоянное SSH-соединение на (host, user, key).
+
+    Transport держится живым через keepalive, команды выполняются
+    отдельными exec-каналами поверх него. Если роутер перезагрузился
+    и transport умер — при следующем вызове переподключаемся.
+    """
 
-            stdin, stdout, stderr = client.exec_command(cmd, timeout=60)
-            out = stdout.read().decode(errors="ignore")
-            err = stderr.read().decode(errors="ignore")
+    def __init__(self, keepalive: int, connect_timeout: int):
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._clients: Dict[tuple, "paramiko.SSHClient"] = {}
+        self._locks: Dict[tuple, threading.Lock] = {}
+        # _clients, _locks и counters меняются из потоков пула — только под _guard
+        self._guard = threading.Lock()
+        self.counters = {
+            "connects": 0,
+            "reuses": 0,
+            "reconnects": 0,
+            "failures": 0,
+            "connect_ms": 0.0,
+            "exec_count": 0,
+            "exec_ms": 0.0,
+        }
+
+    def _lock_for(self, k: tuple) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(k, threading.Lock())
+
+    def _count(self, name: str, value=1):
+        with self._guard:
+            self.counters[name] += value
+
+    def connect(self, host: str, user: str, key: str) -> "paramiko.SSHClient":
+        """Новое соединение без пула (учитывается в счётчиках)."""
+        import paramiko
+
+        t0 = time.monotonic()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=host,
+            username=user,
+            pkey=load_pkey(key),
+            timeout=self.connect_timeout,
+        )
+        transport = client.get_transport()
+        if transport is not None and self.keepalive > 0:
+            transport.set_keepalive(self.keepalive)
+        self._count("connects")
+        self._count("connect_ms", (time.monotonic() - t0) * 1000)
+        METRICS.observe("wolbot_ssh_seconds", time.monotonic() - t0, (("phase", "connect"),))
+        return client
+
+    def client(self, host: str, user: str, key: str) -> Tuple["paramiko.SSHClient", bool]:
+        """
+        Возвращает (client, reused).
+        reused=True — соединение взято из пула, а не только что создано.
+        """
+        k = (host, user, key)
+        with self._lock_for(k):
+            with self._guard:
+                client = self._clients.get(k)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    self._count("reuses")
+                    return client, True
+                # transport умер (например, роутер перезагрузился)
+                self._count("reconnects")
+                client.close()
+
+            client = self.connect(host, user, key)
+            with self._guard:
+                self._clients[k] = client
+            return client, False
+
+    def drop(self, host: str, user: str, key: str):
+        k = (host, user, key)
+        with self._lock_for(k):
+            with self._guard:
+                client = self._clients.pop(k, None)
+        if client is not None:
+            client.close()
 
+    def close_all(self):
+        with self._guard:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
             client.close()
 
-            if err and not out:
-                return False, err
-            return True, out
+    def open_channel(self, host: str, user: str, key: str, cmd: str, timeout: int) -> "paramiko.Channel":
+        """Запускает команду в новом exec-канале поверх общего transport."""
+        for attempt in range(2):
+            client, reused = self.client(host, user, key)
+            try:
+                chan = client.get_transport().open_session(timeout=timeout)
+            except Exception:
+                # Канал не открылся — соединение из пула протухло.
+                # Команда до роутера не дошла, поэтому один повтор безопасен.
+                self.drop(host, user, key)
+                if reused and attempt == 0:
+                    continue
+                raise
+            chan.settimeout(timeout)
+            chan.exec_command(cmd)
+            return chan
+        import paramiko
+
+        raise paramiko.SSHException("SSH: не удалось открыть канал")
+
+    def stream(self, host: str, user: str, key: str, cmd: str, timeout: int, on_chunk) -> Tuple[bool, str]:
+        """
+        Синхронное выполнение команды через пул (вызывать из потока).
+        stdout отдаётся в on_chunk(bytes) по мере поступления.
+        Возвращает (ok, stderr).
+        """
+        try:
+            chan = self.open_channel(host, user, key, cmd, timeout)
         except Exception as e:
+            self._count("failures")
             return False, str(e)
 
-    return await asyncio.to_thread(_run)
+        try:
+            return self.pump(chan, on_chunk)
+        except StreamAborted as e:
+            # канал уже закрыт, соединение исправно
+            return False, str(e)
+        except Exception as e:
+            # Команда уже запущена — не повторяем (reboot/shutdown)
+            self.drop(host, user, key)
+            return False, str(e)
 
+    def pump(self, chan: "paramiko.Channel", on_chunk) -> Tuple[bool, str]:
+        """Читает stdout канала кусками по SSH_STREAM_CHUNK, затем stderr."""
+        t0 = time.monotonic()
+        first = None
+        got_out = False
+        try:
+            while True:
+                data = chan.recv(SSH_STREAM_CHUNK)
+                if first is None:
+                    # до первого байта — время запуска команды на роутере
+                    first = time.monotonic()
+                    METRICS.observe("wolbot_ssh_seconds", first - t0, (("phase", "command"),))
+                if not data:
+                    break
+                got_out = True
+                on_chunk(data)
+            err = chan.makefile_stderr("rb").read().decode(errors="ignore")
+        except Exception:
+            self._count("failures")
+            raise
+        finally:
+            chan.close()
+
+        self._count("exec_count")
+        self._count("exec_ms", (time.monotonic() - t0) * 1000)
+        if first is not None:
+            METRICS.observe("wolbot_ssh_seconds", time.monotonic() - first, (("phase", "transfer"),))
+
+        if err and not got_out:
+            return False, err
+        return True, err
+
+    def exec(self, host: str, user: str, key: str, cmd: str, timeout: int) -> Tuple[bool, str]:
+        """Синхронное выполнение команды с чтением всего вывода в строку."""
+        chunks = []
+        ok, err = self.stream(host, user, key, cmd, timeout, chunks.append)
+        if not ok:
+            return False, err
+        return True, b"".join(chunks).decode(errors="ignore")
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики пула + средние задержки (мс)."""
+        with self._guard:
+            c = dict(self.counters)
+            c["open_sessions"] = len(self._clients)
+        c["connect_avg_ms"] = c["connect_ms"] / c["connects"] if c["connects"] else 0.0
+        c["exec_avg_ms"] = c["exec_ms"] / c["exec_count"] if c["exec_count"] else 0.0
+        return c
+
+
+SSH_POOL = SSHPool(SSH_KEEPALIVE_INTERVAL, SSH_CONNECT_TIMEOUT)
+
+
+def _run_ssh_fresh(host: str, user: str, key: str, cmd: str, timeout: int, on_chunk) -> Tuple[bool, str]:
+    """Старый путь: новое соединение на каждую команду (SSH_POOL_ENABLED=false)."""
+    try:
+        client = SSH_POOL.connect(host, user, key)
+    except Exception as e:
+        SSH_POOL._count("failures")
+        return False, str(e)
 
-async def send_wol(mac: str):
     try:
-        await asyncio.to_thread(send_magic_packet, mac)
-        return True, "WOL пакет отправлен."
+        chan = client.get_transport().open_session(timeout=timeout)
+        chan.settimeout(timeout)
+        chan.exec_command(cmd)
+        return SSH_POOL.pump(chan, on_chunk)
     except Exception as e:
         return False, str(e)
+    finally:
+        client.close()
+
+
+class LineSplitter:
+    """Режет поток байтов на строки, держа в памяти только незавершённый хвост."""
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.tail = b""
+
+    def feed(self, chunk: bytes):
+        lines = (self.tail + chunk).split(b"\n")
+        self.tail = lines.pop()
+        for line in lines:
+            self.on_line(line)
+
+    def close(self):
+        if self.tail:
+            self.on_line(self.tail)
+            self.tail = b""
+
+
+def _ssh_stream(host: str, user: str, key: str, cmd: str, on_chunk, timeout: int = None) -> Tuple[bool, str]:
+    timeout = timeout or SSH_COMMAND_TIMEOUT
+    if SSH_POOL_ENABLED:
+        return SSH_POOL.stream(host, user, key, cmd, timeout, on_chunk)
+    return _run_ssh_fresh(host, user, key, cmd, timeout, on_chunk)
+
+
+# Отдельный ограниченный пул потоков для сбора трафика: зависший роутер
+# занимает не больше TRAFFIC_MAX_PARALLEL потоков и не отнимает их
+# у остальных команд бота (WOL, выключение, перезагрузка).
+COLLECT_EXECUTOR = ThreadPoolExecutor(max_workers=max(TRAFFIC_MAX_PARALLEL, 1), thread_name_prefix="collect")
+
+
+async def run_ssh(host: str, user: str, key: str, cmd: str, executor=None) -> Tuple[bool, str]:
+    """SSH-выполнение команды (OMV или OpenWrt)."""
+
+    def _run():
+        chunks = []
+        ok, err = _ssh_stream(host, user, key, cmd, chunks.append)
+        if not ok:
+            return False, err
+        return True, b"".join(chunks).decode(errors="ignore")
+
+    t0 = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(executor, _run)
+    METRICS.observe("wolbot_ssh_command_seconds", time.perf_counter() - t0)
+    return result
+
+
+async def run_ssh_lines(host: str, user: str, key: str, cmd: str, on_line,
+                        executor=None, abort: threading.Event = None, timeout: int = None) -> Tuple[bool, str]:
+    """
+    Потоковое SSH-выполнение: on_line(bytes) вызывается для каждой строки
+    stdout прямо в рабочем потоке, весь вывод целиком в памяти не держится.
+    abort — прервать чтение (и закрыть канал) с ближайшим куском вывода.
+    Возвращает (ok, stderr).
+    """
+
+    def _run():
+        splitter = LineSplitter(on_line)
+        # время разбора (on_line) — замеряется на кусок, а не на строку
+        parse = [0.0]
+
+        def on_chunk(chunk: bytes):
+            if abort is not None and abort.is_set():
+                raise StreamAborted("чтение прервано")
+            t0 = time.perf_counter()
+            splitter.feed(chunk)
+            parse[0] += time.perf_counter() - t0
+
+        ok, err = _ssh_stream(host, user, key, cmd, on_chunk, timeout)
+        if ok:
+            splitter.close()
+            METRICS.observe("wolbot_parse_seconds", parse[0])
+        return ok, err
+
+    t0 = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(executor, _run)
+    METRICS.observe("wolbot_ssh_command_seconds", time.perf_counter() - t0)
+    return result
+
+
+async def send_wol(mac: str, ip: str = "") -> Tuple[bool, str]:
+    """
+    WOL_BURST магических пакетов на WOL_BROADCAST и, если известен, напрямую
+    на ip (роутер мог сохранить ARP-запись спящего сервера).
+    Успех — если хоть один адрес принял пакеты.
+    """
+    targets = [WOL_BROADCAST] + ([ip] if ip and ip != WOL_BROADCAST else [])
+
+    def _send(addr: str):
+        from wakeonlan import send_magic_packet
+
+        send_magic_packet(mac, ip_address=addr)
+
+    sent, errors = set(), []
+    for i in range(max(WOL_BURST, 1)):
+        if i:
+            await asyncio.sleep(WOL_BURST_INTERVAL)
+        for addr in targets:
+            try:
+                await asyncio.to_thread(_send, addr)
+                sent.add(addr)
+            except Exception as e:
+                errors.append(f"{addr}: {e}")
+    if not sent:
+        return False, "; ".join(errors[-len(targets):])
+    return True, f"{max(WOL_BURST, 1)}× на {', '.join(a for a in targets if a in sent)}"
+
+
+async def probe_tcp(host: str, port: int, timeout: float = 2.0) -> str:
+    """
+    Проверка сервера TCP-подключением: "up" — порт принимает соединения,
+    "refused" — хост в сети, но порт ещё закрыт, "down" — нет ответа.
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except ConnectionRefusedError:
+        return "refused"
+    except (OSError, asyncio.TimeoutError):
+        return "down"
+    writer.close()
+    return "up"
+
+
+# ---------------------------------------------------------------------
+# Серверы: включение по WOL с ожиданием загрузки
+# ---------------------------------------------------------------------
+
+class Server:
+    """Сервер под управлением бота: MAC для WOL, IP и SSH-доступ для проверки и выключения."""
+
+    def __init__(self, name: str, mac: str, ip: str, user: str, key: str):
+        self.name = name
+        self.mac = mac
+        self.ip = ip
+        self.user = user
+        self.key = key
+
+
+def parse_servers(spec: str) -> List[Server]:
+    """
+    SERVERS="name=mac,ip[,user,key]; name2=..."
+    Без SERVERS — один сервер из SERVER_MAC / SERVER_IP.
+    """
+    if not spec.strip():
+        return [Server(DEFAULT_SERVER, SERVER_MAC, SERVER_IP, SSH_USER_OMV, SSH_KEY_OMV)]
+
+    servers = []
+    for item in spec.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, target = item.partition("=")
+        mac, ip, user, key = ([x.strip() for x in target.split(",")] + ["", "", "", ""])[:4]
+        servers.append(Server(name.strip(), mac, ip, user or SSH_USER_OMV, key or SSH_KEY_OMV))
+    return servers
+
+
+SERVERS = parse_servers(SERVERS_CONFIG)
+
+
+def find_server(name: str):
+    return next((s for s in SERVERS if s.name == name), None)
+
+
+class WakeUp:
+    """
+    Одно включение сервера: пакеты WOL, затем проверки TCP-порта с растущей
+    паузой. Ход загрузки пишется во все сообщения, подписанные на включение:
+    повторное нажатие, пока сервер ещё включается, не шлёт пакеты заново,
+    а добавляет своё сообщение к уже идущему включению.
+    """
+
+    def __init__(self, server: Server):
+        self.server = server
+        self.messages = []
+        self.text = ""
+        self.started = time.monotonic()
+        self.task = None
+
+    async def _edit(self, msg, text: str):
+        try:
+            await msg.edit_text(text)
+        except TelegramError:
+            # сообщение уже удалено (авто-очистка) или текст не изменился
+            pass
+
+    async def attach(self, msg):
+        self.messages.append(msg)
+        if self.text:
+            await self._edit(msg, self.text)
+
+    async def show(self, text: str):
+        if text == self.text:
+            return
+        self.text = text
+        for msg in list(self.messages):
+            await self._edit(msg, text)
+
+    async def run(self):
+        s = self.server
+        try:
+            if not s.mac:
+                return await self.show(f"Ошибка: для {s.name} не задан MAC")
+            if s.ip and await probe_tcp(s.ip, WOL_PROBE_PORT) == "up":
+                return await self.show(f"🖥 {s.name} уже включён.")
+
+            ok, info = await send_wol(s.mac, s.ip)
+            if not ok:
+                return await self.show(f"Ошибка WOL {s.name}: {info}")
+            if not s.ip:
+                # проверять нечего — как раньше, только факт отправки
+                return await self.show(f"OK: WOL пакеты {s.name} отправлены ({info}).")
+            await self.show(f"🖥 {s.name}: WOL отправлен ({info}), жду загрузки...")
+
+            delay, online = 1, False
+            deadline = self.started + WOL_BOOT_TIMEOUT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+                state = await probe_tcp(s.ip, WOL_PROBE_PORT)
+                elapsed = time.monotonic() - self.started
+                if state == "up":
+                    METRICS.observe("wolbot_wake_seconds", elapsed, (("server", s.name),))
+                    return await self.show(f"✅ {s.name} включён за {elapsed:.0f} с (порт {WOL_PROBE_PORT} отвечает).")
+                online = online or state == "refused"
+                stage = "в сети, жду порт" if online else "загружается"
+                await self.show(f"🖥 {s.name}: {stage} {WOL_PROBE_PORT}... {elapsed:.0f} с")
+                delay = min(delay * 2, WOL_PROBE_MAX_DELAY)
+
+            METRICS.inc("wolbot_wake_timeouts_total", labels=(("server", s.name),))
+            await self.show(
+                f"⚠ {s.name} не ответил на порт {WOL_PROBE_PORT} за {WOL_BOOT_TIMEOUT} с"
+                + (" (хост в сети)." if online else ".")
+            )
+        finally:
+            WAKES.pop(s.name, None)
+
+
+# имя сервера → идущее включение
+WAKES: Dict[str, WakeUp] = {}
+
+
+async def wake_server(server: Server, msg) -> WakeUp:
+    """Включить сервер (в фоне) и показывать ход загрузки в msg; повторный вызов присоединяется к идущему."""
+    job = WAKES.get(server.name)
+    if job is not None:
+        await job.attach(msg)
+        return job
+    job = WAKES[server.name] = WakeUp(server)
+    job.messages.append(msg)
+    job.task = spawn(job.run())
+    return job
+
+
+# ---------------------------------------------------------------------
+# Серверы: выключение с проверками
+# ---------------------------------------------------------------------
+
+def precheck_command() -> str:
+    """
+    Одна SSH-команда проверок перед выключением; строки вывода:
+        sessions N      — открытые сеансы (who)
+        busy PID NAME   — процессы резервного копирования
+        sudo ok|no      — разрешена ли команда выключения без пароля
+    """
+    parts = ["echo sessions $(who | wc -l)"]
+    if SHUTDOWN_BUSY_PROCESSES:
+        # -x по имени процесса: сама команда проверки (sh -c ...) не совпадёт
+        pattern = shlex.quote("|".join(SHUTDOWN_BUSY_PROCESSES))
+        parts.append(f"pgrep -l -x {pattern} | sed 's/^/busy /'")
+    words = SHUTDOWN_COMMAND.split()
+    if words[:1] == ["sudo"]:
+        i = 1
+        while i < len(words) and words[i].startswith("-"):
+            i += 1
+        parts.append(f"sudo -n -l {shlex.join(words[i:])} >/dev/null 2>&1 && echo sudo ok || echo sudo no")
+    return "; ".join(parts)
+
+
+def parse_precheck(output: str) -> dict:
+    info = {"sessions": 0, "busy": [], "sudo": True}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(" ")
+        if key == "sessions" and value.strip().isdigit():
+            info["sessions"] = int(value)
+        elif key == "busy" and value.split():
+            info["busy"].append(value.split()[-1])
+        elif key == "sudo":
+            info["sudo"] = value.strip() == "ok"
+    return info
+
+
+def detached(cmd: str) -> str:
+    """
+    Команда в фоне на сервере: SSH-канал закрывается сразу, до того как
+    выключение оборвёт соединение, поэтому ответ не теряется.
+    """
+    return f"nohup sh -c {shlex.quote('sleep 1; ' + cmd)} >/dev/null 2>&1 &"
+
+
+class ShutdownRun:
+    """
+    Выключение нескольких серверов с одним сообщением-сводкой. Для каждого
+    сервера параллельно: проверки (сеансы, резервное копирование, sudo),
+    команда выключения в фоне и проверки порта WOL_PROBE_PORT, пока сервер
+    не перестанет отвечать. Занятые серверы пропускаются; кнопка
+    «Выключить всё равно» повторяет прогон без проверки занятости.
+    """
+
+    def __init__(self, servers: List[Server], msg, force: bool = False):
+        self.servers = servers
+        self.msg = msg
+        self.force = force
+        self.status = {s.name: "проверяю..." for s in servers}
+        self.skipped = []
+        self.done = False
+        self.text = ""
+        self._lock = asyncio.Lock()
+
+    def render(self) -> str:
+        title = "⏹ Выключение серверов" + (":" if self.done else "...")
+        return "\n".join([title] + [f"• {name}: {st}" for name, st in self.status.items()])
+
+    async def show(self, reply_markup=None):
+        async with self._lock:
+            text = self.render()
+            if text == self.text and reply_markup is None:
+                return
+            self.text = text
+            try:
+                await self.msg.edit_text(text, reply_markup=reply_markup)
+            except TelegramError:
+                pass
+
+    async def set(self, server: Server, status: str):
+        self.status[server.name] = status
+        await self.show()
+
+    async def host(self, s: Server):
+        if not s.ip:
+            return await self.set(s, "⚠ не задан IP")
+        if await probe_tcp(s.ip, WOL_PROBE_PORT) == "down":
+            return await self.set(s, "уже выключен")
+
+        ok, out = await run_ssh(s.ip, s.user, s.key, precheck_command())
+        if not ok:
+            return await self.set(s, "⚠ проверка не удалась: " + scrub(out)[:200])
+        info = parse_precheck(out)
+        if not info["sudo"]:
+            return await self.set(s, "⚠ sudo требует пароль, команда выключения не пройдёт")
+        busy = []
+        if info["sessions"]:
+            busy.append(f"сеансов: {info['sessions']}")
+        if info["busy"]:
+            busy.append("идёт " + ", ".join(sorted(set(info["busy"]))))
+        if busy and not self.force:
+            self.skipped.append(s.name)
+            return await self.set(s, f"⏸ занят ({'; '.join(busy)}), не выключаю")
+
+        await self.set(s, "отправляю команду...")
+        t0 = time.monotonic()
+        ok, out = await run_ssh(s.ip, s.user, s.key, detached(SHUTDOWN_COMMAND))
+        # даже если канал оборвался, решает проверка: отвечает ли сервер
+        error = "" if ok else scrub(out)[:200]
+        await self.set(s, "завершает работу...")
+        while time.monotonic() - t0 < SHUTDOWN_VERIFY_TIMEOUT:
+            await asyncio.sleep(3)
+            if await probe_tcp(s.ip, WOL_PROBE_PORT) == "down":
+                METRICS.observe("wolbot_shutdown_seconds", time.monotonic() - t0, (("server", s.name),))
+                return await self.set(s, f"✅ выключен за {time.monotonic() - t0:.0f} с")
+        await self.set(s, f"⚠ отвечает и через {SHUTDOWN_VERIFY_TIMEOUT} с" + (f": {error}" if error else ""))
+
+    async def _host(self, s: Server):
+        try:
+            await self.host(s)
+        except Exception as e:
+            await self.set(s, "⚠ ошибка: " + scrub(str(e))[:200])
+
+    async def run(self):
+        await self.show()
+        await asyncio.gather(*(self._host(s) for s in self.servers))
+        self.done = True
+        kb = None
+        if self.skipped:
+            # только пропущенные серверы — остальные пользователь не подтверждал
+            data = "shutdown:force:" + ",".join(self.skipped)
+            if len(data.encode()) <= 64:
+                buttons = [[InlineKeyboardButton("⏹ Выключить всё равно", callback_data=data)]]
+            else:
+                # в callback_data (до 64 байт) все имена не влезают — по кнопке на сервер
+                buttons = [[InlineKeyboardButton(f"⏹ Выключить {name} всё равно",
+                                                 callback_data=f"shutdown:force:{name}")]
+                           for name in self.skipped]
+            kb = InlineKeyboardMarkup(buttons)
+        await self.show(kb)
+
+
+def shutdown_servers(servers: List[Server], msg, force: bool = False) -> asyncio.Task:
+    """Выключение в фоне: сводка обновляется в msg."""
+    return spawn(ShutdownRun(servers, msg, force).run())
 
 
 # ---------------------------------------------------------------------
 # Работа с базой данных SQLite
 # ---------------------------------------------------------------------
 
+class TrafficDB:
+    """
+    Долгоживущие соединения с SQLite, открываются один раз при запуске (main).
+
+    writer — все записи, каждая серия изменений в своей транзакции;
+    reader — только чтение (WAL позволяет читать, пока коллектор пишет).
+    """
+
+    PRAGMAS = (
+        # действует только для новой БД; старую переводит `migrate` (VACUUM)
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+        self.reader = None
+        self._write_lock = asyncio.Lock()
+
+    async def open(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        # isolation_level=None — транзакции открываем сами (BEGIN IMMEDIATE)
+        self.writer = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in self.PRAGMAS:
+            await self.writer.execute(pragma)
+
+        self.reader = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in self.PRAGMAS[2:]:
+            await self.reader.execute(pragma)
+        await self.reader.execute("PRAGMA query_only=ON")
+
+    async def close(self):
+        for conn in (self.reader, self.writer):
+            if conn is not None:
+                await conn.close()
+        self.reader = self.writer = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Одна транзакция на writer; параллельные записи ждут своей очереди."""
+        async with self._write_lock:
+            await self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.writer
+            except BaseException:
+                await self.writer.execute("ROLLBACK")
+                raise
+            await self.writer.execute("COMMIT")
+
+    async def incremental_vacuum(self) -> int:
+        """
+        Возвращает свободные страницы файлу; результат — сколько страниц освобождено.
+
+        Через execute() прагма делает один шаг и отдаёт лишь одну страницу,
+        поэтому идёт через executescript — он прогоняет её до конца.
+        executescript сам коммитит открытую транзакцию, так что BEGIN
+        не открываем, а только держим блокировку записи.
+        """
+        async with self._write_lock:
+            (auto_vacuum,) = await (await self.writer.execute("PRAGMA auto_vacuum")).fetchone()
+            if auto_vacuum != 2:
+                return 0
+            (before,) = await (await self.writer.execute("PRAGMA freelist_count")).fetchone()
+            await self.writer.executescript("PRAGMA incremental_vacuum;")
+            (after,) = await (await self.writer.execute("PRAGMA freelist_count")).fetchone()
+        return before - after
+
+    async def fetchall(self, q: str, params=()) -> List[tuple]:
+        async with self.reader.execute(q, params) as cur:
+            return await cur.fetchall()
+
+    async def fetchone(self, q: str, params=()):
+        async with self.reader.execute(q, params) as cur:
+            return await cur.fetchone()
+
+
+DB = TrafficDB(TRAFFIC_DB_PATH)
+
+
+SCHEMA_VERSION = 5
+
+# (таблица, колонка корзины, ширина корзины в секундах; 0 — календарный месяц)
+# Все метки времени — UTC epoch-секунды начала корзины.
+ROLLUPS = (
+    ("traffic_hourly", "hour", 3600),
+    ("traffic_daily", "day", 86400),
+    ("traffic_monthly", "month", 0),
+)
+
+# MAC (или IP, если MAC неизвестен) → devices.id,
+# чтобы не искать суррогатный ключ на каждую запись
+DEVICE_IDS: Dict[str, int] = {}
+
+
+def default_device_name(ip: str) -> str:
+    return "Device_" + ip.replace(".", "_").replace(":", "_")
+
+
+def month_start(year: int, month: int) -> int:
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def next_month_start(year: int, month: int) -> int:
+    return month_start(year + month // 12, month % 12 + 1)
+
+
+def bucket_start(ts: int, width: int) -> int:
+    if width:
+        return ts - ts % width
+    t = time.gmtime(ts)
+    return month_start(t.tm_year, t.tm_mon)
+
+
+async def _table_columns(db, table: str) -> List[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in await cur.fetchall()]
+
+
 async def init_db():
-    Path(TRAFFIC_DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    """
+    Схема v2: устройства с суррогатным id, время — целые epoch-секунды,
+    сырые замеры в WITHOUT ROWID таблице, кластеризованной по (device_id, ts).
+    v3: у устройства — роутер и подсеть, состояние flow — по роутерам.
+    v4: устройство определяется по MAC (IP — последний известный адрес);
+        по IP — только пока MAC неизвестен.
+    v5: состояние бота между перезапусками (bot_state).
+
+    Если найдена старая текстовая схема — она переименовывается в *_v1,
+    устройства и агрегаты переносятся сразу, а сырые замеры —
+    в фоне порциями (migrate_legacy_samples).
+    """
+    async with DB.transaction() as db:
+        cur = await db.execute("PRAGMA user_version")
+        (version,) = await cur.fetchone()
+        legacy = version < SCHEMA_VERSION and "collected_at" in await _table_columns(db, "traffic_stats")
+
+        if legacy:
+            for table in ("devices", "traffic_stats") + tuple(t for t, _, _ in ROLLUPS):
+                if await _table_columns(db, table):
+                    await db.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+
+        # до v4 ip был уникальным ключом устройства — пересоздаём таблицу
+        # с теми же id, ссылки из статистики остаются верными
+        old_devices = await _table_columns(db, "devices") if 2 <= version < 4 else []
+        if old_devices:
+            await db.execute("ALTER TABLE devices RENAME TO devices_v3")
 
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS devices (
-                ip TEXT PRIMARY KEY,
-                name TEXT,
+                id INTEGER PRIMARY KEY,
                 mac TEXT,
-                last_seen TEXT
+                ip TEXT NOT NULL,
+                name TEXT,
+                last_seen INTEGER,
+                router TEXT,
+                subnet TEXT
             )
         """)
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS devices_mac ON devices (mac) WHERE mac IS NOT NULL")
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS devices_ip ON devices (ip) WHERE mac IS NULL")
+
+        if old_devices:
+            router_cols = "router, subnet" if "router" in old_devices else "NULL, NULL"
+            await db.execute(f"""
+                INSERT INTO devices (id, ip, name, last_seen, router, subnet)
+                SELECT id, ip, name, last_seen, {router_cols} FROM devices_v3
+            """)
+            await db.execute("DROP TABLE devices_v3")
 
         await db.execute("""
             CREATE TABLE IF NOT EXISTS traffic_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                collected_at TEXT,
+                device_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                rx_bytes INTEGER NOT NULL,
+                tx_bytes INTEGER NOT NULL,
+                PRIMARY KEY (device_id, ts)
+            ) WITHOUT ROWID
+        """)
+
+        # Агрегаты по устройствам: час / день / месяц (UTC).
+        # Обновляются при записи, экраны трафика читают только их.
+        for table, bucket, _ in ROLLUPS:
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {bucket} INTEGER NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    rx_bytes INTEGER NOT NULL,
+                    tx_bytes INTEGER NOT NULL,
+                    PRIMARY KEY ({bucket}, device_id)
+                ) WITHOUT ROWID
+            """)
+        # статистика одного устройства (экран устройства) — без полного прохода
+        for table, bucket in (("traffic_daily", "day"), ("traffic_monthly", "month")):
+            await db.execute(f"CREATE INDEX IF NOT EXISTS {table}_device ON {table} (device_id, {bucket})")
+
+        # Последние увиденные счётчики каждого flow (для расчёта дельт).
+        # id flow уникален только в пределах роутера.
+        flow_columns = await _table_columns(db, "conntrack_flows")
+        if flow_columns and "router" not in flow_columns:
+            await db.execute("ALTER TABLE conntrack_flows RENAME TO conntrack_flows_v2")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS conntrack_flows (
+                router TEXT NOT NULL,
+                flow_key TEXT NOT NULL,
                 device_ip TEXT,
                 rx_bytes INTEGER,
-                tx_bytes INTEGER
-            )
+                tx_bytes INTEGER,
+                PRIMARY KEY (router, flow_key)
+            ) WITHOUT ROWID
+        """)
+        if flow_columns and "router" not in flow_columns:
+            await db.execute("""
+                INSERT INTO conntrack_flows (router, flow_key, device_ip, rx_bytes, tx_bytes)
+                SELECT ?, flow_key, device_ip, rx_bytes, tx_bytes FROM conntrack_flows_v2
+            """, (DEFAULT_ROUTER,))
+            await db.execute("DROP TABLE conntrack_flows_v2")
+
+        # chat_data / bot_data Telegram-приложения (BotStatePersistence)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_state (
+                kind TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            ) WITHOUT ROWID
         """)
 
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_ts_ip_date ON traffic_stats(device_ip, collected_at)")
-        await db.commit()
+        if legacy:
+            await _migrate_legacy_schema(db)
+
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
+        cur = await db.execute("SELECT COALESCE(mac, ip), id FROM devices")
+        DEVICE_IDS.clear()
+        DEVICE_IDS.update(await cur.fetchall())
 
-async def add_device(ip: str):
-    now = datetime.utcnow().isoformat()
 
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
+async def _migrate_legacy_schema(db):
+    """Перенос устройств и агрегатов из текстовой схемы (внутри транзакции init_db)."""
+    if await _table_columns(db, "devices_v1"):
         await db.execute("""
-            INSERT INTO devices (ip, name, last_seen)
-            VALUES (?, ?, ?)
-            ON CONFLICT(ip) DO UPDATE SET last_seen = excluded.last_seen
-        """, (ip, f"Device_{ip.replace('.', '_')}", now))
-        await db.commit()
+            INSERT OR IGNORE INTO devices (ip, name, last_seen)
+            SELECT ip, name, CAST(strftime('%s', last_seen) AS INTEGER)
+            FROM devices_v1
+        """)
+        await db.execute("DROP TABLE devices_v1")
+
+    has_rollups = bool(await _table_columns(db, "traffic_daily_v1"))
+
+    # устройства, которые есть только в статистике
+    source = "traffic_daily_v1" if has_rollups else "traffic_stats_v1"
+    await db.execute(f"""
+        INSERT OR IGNORE INTO devices (ip, name)
+        SELECT DISTINCT device_ip, 'Device_' || replace(device_ip, '.', '_')
+        FROM {source}
+    """)
+
+    # как ISO-префикс корзины превращается в начало корзины
+    to_epoch = {
+        "hour": "CAST(strftime('%s', {col} || ':00') AS INTEGER)",
+        "day": "CAST(strftime('%s', {col}) AS INTEGER)",
+        "month": "CAST(strftime('%s', {col} || '-01') AS INTEGER)",
+    }
+    prefix_len = {"hour": 13, "day": 10, "month": 7}
+
+    for table, bucket, _ in ROLLUPS:
+        if has_rollups:
+            expr = to_epoch[bucket].format(col=f"r.{bucket}")
+            await db.execute(f"""
+                INSERT INTO {table} ({bucket}, device_id, rx_bytes, tx_bytes)
+                SELECT {expr}, d.id, r.rx_bytes, r.tx_bytes
+                FROM {table}_v1 r JOIN devices d ON d.ip = r.device_ip
+            """)
+            await db.execute(f"DROP TABLE {table}_v1")
+        else:
+            # база старше агрегатов — строим их из сырых замеров
+            expr = to_epoch[bucket].format(col=f"substr(s.collected_at, 1, {prefix_len[bucket]})")
+            await db.execute(f"""
+                INSERT INTO {table} ({bucket}, device_id, rx_bytes, tx_bytes)
+                SELECT {expr}, d.id, SUM(s.rx_bytes), SUM(s.tx_bytes)
+                FROM traffic_stats_v1 s JOIN devices d ON d.ip = s.device_ip
+                GROUP BY 1, 2
+            """)
 
 
-async def save_sample(ip: str, rx: int, tx: int):
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO traffic_stats (collected_at, device_ip, rx_bytes, tx_bytes)
+async def migrate_legacy_samples(batch: int = 5000, pause: float = 0.05) -> int:
+    """
+    Онлайн-перенос сырых замеров из traffic_stats_v1 в новую схему.
+
+    Каждая порция — отдельная короткая транзакция: перенесённые строки
+    сразу удаляются из старой таблицы, поэтому перенос можно прервать
+    и продолжить при следующем запуске. Возвращает число перенесённых строк.
+    """
+    if not await _table_columns(DB.writer, "traffic_stats_v1"):
+        return 0
+
+    cutoff = (datetime.utcnow() - timedelta(days=TRAFFIC_RAW_RETENTION_DAYS)).isoformat()
+    moved = 0
+    while True:
+        async with DB.transaction() as db:
+            cur = await db.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM traffic_stats_v1 ORDER BY id LIMIT ?)", (batch,)
+            )
+            (hi,) = await cur.fetchone()
+            if hi is None:
+                await db.execute("DROP TABLE traffic_stats_v1")
+                break
+
+            # замеры старше срока хранения сырых данных уже есть в агрегатах
+            cur = await db.execute("""
+                INSERT INTO traffic_stats (device_id, ts, rx_bytes, tx_bytes)
+                SELECT d.id, CAST(strftime('%s', s.collected_at) AS INTEGER), s.rx_bytes, s.tx_bytes
+                FROM traffic_stats_v1 s JOIN devices d ON d.ip = s.device_ip
+                WHERE s.id <= ? AND s.collected_at >= ?
+                ON CONFLICT(device_id, ts) DO UPDATE SET
+                    rx_bytes = rx_bytes + excluded.rx_bytes,
+                    tx_bytes = tx_bytes + excluded.tx_bytes
+            """, (hi, cutoff))
+            moved += max(cur.rowcount, 0)
+            await db.execute("DELETE FROM traffic_stats_v1 WHERE id <= ?", (hi,))
+
+        await asyncio.sleep(pause)
+
+    print(f"Миграция traffic_stats завершена: перенесено {moved} строк")
+    return moved
+
+
+async def resolve_device_ids(db, keys) -> Dict[str, int]:
+    """MAC / ip → devices.id; новые id подтягиваются из БД одним запросом."""
+    if any(key not in DEVICE_IDS for key in keys):
+        cur = await db.execute("SELECT COALESCE(mac, ip), id FROM devices")
+        DEVICE_IDS.update(await cur.fetchall())
+    return DEVICE_IDS
+
+
+DEVICE_FIELDS = ("id", "mac", "ip", "name", "last_seen", "router", "subnet")
+
+
+class DeviceRegistry:
+    """
+    Все устройства в памяти: загружаются один раз при запуске,
+    дальше их обновляют save_cycle (новые устройства, last_seen, IP / MAC)
+    и переименование. Список и поиск «📋 Устройства» идут без запросов к БД.
+    """
+
+    def __init__(self):
+        self.items: Dict[int, dict] = {}
+        self._order = None
+
+    async def load(self):
+        rows = await DB.fetchall(f"SELECT {', '.join(DEVICE_FIELDS)} FROM devices")
+        self.items = {r[0]: dict(zip(DEVICE_FIELDS, r)) for r in rows}
+        self._order = None
+
+    def seen(self, device_id: int, mac, ip: str, name: str, last_seen: int, router: str, subnet: str):
+        """Устройство записано в save_cycle; имя меняется только у нового."""
+        d = self.items.get(device_id)
+        if d is None:
+            self.items[device_id] = dict(zip(DEVICE_FIELDS, (device_id, mac, ip, name, last_seen, router, subnet)))
+            self._order = None
+            return
+        if d["ip"] != ip:
+            self._order = None
+        d.update(ip=ip, last_seen=last_seen, router=router, subnet=subnet)
+        if mac:
+            d["mac"] = mac
+
+    def get(self, device_id: int):
+        return self.items.get(device_id)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def sorted(self) -> List[dict]:
+        """Сначала IPv4, по возрастанию адреса."""
+        if self._order is None:
+            self._order = sorted(
+                self.items.values(), key=lambda d: (":" in d["ip"], pack_ip(d["ip"]) or b"", d["id"])
+            )
+        return self._order
+
+    def search(self, query: str) -> List[dict]:
+        """Подстрока имени, IP или MAC (без учёта регистра, MAC — и через "-")."""
+        q = query.strip().lower()
+        if not q:
+            return self.sorted()
+        mac_q = q.replace("-", ":")
+        return [
+            d for d in self.sorted()
+            if q in (d["name"] or "").lower() or q in d["ip"] or (d["mac"] and mac_q in d["mac"])
+        ]
+
+    async def rename(self, device_id: int, name: str):
+        async with DB.transaction() as db:
+            await db.execute("UPDATE devices SET name = ? WHERE id = ?", (name, device_id))
+        self.items[device_id]["name"] = name
+
+    def names(self) -> Dict[str, str]:
+        """MAC / ip (ключ устройства) → имя."""
+        return {d["mac"] or d["ip"]: d["name"] for d in self.items.values()}
+
+    def labels(self) -> Dict[int, str]:
+        """id → подпись для графиков."""
+        return {d["id"]: d["name"] or d["ip"] for d in self.items.values()}
+
+
+DEVICES = DeviceRegistry()
+
+
+@METRICS.timed("wolbot_db_write_seconds", op="save_cycle")
+async def save_cycle(router: "Router", deltas: Dict[str, Dict[str, int]], flows: Dict[str, tuple] = None,
+                     saved: Dict[str, tuple] = None):
+    """
+    Весь цикл сбора одного роутера — одна транзакция:
+    устройства (last_seen, роутер, подсеть), прирост трафика и новое состояние flow.
+    Адреса одного MAC (IPv4 и IPv6, смена аренды DHCP) — одно устройство.
+    flows=None — только прирост (события DESTROY), состояние flow не трогаем.
+    saved — состояние flow, уже записанное в БД: тогда пишутся только
+    изменившиеся и удаляются пропавшие flow, а не вся таблица роутера.
+    """
+    now = int(time.time())
+    seen = {ip for ip, _, _ in flows.values()} if flows is not None else set()
+    seen.update(deltas)
+
+    # ip → ключ устройства; у устройства показываем IPv4, если он есть
+    keys = {}
+    devices = {}
+    for ip in sorted(seen, key=lambda a: ":" in a):
+        mac, host = router.neighbors.get(ip)
+        key = keys[ip] = mac or ip
+        if key not in devices:
+            subnet = str(router.lan.lookup(ip) or "")
+            devices[key] = (mac, ip, host or default_device_name(ip), now, router.name, subnet)
+
+    per_device: Dict[str, Dict[str, int]] = {}
+    for ip, v in deltas.items():
+        add_delta(per_device, keys[ip], v["in"], v["out"])
+    deltas = per_device
+
+    by_mac = [d for d in devices.values() if d[0]]
+    by_ip = [d[1:] for d in devices.values() if not d[0]]
+
+    async with DB.transaction() as db:
+        # устройство, известное до сих пор только по IP, получает свой MAC
+        await db.executemany("""
+            UPDATE devices SET mac = ?
+            WHERE mac IS NULL AND ip = ?
+              AND NOT EXISTS (SELECT 1 FROM devices WHERE mac = ?)
+        """, [(d[0], d[1], d[0]) for d in by_mac])
+        await db.executemany("""
+            INSERT INTO devices (mac, ip, name, last_seen, router, subnet)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(mac) WHERE mac IS NOT NULL DO UPDATE SET
+                ip = excluded.ip,
+                last_seen = excluded.last_seen,
+                router = excluded.router,
+                subnet = excluded.subnet
+        """, by_mac)
+        await db.executemany("""
+            INSERT INTO devices (ip, name, last_seen, router, subnet)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(ip) WHERE mac IS NULL DO UPDATE SET
+                last_seen = excluded.last_seen,
+                router = excluded.router,
+                subnet = excluded.subnet
+        """, by_ip)
+        # ключ-IP мог перейти к устройству с MAC — пусть id перечитаются
+        for d in by_mac:
+            DEVICE_IDS.pop(d[1], None)
+        ids = await resolve_device_ids(db, devices)
+
+        # одна и та же секунда (ручное обновление) — складываем
+        await db.executemany("""
+            INSERT INTO traffic_stats (device_id, ts, rx_bytes, tx_bytes)
             VALUES (?, ?, ?, ?)
-        """, (datetime.utcnow().isoformat(), ip, rx, tx))
-        await db.commit()
+            ON CONFLICT(device_id, ts) DO UPDATE SET
+                rx_bytes = rx_bytes + excluded.rx_bytes,
+                tx_bytes = tx_bytes + excluded.tx_bytes
+        """, [(ids[key], now, v["in"], v["out"]) for key, v in deltas.items()])
+
+        for table, bucket, width in ROLLUPS:
+            start = bucket_start(now, width)
+            await db.executemany(f"""
+                INSERT INTO {table} ({bucket}, device_id, rx_bytes, tx_bytes)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT({bucket}, device_id) DO UPDATE SET
+                    rx_bytes = rx_bytes + excluded.rx_bytes,
+                    tx_bytes = tx_bytes + excluded.tx_bytes
+            """, [(start, ids[key], v["in"], v["out"]) for key, v in deltas.items()])
+
+        if flows is not None:
+            if saved is None:
+                await db.execute("DELETE FROM conntrack_flows WHERE router = ?", (router.name,))
+                saved = {}
+            else:
+                await db.executemany(
+                    "DELETE FROM conntrack_flows WHERE router = ? AND flow_key = ?",
+                    [(router.name, k) for k in saved if k not in flows]
+                )
+            # простаивающие flow (счётчики те же) не переписываем — WAL растёт по активности
+            await db.executemany("""
+                INSERT INTO conntrack_flows (router, flow_key, device_ip, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(router, flow_key) DO UPDATE SET
+                    device_ip = excluded.device_ip,
+                    rx_bytes = excluded.rx_bytes,
+                    tx_bytes = excluded.tx_bytes
+            """, [(router.name, k, *v) for k, v in flows.items() if saved.get(k) != v])
+
+    for key, d in devices.items():
+        DEVICES.seen(ids[key], *d)
+
+
+async def load_flow_state(router: str) -> Dict[str, tuple]:
+    rows = await DB.fetchall(
+        "SELECT flow_key, device_ip, rx_bytes, tx_bytes FROM conntrack_flows WHERE router = ?", (router,)
+    )
+    return {k: (ip, rx, tx) for k, ip, rx, tx in rows}
+
+
+class BotStatePersistence(BasePersistence):
+    """
+    chat_data и bot_data в таблице bot_state той же БД: после перезапуска
+    бот помнит id своих сообщений и удаляет их как обычно. Значения — JSON
+    (кортежи возвращаются списками). user_data — ожидание ввода, фильтры —
+    не сохраняется: после перезапуска оно уже неактуально.
+
+    PTB вызывает update_* раз в BOT_STATE_INTERVAL секунд только для
+    изменившихся чатов и ещё раз при остановке.
+    """
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+
+    async def _load(self, kind: str) -> dict:
+        rows = await DB.fetchall("SELECT id, data FROM bot_state WHERE kind = ?", (kind,))
+        return {key: json.loads(data) for key, data in rows}
+
+    async def _save(self, kind: str, key: int, data: dict):
+        async with DB.transaction() as db:
+            await db.execute(
+                """
+                INSERT INTO bot_state (kind, id, data) VALUES (?, ?, ?)
+                ON CONFLICT(kind, id) DO UPDATE SET data = excluded.data
+                """,
+                (kind, key, json.dumps(data, ensure_ascii=False)),
+            )
+
+    async def get_chat_data(self) -> dict:
+        return await self._load("chat")
 
+    async def update_chat_data(self, chat_id: int, data: dict):
+        await self._save("chat", chat_id, data)
 
-async def cleanup_old():
-    cutoff = (datetime.utcnow() - timedelta(days=TRAFFIC_RETENTION_DAYS)).date().isoformat()
+    async def drop_chat_data(self, chat_id: int):
+        async with DB.transaction() as db:
+            await db.execute("DELETE FROM bot_state WHERE kind = 'chat' AND id = ?", (chat_id,))
 
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        await db.execute("DELETE FROM traffic_stats WHERE date(collected_at) < ?", (cutoff,))
-        await db.commit()
+    async def get_bot_data(self) -> dict:
+        return (await self._load("bot")).get(0, {})
+
+    async def update_bot_data(self, data: dict):
+        await self._save("bot", 0, data)
+
+    # user_data, callback_data и диалоги не сохраняются
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        # каждая запись — уже закоммиченная транзакция
+        pass
+
+
+# Состояние очистки: сколько строк записано с прошлого прохода и итог последнего
+RETENTION = {
+    "pending_rows": 0,
+    "last_run": None,
+    "last_result": None,
+}
+_RETENTION_LOCK = asyncio.Lock()
+
+
+async def _delete_batched(table: str, key: str, where: str, params: tuple, batch: int, pause: float) -> int:
+    """
+    Удаляет строки порциями по batch: каждая порция — короткая транзакция,
+    выбор строк идёт по первичному ключу, между порциями писатель свободен.
+    """
+    removed = 0
+    while True:
+        async with DB.transaction() as db:
+            cur = await db.execute(f"""
+                DELETE FROM {table}
+                WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {where} LIMIT ?)
+            """, params + (batch,))
+            n = max(cur.rowcount, 0)
+        removed += n
+        if n < batch:
+            return removed
+        await asyncio.sleep(pause)
+
+
+@METRICS.timed("wolbot_db_write_seconds", op="cleanup")
+async def cleanup_old(batch: int = None, pause: float = 0.05) -> Dict[str, object]:
+    """
+    Сырые замеры живут TRAFFIC_RAW_RETENTION_DAYS (они уже свёрнуты в агрегаты),
+    почасовые — TRAFFIC_HOURLY_RETENTION_DAYS, дневные и месячные — TRAFFIC_RETENTION_DAYS.
+
+    Удаление идёт порциями, затем освобождённые страницы возвращаются
+    через incremental_vacuum. Возвращает число удалённых строк по таблицам и время.
+    """
+    batch = batch or TRAFFIC_PRUNE_BATCH
+    now = int(time.time())
+    day = 86400
+    t0 = time.monotonic()
+
+    async with _RETENTION_LOCK:
+        removed = {
+            # IN по первой колонке ключа + диапазон по ts — идём по первичному ключу
+            "traffic_stats": await _delete_batched(
+                "traffic_stats", "device_id, ts",
+                "device_id IN (SELECT id FROM devices) AND ts < ?",
+                (bucket_start(now - TRAFFIC_RAW_RETENTION_DAYS * day, day),), batch, pause),
+            "traffic_hourly": await _delete_batched(
+                "traffic_hourly", "hour, device_id", "hour < ?",
+                (bucket_start(now - TRAFFIC_HOURLY_RETENTION_DAYS * day, day),), batch, pause),
+            "traffic_daily": await _delete_batched(
+                "traffic_daily", "day, device_id", "day < ?",
+                (bucket_start(now - TRAFFIC_RETENTION_DAYS * day, day),), batch, pause),
+            "traffic_monthly": await _delete_batched(
+                "traffic_monthly", "month, device_id", "month < ?",
+                (bucket_start(now - TRAFFIC_RETENTION_DAYS * day, 0),), batch, pause),
+        }
+
+        freed = await DB.incremental_vacuum()
+
+        result = {
+            "removed": removed,
+            "rows": sum(removed.values()),
+            "freed_pages": freed,
+            "seconds": round(time.monotonic() - t0, 3),
+        }
+        RETENTION.update(pending_rows=0, last_run=datetime.utcnow(), last_result=result)
+
+    if removed["traffic_monthly"]:
+        # из старых отчётов пропали месяцы
+        REPORT_CACHE.clear()
+
+    print(f"Очистка старых данных: удалено {result['rows']} строк {removed}, "
+          f"освобождено страниц {freed}, {result['seconds']} с")
+    return result
+
+
+async def retention_job(context):
+    """Раз в сутки (и при накоплении TRAFFIC_PRUNE_THRESHOLD новых строк)."""
+    if _RETENTION_LOCK.locked():
+        return
+    await cleanup_old()
 
 
 # ---------------------------------------------------------------------
 # Парсер conntrack
 # ---------------------------------------------------------------------
 
-RE_SRC = re.compile(r"src=(\d+\.\d+\.\d+\.\d+)")
-RE_DST = re.compile(r"dst=(\d+\.\d+\.\d+\.\d+)")
-RE_BYTES = re.compile(r"bytes=(\d+)")
+# Вся строка разбирается одним заранее скомпилированным выражением:
+# протокол, src/dst/порты и байты прямого направления, src и байты ответа.
+CT_LINE_RE = re.compile(
+    r"(?:\S+ +\d+ +)?(\S+) +\d+ [^=]*"
+    r"src=(\S+) dst=(\S+) (?:sport=(\d+) dport=(\d+) )?(?:\S+ )*?bytes=(\d+) "
+    r"(?:\[\w+\] )?src=(\S+) (?:\S+ )*?bytes=(\d+)"
+)
+
+
+def pack_ip(ip: str):
+    """IPv4 / IPv6 адрес → упакованные байты (4 или 16), None — не адрес."""
+    if ":" in ip:
+        # link-local с зоной: "fe80::1%br-lan"
+        ip = ip.split("%", 1)[0]
+    try:
+        return socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+    except (OSError, ValueError):
+        return None
+
+
+def text_prefix(net) -> str:
+    """
+    Текстовый префикс, с которого начинается запись любого адреса сети:
+    целые октеты IPv4 или группы IPv6 до первой нулевой (дальше conntrack
+    может сократить запись до "::"). Пусто — отсеивать по тексту нечем.
+    """
+    if net.version == 4:
+        octets = str(net.network_address).split(".")[:net.prefixlen // 8]
+        return ".".join(octets) + "." if octets else ""
+    groups = []
+    for g in net.network_address.exploded.split(":")[:net.prefixlen // 16]:
+        g = g.lstrip("0")
+        if not g:
+            break
+        groups.append(g)
+    return ":".join(groups) + ":" if groups else ""
+
+
+def prefix_is_exact(net) -> bool:
+    """Любой адрес с текстовым префиксом text_prefix(net) входит в net."""
+    prefix = text_prefix(net)
+    step, sep = (8, ".") if net.version == 4 else (16, ":")
+    return bool(prefix) and net.prefixlen < net.max_prefixlen and step * prefix.count(sep) == net.prefixlen
+
+
+class LanSubnets:
+    """
+    Набор LAN-подсетей IPv4 и IPv6 с поиском по целочисленным диапазонам:
+    адрес → упакованные байты → int, затем bisect по отсортированным
+    началам подсетей своего семейства.
+    """
+
+    def __init__(self, networks):
+        self.networks = sorted(networks, key=lambda n: (n.version, int(n.network_address)))
+        # длина упакованного адреса (4 / 16) → (начала, концы, сети)
+        self.ranges = {}
+        for n in self.networks:
+            starts, ends, nets = self.ranges.setdefault(n.max_prefixlen // 8, ([], [], []))
+            starts.append(int(n.network_address))
+            ends.append(int(n.broadcast_address))
+            nets.append(n)
+
+        # текстовые префиксы — для быстрого отсева строк (и grep на роутере);
+        # точную проверку делает lookup()
+        self.prefixes = sorted({text_prefix(n) for n in self.networks})
+        self.prefixes_b = [p.encode() for p in self.prefixes]
+        # префикс описывает подсеть точно (целые октеты / группы, не /32 и не /128) —
+        # только тогда агент на роутере сам отличит адрес LAN от внешнего
+        self.exact = all(prefix_is_exact(n) for n in self.networks)
+
+    def lookup(self, ip: str):
+        """Подсеть, в которую входит ip, или None."""
+        packed = pack_ip(ip)
+        if packed is None or len(packed) not in self.ranges:
+            return None
+        starts, ends, nets = self.ranges[len(packed)]
+        n = int.from_bytes(packed, "big")
+        i = bisect.bisect_right(starts, n) - 1
+        if i >= 0 and n <= ends[i]:
+            return nets[i]
+        return None
+
+    def __contains__(self, ip: str) -> bool:
+        return self.lookup(ip) is not None
+
+    def maybe(self, raw: bytes) -> bool:
+        """Быстрый отсев: в строке есть хотя бы один префикс LAN."""
+        for p in self.prefixes_b:
+            if p in raw:
+                return True
+        return False
+
+    def __str__(self):
+        return ",".join(str(n) for n in self.networks)
+
+
+def parse_subnets(spec: str) -> LanSubnets:
+    nets = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "/" not in part and ":" not in part:
+            # старый формат: префикс "192.168.1." → 192.168.1.0/24
+            octets = [o for o in part.split(".") if o]
+            part = ".".join(octets + ["0"] * (4 - len(octets))) + f"/{8 * len(octets)}"
+        nets.append(ipaddress.ip_network(part, strict=False))
+    return LanSubnets(nets)
+
+
+DEFAULT_LAN = parse_subnets(TRAFFIC_LAN_SUBNET)
+
+
+def parse_flow_line(line: str, lan: LanSubnets = None):
+    """
+    Разбирает одну строку `conntrack -L -o extended,id`:
+
+        ipv4 2 tcp 6 431999 ESTABLISHED src=192.168.1.50 dst=1.2.3.4
+        sport=51234 dport=443 packets=10 bytes=1234 src=1.2.3.4
+        dst=203.0.113.5 sport=443 dport=51234 packets=12 bytes=5678
+        [ASSURED] mark=0 use=1 id=3735928559
+
+    Строки IPv6 ("ipv6 10 tcp 6 ... src=2001:db8::50 ...") разбираются так же.
+    Первая группа src/dst/bytes — прямое направление, вторая — ответ.
+    Возвращает (flow_key, lan_ip, rx, tx) или None.
+    """
+    m = CT_LINE_RE.match(line)
+    if not m:
+        return None
+    proto, src, dst, sport, dport, orig_bytes, reply_src, reply_bytes = m.groups()
+    lan = lan or DEFAULT_LAN
+
+    if src in lan:
+        # соединение изнутри LAN: прямое направление — исходящий трафик
+        ip, rx, tx = src, int(reply_bytes), int(orig_bytes)
+    elif dst in lan:
+        ip, rx, tx = dst, int(orig_bytes), int(reply_bytes)
+    elif reply_src in lan:
+        # проброс порта (DNAT): LAN-адрес виден только в ответе
+        ip, rx, tx = reply_src, int(orig_bytes), int(reply_bytes)
+    else:
+        return None
+
+    # id conntrack-записи всегда последний (у ICMP в кортеже есть свой id=)
+    pos = line.rfind(" id=")
+    flow_id = line[pos + 4:].split(None, 1)[0] if pos >= 0 else ""
+
+    key = "|".join((flow_id, proto, src, sport or "", dst, dport or ""))
+    return key, ip, rx, tx
+
+
+# Компактный вывод агента router/wolbot-ct.sh: заголовок, затем
+# "<flow_key> <lan_ip> <rx> <tx>" на каждую строку
+AGENT_HEADER = b"WOLBOT-CT 1"
+
+
+def parse_agent_line(raw: bytes, lan: LanSubnets = None):
+    parts = raw.split()
+    if len(parts) != 4:
+        return None
+    ip = parts[1].decode()
+    # агент сверяет только префиксы октетов — подсеть проверяем точно
+    if ip not in (lan or DEFAULT_LAN):
+        return None
+    return parts[0].decode(), ip, int(parts[2]), int(parts[3])
+
+
+class ConntrackTotals:
+    """
+    Потоковый снимок: сумма накопленных счётчиков по устройствам.
+    Память — O(устройств), строки после разбора не хранятся.
+    """
+
+    def __init__(self, lan: LanSubnets = None):
+        self.lan = lan or DEFAULT_LAN
+        self.result: Dict[str, Dict[str, int]] = {}
+        self.agent = False
+
+    def add(self, ip: str, rx: int, tx: int):
+        d = self.result.get(ip)
+        if d is None:
+            d = self.result[ip] = {"in": 0, "out": 0}
+        d["in"] += rx
+        d["out"] += tx
+
+    def feed_line(self, raw: bytes):
+        if self.agent:
+            parsed = parse_agent_line(raw, self.lan)
+        elif raw.startswith(AGENT_HEADER):
+            self.agent = True
+            return
+        elif not self.lan.maybe(raw):
+            return
+        else:
+            parsed = parse_flow_line(raw.decode("ascii", "ignore"), self.lan)
+        if parsed:
+            self.add(*parsed[1:])
+
 
-def parse_conntrack(output: str) -> Dict[str, Dict[str, int]]:
+def parse_flows(output: str, lan: LanSubnets = None) -> Dict[str, tuple]:
     """
+    Возвращает текущие счётчики каждого flow:
+    {
+        "12345|tcp|192.168.1.50|51234|1.2.3.4|443": ("192.168.1.50", rx, tx),
+        ...
+    }
+    """
+    flows = {}
+    for line in output.splitlines():
+        parsed = parse_flow_line(line, lan)
+        if parsed:
+            key, ip, rx, tx = parsed
+            flows[key] = (ip, rx, tx)
+    return flows
+
+
+def parse_conntrack(output: str, lan: LanSubnets = None) -> Dict[str, Dict[str, int]]:
+    """
+    Снимок: сумма накопленных счётчиков всех живых flow.
     Возвращает:
     {
         "192.168.1.50": {"in": 12345, "out": 54321},
         ...
     }
     """
-    result = {}
+    totals = ConntrackTotals(lan)
+    for line in output.splitlines():
+        parsed = parse_flow_line(line, totals.lan)
+        if parsed:
+            totals.add(*parsed[1:])
+    return totals.result
+
+
+def flow_delta(prev, rx: int, tx: int) -> Tuple[int, int]:
+    """Прирост flow относительно последнего учтённого значения (ip, rx, tx)."""
+    if prev is None:
+        # новый flow — всё, что он успел накопить
+        return rx, tx
+    # счётчик уменьшился → тот же ключ, но новое соединение
+    return (
+        rx - prev[1] if rx >= prev[1] else rx,
+        tx - prev[2] if tx >= prev[2] else tx,
+    )
+
+
+def add_delta(deltas: Dict[str, Dict[str, int]], ip: str, d_rx: int, d_tx: int):
+    if d_rx or d_tx:
+        d = deltas.get(ip)
+        if d is None:
+            d = deltas[ip] = {"in": 0, "out": 0}
+        d["in"] += d_rx
+        d["out"] += d_tx
+
+
+class FlowSample:
+    """
+    Один опрос conntrack, разбираемый на лету.
+    Прирост по устройствам считается сразу при получении строки,
+    сравнением с предыдущим состоянием трекера.
+    """
+
+    def __init__(self, tracker: "FlowTracker"):
+        self.tracker = tracker
+        self.prev = tracker.flows
+        self.flows: Dict[str, tuple] = {}
+        self.deltas: Dict[str, Dict[str, int]] = {}
+        # flow, завершившиеся (DESTROY) во время опроса — уже учтены событиями
+        self.settled = set()
+        self.agent = False
+
+    def add(self, key: str, ip: str, rx: int, tx: int):
+        with self.tracker.lock:
+            if key in self.settled:
+                return
+            d_rx, d_tx = flow_delta(self.prev.get(key), rx, tx)
+            self.flows[key] = (ip, rx, tx)
+        add_delta(self.deltas, ip, d_rx, d_tx)
+
+    def feed_line(self, raw: bytes):
+        lan = self.tracker.lan
+        if self.agent:
+            parsed = parse_agent_line(raw, lan)
+        elif raw.startswith(AGENT_HEADER):
+            # на роутере установлен агент — дальше компактный формат
+            self.agent = True
+            return
+        elif not lan.maybe(raw):
+            return
+        else:
+            parsed = parse_flow_line(raw.decode("ascii", "ignore"), lan)
+        if parsed:
+            self.add(*parsed)
+
+
+class FlowTracker:
+    """
+    Хранит последние увиденные счётчики каждого flow и считает дельты.
+
+    conntrack отдаёт накопленные с начала соединения байты, поэтому
+    в БД пишем только прирост с прошлого опроса. Завершившиеся flow
+    досчитываются по финальным счётчикам из событий DESTROY (settle),
+    а без событий — учтены до последнего увиденного значения.
+    """
+
+    def __init__(self, lan: LanSubnets = None):
+        self.lan = lan or DEFAULT_LAN
+        self.flows: Dict[str, tuple] = {}
+        # опрос и поток событий работают в разных потоках
+        self.lock = threading.Lock()
+        self.current = None
+        # состояние flow, как оно лежит в conntrack_flows: в БД пишется только разница
+        self.saved: Dict[str, tuple] = {}
+
+    def begin(self) -> FlowSample:
+        sample = FlowSample(self)
+        with self.lock:
+            self.current = sample
+        return sample
+
+    def freeze(self, sample: FlowSample) -> Dict[str, tuple]:
+        """
+        Копия снимка для записи в БД: поток событий (settle) меняет
+        sample.flows, пока снимок не закоммичен, в том числе во время записи.
+        """
+        with self.lock:
+            return dict(sample.flows)
+
+    def commit(self, sample: FlowSample) -> Dict[str, Dict[str, int]]:
+        """Новый снимок становится текущим состоянием; возвращает прирост по устройствам."""
+        with self.lock:
+            self.flows = sample.flows
+            if self.current is sample:
+                self.current = None
+        return sample.deltas
+
+    def abort(self, sample: FlowSample):
+        with self.lock:
+            if self.current is sample:
+                self.current = None
+
+    def settle(self, key: str, ip: str, rx: int, tx: int) -> Tuple[int, int]:
+        """Flow завершился: прирост от последнего учтённого значения до финального."""
+        with self.lock:
+            base = self.flows.pop(key, None)
+            sample = self.current
+            if sample is not None:
+                # опрос уже успел учесть этот flow до значения seen
+                seen = sample.flows.pop(key, None)
+                if seen is not None:
+                    base = seen
+                sample.settled.add(key)
+        return flow_delta(base, rx, tx)
+
+    def update(self, flows: Dict[str, tuple]) -> Dict[str, Dict[str, int]]:
+        sample = self.begin()
+        for key, (ip, rx, tx) in flows.items():
+            sample.add(key, ip, rx, tx)
+        return self.commit(sample)
+
+    async def load(self, router: str):
+        self.flows = await load_flow_state(router)
+        self.saved = dict(self.flows)
+
+
+class ConntrackEvents:
+    """
+    Долгоживущий канал `conntrack -E -e DESTROY` к роутеру.
+
+    Каждое завершённое соединение досчитывается по финальным счётчикам
+    (FlowTracker.settle), прирост копится в памяти по устройствам
+    и раз в TRAFFIC_EVENTS_FLUSH_INTERVAL записывается в БД.
+    Так учитываются и короткие соединения, прожившие меньше интервала опроса.
+    Работает в отдельном потоке, после обрыва (перезагрузка роутера)
+    переподключается сам.
+    """
+
+    def __init__(self, router: "Router"):
+        self.router = router
+        self.tracker = router.tracker
+        self.pending: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self._stop = threading.Event()
+        self._chan = None
+        self._thread = None
+        self._agent = False
+
+    def command(self) -> str:
+        return self.router.command("conntrack -E -e DESTROY -o extended,id", "events")
+
+    def on_line(self, raw: bytes):
+        lan = self.tracker.lan
+        if self._agent:
+            parsed = parse_agent_line(raw, lan)
+        elif raw.startswith(AGENT_HEADER):
+            self._agent = True
+            return
+        elif not lan.maybe(raw):
+            return
+        else:
+            # "[DESTROY] ipv4 2 tcp 6 src=..." — без метки события это обычная строка
+            line = raw.decode("ascii", "ignore").lstrip()
+            if line.startswith("["):
+                line = line.split("]", 1)[1].lstrip()
+            parsed = parse_flow_line(line, lan)
+        if not parsed:
+            return
+
+        key, ip, rx, tx = parsed
+        d_rx, d_tx = self.tracker.settle(key, ip, rx, tx)
+        with self.lock:
+            self.events += 1
+            add_delta(self.pending, ip, d_rx, d_tx)
+
+    def take(self) -> Dict[str, Dict[str, int]]:
+        """Забрать накопленный прирост (для записи в БД)."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def _session(self):
+        """Один сеанс: открыть канал и читать события, пока он жив."""
+        r = self.router
+        chan = SSH_POOL.open_channel(r.host, r.user, r.key, self.command(), SSH_CONNECT_TIMEOUT)
+        self._chan = chan
+        self._agent = False
+        self.connected = True
+        # тишина в канале — не ошибка; жив ли transport, проверяем по таймауту
+        chan.settimeout(max(SSH_KEEPALIVE_INTERVAL, 5))
+        splitter = LineSplitter(self.on_line)
+        try:
+            while not self._stop.is_set():
+                try:
+                    data = chan.recv(SSH_STREAM_CHUNK)
+                except socket.timeout:
+                    if not chan.get_transport().is_active():
+                        return
+                    continue
+                if not data:
+                    return
+                splitter.feed(data)
+        finally:
+            self.connected = False
+            self._chan = None
+            chan.close()
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._session()
+            except Exception as e:
+                if not self._stop.is_set():
+                    print(f"Ошибка потока событий conntrack ({self.router.name}):", scrub(str(e)))
+            if self._stop.is_set():
+                break
+            # канал жил долго — начинаем ожидание заново
+            if time.monotonic() - started > 60:
+                backoff = 1
+            self.reconnects += 1
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"conntrack-events-{self.router.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        chan = self._chan
+        if chan is not None:
+            chan.close()
+
+
+# Таблица соседей (ARP / NDP) и аренды dnsmasq; без `ip` — /proc/net/arp
+NEIGHBOR_COMMAND = "ip neigh show 2>/dev/null || cat /proc/net/arp; cat /tmp/dhcp.leases 2>/dev/null; true"
+MAC_RE = re.compile(r"^[0-9a-f]{2}(?::[0-9a-f]{2}){5}$")
+# сколько помнить MAC адреса, пропавшего из таблицы соседей
+NEIGHBOR_KEEP = 86400
+
+
+def parse_neighbors(output: str) -> Dict[bytes, tuple]:
+    """
+    Упакованный адрес → (mac, hostname) из вывода NEIGHBOR_COMMAND:
 
+        192.168.1.50 dev br-lan lladdr aa:bb:cc:dd:ee:ff REACHABLE
+        2001:db8::50 dev br-lan lladdr aa:bb:cc:dd:ee:ff STALE
+        192.168.1.50 0x1 0x2 aa:bb:cc:dd:ee:ff * br-lan
+        1700000000 aa:bb:cc:dd:ee:ff 192.168.1.50 laptop 01:aa:bb:cc:dd:ee:ff
+    """
+    macs = {}
+    names = {}
     for line in output.splitlines():
-        if TRAFFIC_LAN_SUBNET not in line:
+        f = line.split()
+        if "lladdr" in f[:-1]:
+            ip, mac = f[0], f[f.index("lladdr") + 1]
+        elif len(f) == 6 and f[1].startswith("0x"):
+            ip, mac = f[0], f[3]
+        elif len(f) >= 4 and f[0].isdigit():
+            ip, mac = f[2], f[1]
+            if f[3] != "*":
+                names[mac.lower()] = f[3]
+        else:
             continue
-
-        m_bytes = RE_BYTES.search(line)
-        if not m_bytes:
+        mac = mac.lower()
+        packed = pack_ip(ip)
+        if packed is None or not MAC_RE.match(mac) or mac == "00:00:00:00:00:00":
             continue
+        macs[packed] = mac
+    return {packed: (mac, names.get(mac)) for packed, mac in macs.items()}
 
-        size = int(m_bytes.group(1))
 
-        m_src = RE_SRC.search(line)
-        m_dst = RE_DST.search(line)
+class NeighborCache:
+    """
+    IP → MAC одного роутера. Таблица запрашивается не чаще раза за цикл:
+    когда истёк TRAFFIC_NEIGHBOR_TTL или встретился незнакомый адрес.
+    Адреса, которых роутер не знает, запоминаются до следующего обновления,
+    чтобы не спрашивать о них каждый цикл.
+    """
 
-        # если src = LAN → исходящий трафик
-        if m_src:
-            ip = m_src.group(1)
-            if ip.startswith(TRAFFIC_LAN_SUBNET):
-                result.setdefault(ip, {"in": 0, "out": 0})
-                result[ip]["out"] += size
+    def __init__(self, router: "Router"):
+        self.router = router
+        # упакованный адрес → (mac, hostname, когда видели) или None
+        self.table: Dict[bytes, tuple] = {}
+        self.fetched = None
+        self.refreshes = 0
+
+    def get(self, ip: str) -> Tuple[str, str]:
+        """(mac, hostname) адреса или (None, None)."""
+        entry = self.table.get(pack_ip(ip))
+        return (entry[0], entry[1]) if entry else (None, None)
+
+    async def refresh(self, ips):
+        if not TRAFFIC_NEIGHBOR_TTL:
+            return
+        now = time.monotonic()
+        unknown = [p for p in map(pack_ip, ips) if p is not None and p not in self.table]
+        if not unknown and self.fetched is not None and now - self.fetched < TRAFFIC_NEIGHBOR_TTL:
+            return
+
+        r = self.router
+        ok, out = await run_ssh(r.host, r.user, r.key, NEIGHBOR_COMMAND, COLLECT_EXECUTOR)
+        if not ok:
+            print(f"Ошибка чтения таблицы соседей ({r.name}):", scrub(out))
+            return
+
+        # MAC, пропавший из таблицы соседей, помним ещё NEIGHBOR_KEEP секунд:
+        # долгое соединение не должно «переехать» на устройство по IP
+        table = {
+            p: e for p, e in self.table.items()
+            if e is not None and now - e[2] < NEIGHBOR_KEEP
+        }
+        for p, (mac, host) in parse_neighbors(out).items():
+            table[p] = (mac, host, now)
+        for p in unknown:
+            table.setdefault(p, None)
+        self.table = table
+        self.fetched = now
+        self.refreshes += 1
+
+    def size(self) -> int:
+        return sum(1 for e in self.table.values() if e is not None)
+
+
+class Router:
+    """
+    Роутер (или точка доступа), с которого снимаем conntrack:
+    свой SSH-доступ, свои подсети LAN, своё состояние flow и поток событий.
+    """
+
+    def __init__(self, name: str, host: str, user: str, key: str, lan: LanSubnets, grep: str = ""):
+        self.name = name
+        self.host = host
+        self.user = user
+        self.key = key
+        self.lan = lan
+        self.grep = grep
+        self.tracker = FlowTracker(lan)
+        self.events = ConntrackEvents(self)
+        self.neighbors = NeighborCache(self)
+        # режим последнего сбора ("agent" / "dump"), число flow, время и ошибки
+        self.stats = {
+            "mode": None,
+            "flows": 0,
+            "last_ms": None,
+            "ok": 0,
+            "failures": 0,
+            "last_error": None,
+        }
+        # неудачных опросов подряд и сколько плановых опросов пропустить
+        self.fail_streak = 0
+        self.skip = 0
+
+    def failed(self, error: str):
+        """
+        Опрос не удался. Каждая следующая неудача подряд удваивает паузу:
+        пропускаем 0, 1, 3, 7... плановых опросов, не дольше TRAFFIC_BACKOFF_MAX.
+        """
+        self.stats["failures"] += 1
+        self.stats["last_error"] = error
+        self.fail_streak += 1
+        max_skip = max(TRAFFIC_BACKOFF_MAX // max(TRAFFIC_COLLECTION_INTERVAL, 1) - 1, 0)
+        self.skip = min(2 ** (self.fail_streak - 1) - 1, max_skip)
+
+    def command(self, fallback: str, agent_args: str = "") -> str:
+        """
+        Агент wolbot-ct, если он есть на роутере (TRAFFIC_AGENT_MODE=auto),
+        иначе fallback. Проверка и выбор — в одной SSH-команде.
+        """
+        # агент выбирает сторону LAN по текстовому префиксу: для /20, /12 или
+        # подсети шире /8 он взял бы чужой адрес — такие разбирает только бот
+        if TRAFFIC_AGENT_MODE == "off" or not self.lan.exact:
+            return fallback
+        args = f"{agent_args} " if agent_args else ""
+        prefixes = ",".join(self.lan.prefixes)
+        return (
+            f"if command -v {TRAFFIC_AGENT_COMMAND} >/dev/null 2>&1; "
+            f"then {TRAFFIC_AGENT_COMMAND} {args}'{prefixes}'; "
+            f"else {fallback}; fi"
+        )
+
+    def dump_command(self) -> str:
+        if self.grep:
+            grep = f"grep '{self.grep}'"
+        elif "" in self.lan.prefixes:
+            # подсеть шире /8 — отсеивать на роутере нечем
+            grep = "cat"
+        else:
+            grep = "grep -F " + " ".join(f"-e '{p}'" for p in self.lan.prefixes)
+        return self.command(f"conntrack -L -o extended,id | {grep} || true")
+
+
+def parse_routers(spec: str) -> List[Router]:
+    """
+    ROUTERS="name=user@host:key:cidr,cidr; name2=..."
+    Путь к ключу не содержит ":", поэтому всё после него — подсети,
+    в том числе IPv6 ("2001:db8::/64"). IPv6-адрес роутера — в скобках:
+    "name=root@[fd00::1]:key:cidr".
+    Без ROUTERS — один роутер из ROUTER_IP / ROUTER_SSH_USER / ROUTER_SSH_KEY.
+    """
+    if not spec.strip():
+        return [Router(DEFAULT_ROUTER, ROUTER_IP, ROUTER_SSH_USER, ROUTER_SSH_KEY,
+                       DEFAULT_LAN, TRAFFIC_GREP_PATTERN)]
+
+    routers = []
+    for item in spec.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, target = item.partition("=")
+        user, _, target = target.rpartition("@")
+        if target.startswith("["):
+            host, _, rest = target[1:].partition("]")
+            rest = rest[1:]
+        else:
+            host, _, rest = target.partition(":")
+        key, _, subnets = rest.partition(":")
+        routers.append(Router(
+            name.strip(),
+            host.strip(),
+            user.strip() or ROUTER_SSH_USER,
+            key.strip() or ROUTER_SSH_KEY,
+            parse_subnets(subnets) if subnets.strip() else DEFAULT_LAN,
+        ))
+    return routers
+
+
+ROUTERS = parse_routers(ROUTERS_CONFIG)
+
+
+async def flush_events(context):
+    """Записать прирост от завершившихся соединений (по таймеру)."""
+    for router in ROUTERS:
+        deltas = router.events.take()
+        if not deltas:
+            continue
+        await router.neighbors.refresh(deltas)
+        await save_cycle(router, deltas)
+        REPORT_CACHE.invalidate_open()
 
-        # если dst = LAN → входящий трафик
-        if m_dst:
-            ip = m_dst.group(1)
-            if ip.startswith(TRAFFIC_LAN_SUBNET):
-                result.setdefault(ip, {"in": 0, "out": 0})
-                result[ip]["in"] += size
 
-    return result
 # ---------------------------------------------------------------------
 # Задача: собрать трафик через conntrack
 # ---------------------------------------------------------------------
 
-async def collect_conntrack(context):
+async def collect_router(router: Router) -> int:
     """
-    Запускается каждые TRAFFIC_COLLECTION_INTERVAL секунд.
-    На роутере выполняем:
+    Один опрос одного роутера. На роутере выполняем:
 
-        conntrack -L -o extended | grep "192.168.1."
+        conntrack -L -o extended,id | grep -F -e "192.168.1."
 
-    Потом парсим и записываем трафик в БД.
+    (или компактный вывод агента wolbot-ct, если он установлен).
+    Потом парсим и записываем в БД прирост трафика с прошлого опроса.
+    Возвращает число устройств с приростом.
     """
 
-    cmd = f"conntrack -L -o extended | grep '{TRAFFIC_GREP_PATTERN}' || true"
+    tracker = router.tracker
+    stats = router.stats
+    started = time.monotonic()
 
-    ok, out = await run_ssh(
-        ROUTER_IP,
-        ROUTER_SSH_USER,
-        ROUTER_SSH_KEY,
-        cmd
-    )
+    # вывод разбирается построчно прямо по мере чтения из канала
+    sample = tracker.begin()
+    abort = threading.Event()
+    try:
+        ok, err = await asyncio.wait_for(
+            run_ssh_lines(
+                router.host, router.user, router.key, router.dump_command(), sample.feed_line,
+                executor=COLLECT_EXECUTOR, abort=abort, timeout=TRAFFIC_ROUTER_TIMEOUT
+            ),
+            TRAFFIC_ROUTER_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        ok, err = False, f"нет ответа за {TRAFFIC_ROUTER_TIMEOUT} с"
+    finally:
+        # опрос отменён или не уложился в срок — поток бросит чтение
+        # с ближайшим куском вывода и вернётся в пул
+        abort.set()
 
+    labels = (("router", router.name),)
+    METRICS.observe("wolbot_collect_router_seconds", time.monotonic() - started, labels)
     if not ok:
-        print("Ошибка conntrack:", scrub(out))
-        return
+        tracker.abort(sample)
+        router.failed(scrub(err))
+        METRICS.inc("wolbot_collect_total", labels=labels + (("result", "error"),))
+        print(f"Ошибка conntrack ({router.name}):", scrub(err))
+        return 0
+
+    router.fail_streak = 0
+    router.skip = 0
+    METRICS.inc("wolbot_collect_total", labels=labels + (("result", "ok"),))
+    METRICS.set("wolbot_collect_flows", len(sample.flows), labels)
+    mode = "agent" if sample.agent else "dump"
+    if stats["mode"] != mode:
+        print(f"Сбор трафика ({router.name}):", "агент на роутере" if sample.agent else "полный дамп conntrack")
+    stats.update(
+        mode=mode,
+        flows=len(sample.flows),
+        last_ms=round((time.monotonic() - started) * 1000),
+        ok=stats["ok"] + 1,
+        last_error=None,
+    )
 
-    parsed = parse_conntrack(out)
-    if not parsed:
-        return
+    # снимок получен — запись доводим до конца, даже если срок прогона истёк
+    return await asyncio.shield(save_sample(router, sample))
 
-    for ip, values in parsed.items():
-        await add_device(ip)
-        await save_sample(ip, values["in"], values["out"])
 
-    await cleanup_old()
+async def save_sample(router: Router, sample: FlowSample) -> int:
+    """
+    Запись снимка; новые счётчики становятся базой только после успешной
+    записи — иначе база прежняя и следующий опрос посчитает этот прирост заново.
+    """
+    tracker = router.tracker
+    flows = tracker.freeze(sample)
+    try:
+        await router.neighbors.refresh({ip for ip, _, _ in flows.values()})
+        await save_cycle(router, sample.deltas, flows, tracker.saved)
+    except BaseException:
+        tracker.abort(sample)
+        raise
+    tracker.saved = flows
+    return len(tracker.commit(sample))
+
+
+async def collect_conntrack(routers: List[Router]) -> int:
+    """
+    Один прогон сбора. Роутеры опрашиваются параллельно (не больше
+    TRAFFIC_MAX_PARALLEL одновременно): медленный или недоступный роутер
+    не задерживает и не роняет сбор с остальных.
+    Возвращает число записанных устройств.
+    """
+    sem = asyncio.Semaphore(max(TRAFFIC_MAX_PARALLEL, 1))
+
+    async def one(router: Router) -> int:
+        async with sem:
+            try:
+                return await collect_router(router)
+            except asyncio.CancelledError:
+                # срок всего прогона истёк, пока этот роутер не ответил
+                router.failed(f"прогон прерван через {TRAFFIC_RUN_DEADLINE} с")
+                raise
+            except Exception as e:
+                router.failed(scrub(str(e)))
+                print(f"Ошибка сбора трафика ({router.name}):", scrub(str(e)))
+                return 0
+
+    written = sum(await asyncio.gather(*(one(r) for r in routers)))
+    if written:
+        REPORT_CACHE.invalidate_open()
+
+    # очистка — раз в сутки по расписанию или раньше, если строк накопилось много
+    RETENTION["pending_rows"] += written
+    if RETENTION["pending_rows"] >= TRAFFIC_PRUNE_THRESHOLD and not _RETENTION_LOCK.locked():
+        spawn(cleanup_old())
+    return written
+
+
+class Collector:
+    """
+    Планировщик сбора трафика.
+
+    Одновременно идёт не больше одного прогона: плановый запуск во время
+    идущего пропускается, а ручное «🔄 Обновить» присоединяется к нему
+    и ждёт его результата. Прогон ограничен TRAFFIC_RUN_DEADLINE.
+    Недоступные роутеры плановые прогоны обходят с растущей паузой
+    (Router.failed), ручное обновление опрашивает все.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.counters = {
+            "runs": 0,
+            "coalesced": 0,
+            "skipped": 0,
+            "timeouts": 0,
+        }
+        self.last_ms = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def _run(self, routers: List[Router]):
+        started = time.monotonic()
+        self.counters["runs"] += 1
+        try:
+            await asyncio.wait_for(collect_conntrack(routers), TRAFFIC_RUN_DEADLINE)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            print(f"Сбор трафика не уложился в {TRAFFIC_RUN_DEADLINE} с и прерван")
+        finally:
+            self.last_ms = round((time.monotonic() - started) * 1000)
+            METRICS.observe("wolbot_collect_seconds", time.monotonic() - started)
+
+    async def refresh(self):
+        """Ручное обновление: новый прогон или ожидание уже идущего."""
+        if self.running:
+            self.counters["coalesced"] += 1
+        else:
+            self.task = spawn(self._run(ROUTERS))
+        # отмена ожидающего (ушёл пользователь) не прерывает сам прогон
+        await asyncio.shield(self.task)
+
+    async def tick(self, context):
+        """Плановый запуск из JobQueue; сам прогон идёт в фоне."""
+        if self.running:
+            self.counters["skipped"] += 1
+            return
+
+        routers = []
+        for router in ROUTERS:
+            if router.skip > 0:
+                router.skip -= 1
+                continue
+            routers.append(router)
+        if routers:
+            self.task = spawn(self._run(routers))
+
+
+COLLECTOR = Collector()
 
 
 # ---------------------------------------------------------------------
 # Функции агрегирования статистики
 # ---------------------------------------------------------------------
 
+@METRICS.timed("wolbot_query_seconds", query="today_per_device")
 async def today_per_device() -> List[tuple]:
+    today = bucket_start(int(time.time()), 86400)
     q = """
-    SELECT device_ip, SUM(rx_bytes + tx_bytes)
-    FROM traffic_stats
-    WHERE date(collected_at) = date('now')
-    GROUP BY device_ip
-    ORDER BY SUM(rx_bytes + tx_bytes) DESC
-    """
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        rows = await db.execute(q)
-        rows = await rows.fetchall()
+    SELECT d.ip, r.rx_bytes + r.tx_bytes
+    FROM traffic_daily r JOIN devices d ON d.id = r.device_id
+    WHERE r.day >= ? AND r.day < ?
+    ORDER BY 2 DESC
+    """
+    rows = await DB.fetchall(q, (today, today + 86400))
     return [(ip, s or 0) for ip, s in rows]
 
 
+@METRICS.timed("wolbot_query_seconds", query="yesterday_total")
 async def yesterday_total() -> int:
-    q = "SELECT SUM(rx_bytes + tx_bytes) FROM traffic_stats WHERE date(collected_at)=date('now','-1 day')"
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        r = await db.execute(q)
-        r = await r.fetchone()
+    today = bucket_start(int(time.time()), 86400)
+    q = "SELECT SUM(rx_bytes + tx_bytes) FROM traffic_daily WHERE day >= ? AND day < ?"
+    r = await DB.fetchone(q, (today - 86400, today))
     return r[0] or 0
 
 
+@METRICS.timed("wolbot_query_seconds", query="month_total")
 async def month_total(year, month) -> int:
-    ym = f"{year:04d}-{month:02d}"
-    q = """
-    SELECT SUM(rx_bytes + tx_bytes)
-    FROM traffic_stats
-    WHERE strftime('%Y-%m', collected_at)=?
-    """
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        r = await db.execute(q, (ym,))
-        r = await r.fetchone()
+    q = "SELECT SUM(rx_bytes + tx_bytes) FROM traffic_monthly WHERE month >= ? AND month < ?"
+    r = await DB.fetchone(q, (month_start(year, month), next_month_start(year, month)))
     return r[0] or 0
 
 
-async def month_per_device(year, month) -> dict:
-    ym = f"{year:04d}-{month:02d}"
+@METRICS.timed("wolbot_query_seconds", query="month_per_device")
+async def month_per_device(year, month) -> List[tuple]:
     q = """
-    SELECT device_ip, SUM(rx_bytes + tx_bytes)
-    FROM traffic_stats
-    WHERE strftime('%Y-%m', collected_at)=?
-    GROUP BY device_ip
-    ORDER BY SUM(rx_bytes + tx_bytes) DESC
+    SELECT d.ip, r.rx_bytes + r.tx_bytes
+    FROM traffic_monthly r JOIN devices d ON d.id = r.device_id
+    WHERE r.month >= ? AND r.month < ?
+    ORDER BY 2 DESC
     """
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        r = await db.execute(q, (ym,))
-        rows = await r.fetchall()
-    return {ip: s or 0 for ip, s in rows}
+    rows = await DB.fetchall(q, (month_start(year, month), next_month_start(year, month)))
+    return [(ip, s or 0) for ip, s in rows]
 
 
+@METRICS.timed("wolbot_query_seconds", query="year_total")
 async def year_total() -> int:
-    q = """
-    SELECT SUM(rx_bytes + tx_bytes)
-    FROM traffic_stats
-    WHERE strftime('%Y', collected_at)=strftime('%Y','now')
-    """
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        r = await db.execute(q)
-        r = await r.fetchone()
+    year = datetime.utcnow().year
+    q = "SELECT SUM(rx_bytes + tx_bytes) FROM traffic_monthly WHERE month >= ? AND month < ?"
+    r = await DB.fetchone(q, (month_start(year, 1), month_start(year + 1, 1)))
     return r[0] or 0
 
 
+@METRICS.timed("wolbot_query_seconds", query="device_traffic")
+async def device_traffic(device_id: int) -> Dict[str, tuple]:
+    """
+    (rx, tx) одного устройства за сегодня, вчера, месяц, год и всё время
+    хранения — два запроса по индексам (device_id, day / month).
+    """
+    today = bucket_start(int(time.time()), 86400)
+    now = datetime.utcnow()
+    month, year = month_start(now.year, now.month), month_start(now.year, 1)
+
+    d = await DB.fetchone("""
+        SELECT SUM(CASE WHEN day >= ?1 THEN rx_bytes END), SUM(CASE WHEN day >= ?1 THEN tx_bytes END),
+               SUM(CASE WHEN day < ?1 THEN rx_bytes END), SUM(CASE WHEN day < ?1 THEN tx_bytes END)
+        FROM traffic_daily WHERE device_id = ?2 AND day >= ?3
+    """, (today, device_id, today - 86400))
+    m = await DB.fetchone("""
+        SELECT SUM(CASE WHEN month >= ?1 THEN rx_bytes END), SUM(CASE WHEN month >= ?1 THEN tx_bytes END),
+               SUM(CASE WHEN month >= ?2 THEN rx_bytes END), SUM(CASE WHEN month >= ?2 THEN tx_bytes END),
+               SUM(rx_bytes), SUM(tx_bytes)
+        FROM traffic_monthly WHERE device_id = ?3
+    """, (month, year, device_id))
+    d = [x or 0 for x in d]
+    m = [x or 0 for x in m]
+    return {
+        "today": (d[0], d[1]),
+        "yesterday": (d[2], d[3]),
+        "month": (m[0], m[1]),
+        "year": (m[2], m[3]),
+        "total": (m[4], m[5]),
+    }
+
+
 # ---------------------------------------------------------------------
 # Форматирование объёма данных
 # ---------------------------------------------------------------------
@@ -377,8 +2876,9 @@ def fmt(x: int) -> str:
 MAIN_KB = ReplyKeyboardMarkup(
     [
         ["🖥 Включить сервер", "⏹ Выключить сервер"],
-        ["🔄 Перезагрузить роутер"],
-        ["📊 Трафик"],
+        # без ROUTER_IP / ROUTERS перезагружать нечего — кнопку не показываем
+        *([["🔄 Перезагрузить роутер"]] if any(r.host for r in ROUTERS) else []),
+        ["📊 Трафик", "⚡ Сейчас"],
         ["📋 Устройства", "📜 Логи"]
     ],
     resize_keyboard=True
@@ -396,6 +2896,10 @@ def kb_traffic(offset):
     if offset < 0:
         buttons[0].append(InlineKeyboardButton("➡ Вперёд", callback_data=f"traffic_prev:{offset+1}"))
 
+    buttons.append([
+        InlineKeyboardButton("📈 По дням", callback_data=f"traffic_graph:{offset}:d"),
+        InlineKeyboardButton("📈 По часам", callback_data=f"traffic_graph:{offset}:h"),
+    ])
     buttons.append([
         InlineKeyboardButton("🔄 Обновить", callback_data=f"traffic_refresh:{offset}"),
         InlineKeyboardButton("🧹 Очистить", callback_data=f"traffic_clear:confirm"),
@@ -409,104 +2913,671 @@ def kb_traffic(offset):
 # Автоудаление старых сообщений
 # ---------------------------------------------------------------------
 
-async def record(context: ContextTypes.DEFAULT_TYPE, message):
+async def record(context: ContextTypes.DEFAULT_TYPE, *messages):
     """
     Храним ID последних N сообщений.
-    Всё старше — удаляется.
+    Всё старше — удаляется одним запросом delete_messages (до 100 за раз).
     """
     hist = context.chat_data.setdefault("hist", [])
-    hist.append(message.message_id)
+    hist.extend(m.message_id for m in messages)
 
     if len(hist) > KEEP_CHAT_MESSAGES:
         old = hist[:-KEEP_CHAT_MESSAGES]
-        for mid in old:
-            try:
-                await context.bot.delete_message(message.chat_id, mid)
-            except:
-                pass
         context.chat_data["hist"] = hist[-KEEP_CHAT_MESSAGES:]
+        chat_id = messages[0].chat_id
+        for i in range(0, len(old), 100):
+            try:
+                await context.bot.delete_messages(chat_id, old[i:i + 100])
+            except TelegramError as e:
+                # например, сообщения старше 48 часов Telegram удалить не даёт
+                print("Не удалось удалить старые сообщения:", scrub(str(e)))
+
+
+# ---------------------------------------------------------------------
+# Лог-файл: чтение страницами с конца и ротация
+# ---------------------------------------------------------------------
+
+LOG_BLOCK = 8192
+# сколько символов лога на страницу (лимит сообщения Telegram — 4096)
+LOG_PAGE_CHARS = 3500
+# сколько байт просматривать за страницу в поисках строк под фильтр
+LOG_SCAN_LIMIT = 8 * 1024 * 1024
+
+LOG_LEVELS = {
+    "error": re.compile(r"error|ошибка|traceback|exception|critical", re.IGNORECASE),
+    "warning": re.compile(r"error|ошибка|traceback|exception|critical|warn", re.IGNORECASE),
+}
+
+
+def log_matcher(flt: str):
+    """Фильтр строк лога: уровень ("error" / "warning"), "text:слово" или все строки."""
+    if flt in LOG_LEVELS:
+        return LOG_LEVELS[flt].search
+    if flt.startswith("text:"):
+        word = flt[5:].lower()
+        return lambda line: word in line.lower()
+    return None
+
+
+class LogChain:
+    """
+    Лог вместе с ротированными копиями как один файл для чтения:
+    path.LOG_BACKUPS … path.1, path — от старых строк к новым.
+    Смещения сквозные; размер каждого файла фиксируется при открытии.
+    """
+
+    def __init__(self, path: str):
+        self.parts = []
+        start = 0
+        names = [f"{path}.{i}" for i in range(LOG_BACKUPS, 0, -1)] + [path]
+        try:
+            for name in names:
+                try:
+                    f = open(name, "rb")
+                except FileNotFoundError:
+                    if name == path:
+                        raise
+                    continue
+                size = f.seek(0, os.SEEK_END)
+                self.parts.append((start, size, f))
+                start += size
+        except BaseException:
+            self.close()
+            raise
+        self.size = start
+        self.pos = 0
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        self.pos = self.size + pos if whence == os.SEEK_END else pos
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def read(self, n: int) -> bytes:
+        chunks = []
+        for start, size, f in self.parts:
+            if n <= 0:
+                break
+            if not start <= self.pos < start + size:
+                continue
+            f.seek(self.pos - start)
+            data = f.read(min(n, start + size - self.pos))
+            if not data:
+                break
+            chunks.append(data)
+            self.pos += len(data)
+            n -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        for _, _, f in self.parts:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_log_page(path: str, offset: int, older: bool = True, match=None):
+    """
+    Страница лога, не читая файл целиком: блоками по LOG_BLOCK назад
+    от offset (older) или вперёд от него, пока строки, прошедшие фильтр
+    match, помещаются в LOG_PAGE_CHARS. offset < 0 — конец файла.
+    Ротированные копии (path.1 …) читаются как начало того же лога.
+
+    Границы страницы — байтовые смещения перевода строки между строками
+    (или 0 / размер файла): по ним кнопки листают дальше.
+    Возвращает (строки, начало, конец, размер файла).
+    """
+    with LogChain(path) as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset < 0 or offset > size:
+            # конец файла, либо файл с тех пор ротирован
+            offset = size
+        lines = []
+        used = 0
+
+        def take(raw: bytes) -> bool:
+            """False — страница заполнена, строку не берём."""
+            nonlocal used
+            line = scrub(raw.decode("utf-8", errors="replace").rstrip("\r"))
+            if not line or (match is not None and not match(line)):
+                return True
+            if len(line) > LOG_PAGE_CHARS:
+                line = line[:LOG_PAGE_CHARS - 1] + "…"
+            if lines and used + len(line) + 1 > LOG_PAGE_CHARS:
+                return False
+            lines.append(line)
+            used += len(line) + 1
+            return True
+
+        if older:
+            cursor = pos = offset
+            rest = b""
+            while pos > 0 and offset - cursor < LOG_SCAN_LIMIT:
+                n = min(LOG_BLOCK, pos)
+                pos -= n
+                f.seek(pos)
+                parts = (f.read(n) + rest).split(b"\n")
+                # первая часть может быть хвостом строки из предыдущего блока
+                rest = parts[0] if pos > 0 else b""
+                chunk = parts[1:] if pos > 0 else parts
+                full = False
+                for raw in reversed(chunk):
+                    if not take(raw):
+                        full = True
+                        break
+                    cursor = max(cursor - len(raw) - 1, 0)
+                if full:
+                    break
+            lines.reverse()
+            return lines, cursor, offset, size
+
+        # offset — перевод строки перед первой строкой страницы
+        cursor = offset
+        line_start = offset + 1 if offset > 0 else 0
+        f.seek(line_start)
+        rest = b""
+        while f.tell() < size and cursor - offset < LOG_SCAN_LIMIT:
+            parts = (rest + f.read(LOG_BLOCK)).split(b"\n")
+            # последняя часть — начало строки, которая продолжится в следующем блоке
+            rest = parts.pop() if f.tell() < size else b""
+            full = False
+            for raw in parts:
+                if not take(raw):
+                    full = True
+                    break
+                cursor = line_start + len(raw)
+                line_start = cursor + 1
+            if full:
+                break
+        return lines, offset, cursor, size
+
+
+def rotate_log(path: str = LOG_PATH) -> bool:
+    """
+    Ротация по размеру: path → path.1 → ... → path.LOG_BACKUPS.
+
+    Файл пишет systemd (StandardOutput=append:), который держит его открытым,
+    поэтому не переименовываем, а копируем и обрезаем (copytruncate):
+    запись с O_APPEND продолжается с начала пустого файла.
+    В path.1 уходят только последние LOG_MAX_BYTES — и от старого
+    многомегабайтного лога тоже.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if not LOG_MAX_BYTES or size < LOG_MAX_BYTES:
+        return False
+
+    if LOG_BACKUPS > 0:
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        with open(path, "rb") as src, open(f"{path}.1", "wb") as dst:
+            src.seek(max(size - LOG_MAX_BYTES, 0))
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    with open(path, "r+b") as f:
+        f.truncate(0)
+    return True
+
+
+async def log_rotate_job(context):
+    if await asyncio.to_thread(rotate_log):
+        print(f"Лог ротирован (больше {fmt(LOG_MAX_BYTES)})")
 
 
 # ---------------------------------------------------------------------
 # Команды Telegram
 # ---------------------------------------------------------------------
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_allowed(update.effective_user.id):
-        return await update.message.reply_text("Доступ запрещён.")
+@METRICS.timed("wolbot_handler_seconds", handler="start")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    msg = await update.message.reply_text("Готов к работе!", reply_markup=MAIN_KB)
+    await record(context, msg)
+
+
+def kb_servers(action: str) -> InlineKeyboardMarkup:
+    """Выбор сервера: по кнопке на сервер и «Все»."""
+    buttons = [[InlineKeyboardButton(s.name, callback_data=f"{action}:{s.name}")] for s in SERVERS]
+    buttons.append([InlineKeyboardButton("Все", callback_data=f"{action}:*")])
+    return InlineKeyboardMarkup(buttons)
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="wol")
+async def wol(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    if len(SERVERS) > 1:
+        msg = await update.message.reply_text("🖥 Какой сервер включить?", reply_markup=kb_servers("wol"))
+        return await record(context, msg)
+
+    server = SERVERS[0]
+    msg = await update.message.reply_text(f"Отправляю WOL {server.name}...")
+    await record(context, msg)
+    # ход загрузки — в то же сообщение, из фоновой задачи
+    await wake_server(server, msg)
+
+
+async def wol_callback(q, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """wol:NAME — включить один сервер (в этом же сообщении), wol:* — все, по сообщению на сервер."""
+    name = data.split(":", 1)[1]
+    if name != "*":
+        server = find_server(name)
+        if server is None:
+            return await q.edit_message_text("Сервер не найден.")
+        await q.edit_message_text(f"Отправляю WOL {server.name}...")
+        return await wake_server(server, q.message)
+
+    await q.edit_message_text("🖥 Включаю все серверы:")
+    for server in SERVERS:
+        m = await context.bot.send_message(chat_id=q.message.chat.id, text=f"Отправляю WOL {server.name}...")
+        await record(context, m)
+        await wake_server(server, m)
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="shutdown")
+async def shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    if len(SERVERS) > 1:
+        msg = await update.message.reply_text("⏹ Какой сервер выключить?", reply_markup=kb_servers("shutdown"))
+        return await record(context, msg)
+
+    msg = await update.message.reply_text("Выключаю сервер...")
+    await record(context, msg)
+    shutdown_servers(SERVERS, msg)
+
+
+async def shutdown_callback(q, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """
+    shutdown:NAME / shutdown:* — выключить;
+    shutdown:force:NAME,NAME2 — выключить перечисленные без проверки занятости.
+    """
+    force = data.startswith("shutdown:force:")
+    if force:
+        names = set(data.split(":", 2)[2].split(","))
+        servers = [s for s in SERVERS if s.name in names]
+    else:
+        name = data.split(":", 1)[1]
+        servers = SERVERS if name == "*" else [s for s in SERVERS if s.name == name]
+    if not servers:
+        return await q.edit_message_text("Сервер не найден.")
+    # сводка — в этом же сообщении
+    await q.edit_message_text("Выключаю...")
+    shutdown_servers(servers, q.message, force)
+
+
+def reboot_targets() -> List[Router]:
+    """Роутеры, которые можно перезагрузить: с адресом из ROUTERS или ROUTER_IP."""
+    return [r for r in ROUTERS if r.host]
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="reboot_router")
+async def reboot_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    routers = reboot_targets()
+    if not routers:
+        msg = await update.message.reply_text("Роутер не настроен (ROUTER_IP / ROUTERS).")
+        return await record(context, msg)
+
+    if len(routers) > 1:
+        buttons = [[InlineKeyboardButton(r.name, callback_data=f"reboot:{r.name}")] for r in routers]
+        msg = await update.message.reply_text("🔄 Какой роутер перезагрузить?",
+                                              reply_markup=InlineKeyboardMarkup(buttons))
+        return await record(context, msg)
+
+    msg = await update.message.reply_text("Перезагружаю роутер...")
+    await record(context, msg)
+    await reboot(routers[0], msg)
+
+
+async def reboot_callback(q, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """reboot:NAME — перезагрузить роутер из ROUTERS (в этом же сообщении)."""
+    name = data.split(":", 1)[1]
+    router = next((r for r in reboot_targets() if r.name == name), None)
+    if router is None:
+        return await q.edit_message_text("Роутер не найден.")
+    await q.edit_message_text(f"Перезагружаю роутер {router.name}...")
+    await reboot(router, q.message)
+
+
+async def reboot(router: Router, msg):
+    ok, out = await run_ssh(router.host, router.user, router.key, "reboot")
+    await msg.edit_text((out or "Команда перезагрузки отправлена.") if ok else "Ошибка:\n" + scrub(out))
+
+
+# ---------------------------------------------------------------------
+# Устройства и логи
+# ---------------------------------------------------------------------
+
+def fmt_seen(ts) -> str:
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else "-"
+
+
+def render_devices(devices: List[dict], page: int, query: str = ""):
+    """Страница списка устройств: (текст, клавиатура). Кнопка — экран устройства."""
+    size = max(DEVICES_PAGE_SIZE, 1)
+    pages = max((len(devices) + size - 1) // size, 1)
+    page = min(max(page, 0), pages - 1)
+    chunk = devices[page * size:(page + 1) * size]
+
+    title = f"📋 Устройства: {len(devices)}"
+    if query:
+        title += f" (поиск «{query}»)"
+    lines = [title, ""]
+    for d in chunk:
+        lines.append(f"• {d['name'] or d['ip']} — {d['ip']}  MAC:{d['mac'] or '-'}  last:{fmt_seen(d['last_seen'])}")
+    if not devices:
+        lines.append("Ничего не найдено." if query else "Устройства не найдены.")
+
+    buttons = [
+        [InlineKeyboardButton(f"{d['name'] or d['ip']} · {d['ip']}", callback_data=f"dev:show:{d['id']}:{page}")]
+        for d in chunk
+    ]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅", callback_data=f"dev:page:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="dev:noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("➡", callback_data=f"dev:page:{page + 1}"))
+        buttons.append(nav)
+
+    row = [InlineKeyboardButton("🔍 Поиск", callback_data="dev:search")]
+    if query:
+        row.append(InlineKeyboardButton("✖ Сбросить", callback_data="dev:reset"))
+    row.append(InlineKeyboardButton("🏠 Меню", callback_data="menu:home"))
+    buttons.append(row)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+
+def device_page(context, page: int = 0):
+    """Страница с учётом поиска, сохранённого для пользователя."""
+    query = context.user_data.get("dev_query", "")
+    return render_devices(DEVICES.search(query), page, query)
+
+
+async def render_device(device_id: int, page: int = 0):
+    """Экран устройства: (текст, клавиатура) или None, если устройства нет."""
+    d = DEVICES.get(device_id)
+    if d is None:
+        return None
+    t = await device_traffic(device_id)
+
+    def line(title, key):
+        rx, tx = t[key]
+        return f"{title}: {fmt(rx + tx)}  (↓ {fmt(rx)}  ↑ {fmt(tx)})"
+
+    lines = [
+        f"📟 {d['name'] or d['ip']}",
+        "",
+        f"IP: {d['ip']}",
+        f"MAC: {d['mac'] or '-'}",
+        f"Роутер: {d['router'] or '-'}  подсеть: {d['subnet'] or '-'}",
+        f"Последняя активность: {fmt_seen(d['last_seen'])} UTC",
+        "",
+        line("Сегодня", "today"),
+        line("Вчера", "yesterday"),
+        line("Месяц", "month"),
+        line("Год", "year"),
+        line("Всего", "total"),
+    ]
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✏️ Переименовать", callback_data=f"dev:rename:{device_id}:{page}"),
+        InlineKeyboardButton("⬅ К списку", callback_data=f"dev:page:{page}"),
+    ]])
+    return "\n".join(lines), kb
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="list_devices")
+async def list_devices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    context.user_data.pop("dev_query", None)
+    text, kb = device_page(context)
+    m = await update.message.reply_text(text, reply_markup=kb)
+    await record(context, m)
+
+
+async def device_callback(q, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """Кнопки «📋 Устройства»: dev:page:N, dev:show:ID:N, dev:rename:ID:N, dev:search, dev:reset."""
+    parts = data.split(":")
+    action = parts[1] if len(parts) > 1 else ""
+    try:
+        args = [int(x) for x in parts[2:]]
+    except ValueError:
+        args = []
+
+    if action == "page":
+        text, kb = device_page(context, args[0] if args else 0)
+
+    elif action == "reset":
+        context.user_data.pop("dev_query", None)
+        text, kb = device_page(context)
+
+    elif action == "show" and args:
+        screen = await render_device(*args[:2])
+        if screen is None:
+            text, kb = device_page(context)
+        else:
+            text, kb = screen
+
+    elif action == "search":
+        context.user_data["pending"] = ("dev_search",)
+        m = await q.message.reply_text("🔍 Введите часть имени, IP или MAC:")
+        await record(context, m)
+        return
+
+    elif action == "rename" and args:
+        d = DEVICES.get(args[0])
+        if d is None:
+            return
+        context.user_data["pending"] = ("dev_rename", *args[:2])
+        m = await q.message.reply_text(f"✏️ Новое имя для {d['name'] or d['ip']} ({d['ip']}):")
+        await record(context, m)
+        return
 
-    msg = await update.message.reply_text("Готов к работе!", reply_markup=MAIN_KB)
-    await record(context, msg)
+    else:
+        # номер страницы и прочее без действия
+        return
 
+    try:
+        await q.edit_message_text(text, reply_markup=kb)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            m = await q.message.reply_text(text, reply_markup=kb)
+            await record(context, m)
 
-async def wol(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = await update.message.reply_text("Отправляю WOL...")
-    ok, info = await send_wol(SERVER_MAC)
-    out = "OK: " + info if ok else "Ошибка: " + info
-    msg2 = await update.message.reply_text(out)
-    await record(context, msg)
-    await record(context, msg2)
 
+async def device_input(update: Update, context: ContextTypes.DEFAULT_TYPE, pending: tuple, text: str):
+    """Ответ на «🔍 Поиск» или «✏️ Переименовать»."""
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
 
-async def shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = await update.message.reply_text("Выключаю сервер...")
-    ok, out = await run_ssh(SERVER_IP, SSH_USER_OMV, SSH_KEY_OMV, "sudo shutdown -h now")
-    msg2 = await update.message.reply_text(out if ok else "Ошибка:\n" + scrub(out))
-    await record(context, msg)
-    await record(context, msg2)
+    if pending[0] == "dev_search":
+        context.user_data["dev_query"] = text[:64]
+        text, kb = device_page(context)
+    else:
+        _, device_id, page = pending
+        name = " ".join(text.split())[:64]
+        if DEVICES.get(device_id) is None:
+            text, kb = "Устройство не найдено.", None
+        else:
+            if name:
+                await DEVICES.rename(device_id, name)
+            text, kb = await render_device(device_id, page)
 
+    m = await update.message.reply_text(text, reply_markup=kb)
+    await record(context, m)
 
-async def reboot_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = await update.message.reply_text("Перезагружаю роутер...")
-    ok, out = await run_ssh(ROUTER_IP, ROUTER_SSH_USER, ROUTER_SSH_KEY, "reboot")
-    msg2 = await update.message.reply_text(out if ok else "Ошибка:\n" + scrub(out))
-    await record(context, msg)
-    await record(context, msg2)
-# ---------------------------------------------------------------------
-# Устройства и логи
-# ---------------------------------------------------------------------
 
-async def list_devices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def render_log(flt: str, offset: int = -1, older: bool = True):
+    """Страница лога для экрана «📜 Логи»: (текст, клавиатура)."""
+    lines, start, end, size = await asyncio.to_thread(read_log_page, LOG_PATH, offset, older, log_matcher(flt))
+
+    title = f"📜 Лог ({fmt(size)})"
+    if flt in LOG_LEVELS:
+        title += ", только ошибки" if flt == "error" else ", ошибки и предупреждения"
+    elif flt.startswith("text:"):
+        title += f", поиск «{flt[5:]}»"
+    if size and end + 1 < size:
+        title += f", позиция {end * 100 // size}%"
+    body = "\n".join(lines) if lines else ("(ничего не найдено)" if flt else "(лог пуст)")
+
+    nav = []
+    if start > 0:
+        nav.append(InlineKeyboardButton("⬅ Раньше", callback_data=f"log:o:{start}"))
+    if end + 1 < size:
+        nav.append(InlineKeyboardButton("➡ Позже", callback_data=f"log:n:{end}"))
+        nav.append(InlineKeyboardButton("⏭ Последние", callback_data="log:o:-1"))
+    filters_row = [
+        InlineKeyboardButton(("✓ " if not flt else "") + "Все", callback_data="log:f:all"),
+        InlineKeyboardButton(("✓ " if flt == "error" else "") + "⚠ Ошибки", callback_data="log:f:error"),
+        InlineKeyboardButton(("✓ " if flt.startswith("text:") else "") + "🔍 Поиск", callback_data="log:f:search"),
+    ]
+    kb = InlineKeyboardMarkup([nav, filters_row] if nav else [filters_row])
+    return f"{title}\n\n{body}", kb
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="show_logs")
+async def show_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return await update.message.reply_text("Доступ запрещён.")
-    async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
-        cur = await db.execute("SELECT ip, name, mac, last_seen FROM devices ORDER BY ip")
-        rows = await cur.fetchall()
 
-    if not rows:
-        msg = await update.message.reply_text("Устройства не найдены.")
-        await record(context, msg)
+    if not os.path.exists(LOG_PATH):
+        m = await update.message.reply_text("Лог-файла не найден.")
+        await record(context, m)
         return
 
-    lines = []
-    for ip, name, mac, last in rows:
-        lines.append(f"{ip} — {name}  MAC:{mac or '-'}  last:{last or '-'}")
+    text, kb = await render_log(context.user_data.get("log_filter", ""))
+    m = await update.message.reply_text(text, reply_markup=kb)
+    await record(context, m)
+
+
+async def log_callback(q, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """Кнопки «📜 Логи»: log:o:N (раньше N), log:n:N (позже N), log:f:фильтр."""
+    _, action, arg = (data.split(":", 2) + ["", ""])[:3]
+    if not os.path.exists(LOG_PATH):
+        return await q.edit_message_text("Лог-файла не найден.")
 
-    # Разбиваем на сообщения по 4000 символов (telegram limit)
-    chunk = ""
-    for line in lines:
-        if len(chunk) + len(line) + 1 > 3900:
-            m = await update.message.reply_text(chunk)
+    if action == "f":
+        if arg == "search":
+            context.user_data["pending"] = ("log_filter",)
+            m = await q.message.reply_text("🔍 Введите слово для поиска в логе:")
             await record(context, m)
-            chunk = ""
-        chunk += line + "\n"
-    if chunk:
-        m = await update.message.reply_text(chunk)
-        await record(context, m)
+            return
+        context.user_data["log_filter"] = arg if arg in LOG_LEVELS else ""
+        offset, older = -1, True
+    else:
+        try:
+            offset = int(arg)
+        except ValueError:
+            offset = -1
+        older = action != "n"
 
+    text, kb = await render_log(context.user_data.get("log_filter", ""), offset, older)
+    try:
+        await q.edit_message_text(text, reply_markup=kb)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            m = await q.message.reply_text(text, reply_markup=kb)
+            await record(context, m)
 
-async def show_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+async def log_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Ответ на «🔍 Поиск» в логе."""
     if not is_allowed(update.effective_user.id):
         return await update.message.reply_text("Доступ запрещён.")
 
+    word = text.strip()[:64]
+    context.user_data["log_filter"] = f"text:{word}" if word else ""
     if not os.path.exists(LOG_PATH):
         m = await update.message.reply_text("Лог-файла не найден.")
-        await record(context, m)
-        return
+    else:
+        text, kb = await render_log(context.user_data["log_filter"])
+        m = await update.message.reply_text(text, reply_markup=kb)
+    await record(context, m)
 
-    with open(LOG_PATH, "r", encoding="utf-8", errors="ignore") as f:
-        text = f.read()[-6000:]
-    m = await update.message.reply_text(scrub(text))
+
+@METRICS.timed("wolbot_handler_seconds", handler="show_stats")
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — служебные счётчики (SSH-пул, кэш отчётов)."""
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    ssh = SSH_POOL.stats()
+    cache = REPORT_CACHE.stats()
+    lines = [
+        "⚙️ Служебная статистика",
+        "",
+        f"SSH: {'пул' if SSH_POOL_ENABLED else 'без пула'}, сессий {ssh['open_sessions']}",
+        f"  подключений {ssh['connects']} (ср. {ssh['connect_avg_ms']:.0f} мс), "
+        f"повторных использований {ssh['reuses']}, переподключений {ssh['reconnects']}",
+        f"  команд {ssh['exec_count']} (ср. {ssh['exec_avg_ms']:.0f} мс), ошибок {ssh['failures']}",
+        "",
+        f"Кэш отчётов: {cache['size']}/{REPORT_CACHE.size}, "
+        f"попаданий {cache['hits']}, промахов {cache['misses']}",
+    ]
+    limiter = context.bot.rate_limiter
+    if isinstance(limiter, OutboundLimiter):
+        c = limiter.counters
+        lines.append(
+            f"Telegram: запросов {c['requests']}, ждали очереди {c['queued']}, "
+            f"повторов после 429 {c['retries']}, не отправлено {c['failed']}"
+        )
+    if TRAFFIC_COLLECTION_ENABLED:
+        c = COLLECTOR.counters
+        lines += [
+            "",
+            f"Сбор трафика: прогонов {c['runs']} (последний {COLLECTOR.last_ms} мс), "
+            f"прервано по сроку {c['timeouts']}, пропущено {c['skipped']}, "
+            f"присоединено обновлений {c['coalesced']}",
+        ]
+    for router in ROUTERS:
+        st = router.stats
+        lines.append("")
+        lines.append(f"Роутер {router.name} ({router.host}, {router.lan}):")
+        if st["mode"]:
+            mode = "агент на роутере" if st["mode"] == "agent" else "полный дамп"
+            lines.append(f"  сбор: {mode}, соединений {st['flows']}, {st['last_ms']} мс")
+        if TRAFFIC_NEIGHBOR_TTL:
+            nb = router.neighbors
+            lines.append(f"  MAC-адресов {nb.size()}, обновлений таблицы соседей {nb.refreshes}")
+        lines.append(f"  опросов {st['ok']}, ошибок {st['failures']}")
+        if router.fail_streak:
+            lines.append(f"  недоступен {router.fail_streak} раз подряд, пропуск опросов: {router.skip}")
+        if st["last_error"]:
+            lines.append(f"  последняя ошибка: {st['last_error']}")
+        if TRAFFIC_EVENTS_ENABLED:
+            ev = router.events
+            state = "подключён" if ev.connected else "нет связи"
+            lines.append(f"  события DESTROY: {state}, событий {ev.events}, переподключений {ev.reconnects}")
+    last = RETENTION["last_result"]
+    if last:
+        lines.append("")
+        lines.append(
+            f"Очистка {RETENTION['last_run']:%Y-%m-%d %H:%M} UTC: "
+            f"удалено {last['rows']} строк за {last['seconds']} с"
+        )
+    timings = METRICS.summary()
+    if timings:
+        lines += ["", "⏱ Время: количество, среднее / p95, мс"]
+        for name, count, avg, p95 in timings:
+            lines.append(f"  {name}: {count}, {avg:.1f} / {'>60000' if p95 == float('inf') else f'{p95:.0f}'}")
+    m = await update.message.reply_text("\n".join(lines))
     await record(context, m)
 
 
@@ -514,14 +3585,55 @@ async def show_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Показ статистики (кнопка / рендер)
 # ---------------------------------------------------------------------
 
-async def show_traffic(update: Update, context: ContextTypes.DEFAULT_TYPE, offset: int = 0):
+class ReportCache:
+    """
+    LRU-кэш готовых отчётов «📊 Трафик»: тексты и графики.
+
+    Закрытые месяцы не меняются и сбрасываются только вытеснением.
+    Отчёты по текущему периоду сбрасываются, когда коллектор записал
+    новые данные или статистику очистили.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key: tuple, value, closed: bool):
+        self._items[key] = (value, closed)
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def invalidate_open(self):
+        for key in [k for k, (_, closed) in self._items.items() if not closed]:
+            del self._items[key]
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+REPORT_CACHE = ReportCache(REPORT_CACHE_SIZE)
+
+
+async def render_traffic(offset: int) -> str:
     """
     offset == 0 -> текущий месяц (спец-правила: показать сегодня, вчера, месяц, год)
     offset < 0  -> показать итог за соответствующий прошлый месяц (разбивка по устройствам)
     """
-    if not is_allowed(update.effective_user.id):
-        return await update.message.reply_text("Доступ запрещён.")
-
     target = datetime.now() + relativedelta(months=offset)
     month_title = target.strftime("%B %Y")
 
@@ -543,29 +3655,359 @@ async def show_traffic(update: Update, context: ContextTypes.DEFAULT_TYPE, offse
         lines += ["", f"Всего сегодня: {fmt(total_today)}", f"Вчера: {fmt(y_total)}", f"Месяц (нарастающим итогом): {fmt(m_total)}", f"Год: {fmt(yrtotal)}"]
     else:
         per_dev = await month_per_device(target.year, target.month)
-        total = sum(per_dev.values())
+        total = sum(t for _, t in per_dev)
         lines = [f"📊 Трафик за {month_title} (итог):", ""]
         if per_dev:
             idx = 1
-            for ip, val in sorted(per_dev.items(), key=lambda x: x[1], reverse=True):
+            for ip, val in per_dev:
                 lines.append(f"{idx}. {ip} — {fmt(val)}")
                 idx += 1
             lines += ["", f"Всего: {fmt(total)}"]
         else:
             lines.append("(нет данных)")
 
+    return "\n".join(lines)
+
+
+async def traffic_report(offset: int) -> str:
+    """Текст отчёта для offset, из кэша если возможно."""
+    now = datetime.now()
+    target = now + relativedelta(months=offset)
+    if offset == 0:
+        # текущий отчёт зависит и от дня (сегодня / вчера)
+        key = ("current", now.date().isoformat())
+        closed = False
+    else:
+        key = ("month", target.year, target.month)
+        closed = next_month_start(target.year, target.month) <= time.time()
+
+    text = REPORT_CACHE.get(key)
+    if text is None:
+        text = await render_traffic(offset)
+        REPORT_CACHE.put(key, text, closed)
+    return text
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="show_traffic")
+async def show_traffic(update: Update, context: ContextTypes.DEFAULT_TYPE, offset: int = 0):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    text = await traffic_report(offset)
+
     # Отправляем текст с Inline-клавиатурой
-    text = "\n".join(lines)
     m = await update.message.reply_text(text, reply_markup=kb_traffic(offset))
     await record(context, m)
 
 
+# ---------------------------------------------------------------------
+# Графики трафика по устройствам
+# ---------------------------------------------------------------------
+
+# разрешение графика → (таблица агрегатов, колонка корзины, ширина корзины)
+CHART_SERIES = {
+    "h": ROLLUPS[0],
+    "d": ROLLUPS[1],
+}
+
+_CHART_POOL = None
+
+
+def chart_pool() -> ProcessPoolExecutor:
+    """
+    Отдельный процесс для отрисовки: matplotlib занимает CPU на сотни
+    миллисекунд и держит GIL, в потоке это остановило бы бота.
+    spawn — процесс бота многопоточный (SSH, SQLite), fork небезопасен.
+    """
+    global _CHART_POOL
+    if _CHART_POOL is None:
+        _CHART_POOL = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _CHART_POOL
+
+
+def render_chart(data: bytes, start: int, width: int, count: int,
+                 labels: Dict[int, str], title: str, top: int) -> bytes:
+    """
+    Рисует PNG со скоростью по устройствам (выполняется в процессе chart_pool).
+
+    data — плоский int64-массив троек (корзина, device_id, байты).
+    Самые активные top устройств — отдельными слоями, остальные — «другие».
+    """
+    import numpy as np
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rows = np.frombuffer(data, dtype=np.int64).reshape(-1, 3)
+    devices, dev_idx = np.unique(rows[:, 1], return_inverse=True)
+    grid = np.zeros((len(devices), count))
+    np.add.at(grid, (dev_idx, (rows[:, 0] - start) // width), rows[:, 2])
+
+    order = np.argsort(grid.sum(axis=1))[::-1]
+    series = grid[order[:top]]
+    names = [labels.get(int(d), str(d)) for d in devices[order[:top]]]
+    palette = plt.get_cmap("tab20").colors
+    colors = [palette[i % len(palette)] for i in range(len(names))]
+    if len(order) > top:
+        series = np.vstack([series, grid[order[top:]].sum(axis=0)])
+        names.append("другие")
+        colors.append("0.8")
+
+    # байты за корзину → средняя скорость, Мбит/с
+    series = series * 8 / width / 1e6
+    times = (start + np.arange(count) * width).astype("datetime64[s]")
+
+    fig, ax = plt.subplots(figsize=(10, 5), dpi=100)
+    try:
+        ax.stackplot(times, series, labels=names, colors=colors)
+        ax.set_title(title)
+        ax.set_ylabel("Мбит/с (среднее)")
+        ax.set_xlim(times[0], times[-1])
+        ax.grid(alpha=0.3)
+        ax.legend(loc="upper left", fontsize="small", ncol=2)
+        fig.autofmt_xdate()
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", bbox_inches="tight")
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+@METRICS.timed("wolbot_query_seconds", query="chart_data")
+async def chart_data(res: str, start: int, end: int) -> Tuple[array, Dict[int, str]]:
+    """Корзины из агрегатов одним запросом, сразу в плоский int64-массив."""
+    table, bucket, _ = CHART_SERIES[res]
+    rows = await DB.fetchall(
+        f"SELECT {bucket}, device_id, rx_bytes + tx_bytes FROM {table} WHERE {bucket} >= ? AND {bucket} < ?",
+        (start, end)
+    )
+    data = array("q", chain.from_iterable(rows))
+    return data, DEVICES.labels()
+
+
+async def traffic_chart(offset: int, res: str):
+    """
+    График за месяц offset: file_id уже отправленного графика, PNG
+    или None, если данных нет. Возвращает (ключ кэша, закрыт ли месяц, фото).
+    """
+    target = datetime.now() + relativedelta(months=offset)
+    start = month_start(target.year, target.month)
+    end = next_month_start(target.year, target.month)
+    closed = end <= time.time()
+    key = ("chart", target.year, target.month, res)
+
+    photo = REPORT_CACHE.get(key)
+    if photo is not None:
+        return key, closed, photo
+
+    _, _, width = CHART_SERIES[res]
+    # текущий месяц — до текущей корзины включительно
+    last = min(end, bucket_start(int(time.time()), width) + width)
+    data, labels = await chart_data(res, start, last)
+    if not data:
+        return key, closed, None
+
+    title = f"Трафик по устройствам — {target.strftime('%B %Y')}, {'по часам' if res == 'h' else 'по дням'}"
+    png = await asyncio.get_running_loop().run_in_executor(
+        chart_pool(), render_chart,
+        data.tobytes(), start, width, (last - start) // width, labels, title, CHART_TOP_DEVICES
+    )
+    REPORT_CACHE.put(key, png, closed)
+    return key, closed, png
+
+
+async def send_traffic_chart(q, context, offset: int, res: str):
+    try:
+        key, closed, photo = await traffic_chart(offset, res)
+    except ImportError:
+        m = await q.message.reply_text("Для графиков установите matplotlib: pip install matplotlib")
+        await record(context, m)
+        return
+
+    if photo is None:
+        m = await q.message.reply_text("Нет данных для графика за этот период.")
+        await record(context, m)
+        return
+
+    m = await q.message.reply_photo(photo)
+    await record(context, m)
+    if isinstance(photo, bytes) and m.photo:
+        # повторно отправляем по file_id, без загрузки картинки
+        REPORT_CACHE.put(key, m.photo[-1].file_id, closed)
+
+
+# ---------------------------------------------------------------------
+# ⚡ Сейчас — текущая скорость по устройствам
+# ---------------------------------------------------------------------
+
+class LiveRates:
+    """
+    Замер текущей скорости: прирост счётчиков flow между двумя
+    последними снимками conntrack, делённый на время между ними.
+
+    Отдельно от коллектора: у каждого роутера свой FlowTracker, который
+    хранит только последний снимок, в БД ничего не пишется.
+    Один экземпляр (LIVE) на всех зрителей «⚡ Сейчас»: снимок, снятый
+    для одного сообщения, получают и остальные — роутер не дампит
+    conntrack на каждое открытое сообщение. SSH — через COLLECT_EXECUTOR,
+    как у коллектора.
+    """
+
+    def __init__(self):
+        self.trackers = {r.name: FlowTracker(r.lan) for r in ROUTERS}
+        self.taken: Dict[str, float] = {}
+        self.task = None
+        self.result: Tuple[Dict[str, list], List[str]] = ({}, [])
+        self.result_at = None
+
+    async def _sample(self, router: Router):
+        tracker = self.trackers[router.name]
+        sample = tracker.begin()
+        taken = time.monotonic()
+        abort = threading.Event()
+        try:
+            ok, err = await asyncio.wait_for(
+                run_ssh_lines(
+                    router.host, router.user, router.key, router.dump_command(), sample.feed_line,
+                    executor=COLLECT_EXECUTOR, abort=abort, timeout=TRAFFIC_ROUTER_TIMEOUT
+                ),
+                TRAFFIC_ROUTER_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            ok, err = False, f"нет ответа за {TRAFFIC_ROUTER_TIMEOUT} с"
+        except BaseException:
+            tracker.abort(sample)
+            raise
+        finally:
+            # поток бросит чтение с ближайшим куском вывода и вернётся в пул
+            abort.set()
+        if not ok:
+            # недочитанный снимок не принимаем: следующий посчитается от прошлого целого
+            tracker.abort(sample)
+            raise RuntimeError(err)
+
+        deltas = tracker.commit(sample)
+        prev = self.taken.get(router.name)
+        self.taken[router.name] = taken
+        if prev is None or taken - prev > 3 * LIVE_INTERVAL:
+            # первый снимок (или давно никто не смотрел) — только точка отсчёта
+            return {}
+        return {ip: (v["in"] / (taken - prev), v["out"] / (taken - prev)) for ip, v in deltas.items()}
+
+    async def _sample_all(self) -> Tuple[Dict[str, list], List[str]]:
+        results = await asyncio.gather(*(self._sample(r) for r in ROUTERS), return_exceptions=True)
+        rates = {}
+        failed = []
+        for router, res in zip(ROUTERS, results):
+            if isinstance(res, BaseException):
+                failed.append(router.name)
+                continue
+            for ip, (rx, tx) in res.items():
+                mac, _ = router.neighbors.get(ip)
+                r = rates.setdefault(mac or ip, [ip, 0.0, 0.0])
+                r[1] += rx
+                r[2] += tx
+        self.result = rates, failed
+        self.result_at = time.monotonic()
+        return self.result
+
+    async def sample(self) -> Tuple[Dict[str, list], List[str]]:
+        """
+        Снимок со всех роутеров: ({mac или ip: [ip, rx/с, tx/с]}, [роутеры без ответа]).
+        Идущий замер ждём, снятый меньше полуинтервала назад отдаём готовым.
+        """
+        if self.task is None or self.task.done():
+            if self.result_at is not None and time.monotonic() - self.result_at < LIVE_INTERVAL / 2:
+                return self.result
+            self.task = spawn(self._sample_all())
+        # зритель ушёл (отмена) — замер для остальных продолжается
+        return await asyncio.shield(self.task)
+
+
+LIVE = LiveRates()
+
+
+def render_live(rates: Dict[str, list], names: Dict[str, str], failed: List[str], final: bool) -> str:
+    lines = [f"⚡ Сейчас — {datetime.now():%H:%M:%S}", ""]
+    top = sorted(rates.items(), key=lambda x: x[1][1] + x[1][2], reverse=True)
+    for key, (ip, rx, tx) in top[:15]:
+        if rx + tx < 1:
+            break
+        lines.append(f"• {names.get(key) or ip} — ↓ {fmt(int(rx))}/s  ↑ {fmt(int(tx))}/s")
+    if len(lines) == 2:
+        lines.append("(нет активности)")
+
+    total_rx = sum(r[1] for r in rates.values())
+    total_tx = sum(r[2] for r in rates.values())
+    lines += ["", f"Всего: ↓ {fmt(int(total_rx))}/s  ↑ {fmt(int(total_tx))}/s"]
+    if failed:
+        lines.append("Нет ответа: " + ", ".join(failed))
+    lines.append("Обновление остановлено." if final else f"Обновляется каждые {LIVE_INTERVAL} с")
+    return "\n".join(lines)
+
+
+# chat_id → задача, обновляющая сообщение «⚡ Сейчас» в этом чате
+LIVE_TASKS: Dict[int, asyncio.Task] = {}
+
+
+async def run_live(message):
+    """Обновляет сообщение на месте LIVE_DURATION секунд."""
+    names = DEVICES.names()
+    deadline = time.monotonic() + LIVE_DURATION
+    await LIVE.sample()
+
+    while True:
+        await asyncio.sleep(LIVE_INTERVAL)
+        rates, failed = await LIVE.sample()
+        final = time.monotonic() >= deadline
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⚡ Ещё раз", callback_data="live:start")]]) if final else None
+        try:
+            await message.edit_text(render_live(rates, names, failed, final), reply_markup=kb)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                # сообщение удалено (автоочистка) — обновлять больше нечего
+                return
+        if final:
+            return
+
+
+def start_live(message, context):
+    chat_id = message.chat.id
+    old = LIVE_TASKS.get(chat_id)
+    if old is not None and not old.done():
+        old.cancel()
+    LIVE_TASKS[chat_id] = spawn(run_live(message))
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="show_live")
+async def show_live(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    m = await update.message.reply_text(f"⚡ Замеряю скорость ({LIVE_INTERVAL} с)...")
+    await record(context, m)
+    start_live(m, context)
+
+
 # ---------------------------------------------------------------------
 # CallbackQuery handler
 # ---------------------------------------------------------------------
 
+async def edit_traffic(q, offset: int):
+    """Редактируем сообщение — рендерим для offset."""
+    text = await traffic_report(offset)
+    try:
+        await q.edit_message_text(text, reply_markup=kb_traffic(offset))
+    except Exception:
+        # Возможно сообщение было удалено/изменино — просто отправим новое
+        await q.message.reply_text(text, reply_markup=kb_traffic(offset))
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="callback_handler")
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
+    if not is_allowed(update.effective_user.id):
+        return await q.answer("Доступ запрещён.")
     await q.answer()
     data = q.data or ""
 
@@ -574,40 +4016,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             offset = int(data.split(":", 1)[1])
         except:
             offset = 0
-        # редактируем сообщение — рендерим для offset
-        target = datetime.now() + relativedelta(months=offset)
-        month_title = target.strftime("%B %Y")
-        if offset == 0:
-            today = await today_per_device()
-            total_today = sum(t for _, t in today)
-            y_total = await yesterday_total()
-            m_total = await month_total(target.year, target.month)
-            yrtotal = await year_total()
-            lines = [f"📊 Трафик — {month_title}", ""]
-            lines.append("Сегодня (на данный момент):")
-            if today:
-                for ip, t in today:
-                    lines.append(f"• {ip} — {fmt(t)}")
-            else:
-                lines.append("(нет данных за сегодня)")
-            lines += ["", f"Всего сегодня: {fmt(total_today)}", f"Вчера: {fmt(y_total)}", f"Месяц (нарастающим итогом): {fmt(m_total)}", f"Год: {fmt(yrtotal)}"]
-        else:
-            per_dev = await month_per_device(target.year, target.month)
-            total = sum(per_dev.values())
-            lines = [f"📊 Трафик за {month_title} (итог):", ""]
-            if per_dev:
-                idx = 1
-                for ip, val in sorted(per_dev.items(), key=lambda x: x[1], reverse=True):
-                    lines.append(f"{idx}. {ip} — {fmt(val)}")
-                    idx += 1
-                lines += ["", f"Всего: {fmt(total)}"]
-            else:
-                lines.append("(нет данных)")
-        try:
-            await q.edit_message_text("\n".join(lines), reply_markup=kb_traffic(offset))
-        except Exception:
-            # Возможно сообщение было удалено/изменино — просто отправим новое
-            await q.message.reply_text("\n".join(lines), reply_markup=kb_traffic(offset))
+        await edit_traffic(q, offset)
 
     elif data.startswith("traffic_refresh:"):
         try:
@@ -615,10 +4024,36 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             offset = 0
         if offset == 0 and TRAFFIC_COLLECTION_ENABLED:
-            # принудительный сбор
-            await collect_conntrack(context)
+            # принудительный сбор (или ожидание уже идущего)
+            await COLLECTOR.refresh()
         # перерендерить текущее окно:
-        await callback_handler(update, context)  # рекурсивно обработаем traffic_prev:0
+        await edit_traffic(q, offset)
+
+    elif data.startswith("traffic_graph:"):
+        try:
+            _, offset, res = data.split(":")
+            offset = int(offset)
+        except ValueError:
+            offset, res = 0, "d"
+        await send_traffic_chart(q, context, offset, res if res in CHART_SERIES else "d")
+
+    elif data == "live:start":
+        start_live(q.message, context)
+
+    elif data.startswith("wol:"):
+        await wol_callback(q, context, data)
+
+    elif data.startswith("shutdown:"):
+        await shutdown_callback(q, context, data)
+
+    elif data.startswith("reboot:"):
+        await reboot_callback(q, context, data)
+
+    elif data.startswith("dev:"):
+        await device_callback(q, context, data)
+
+    elif data.startswith("log:"):
+        await log_callback(q, context, data)
 
     elif data == "traffic_clear:confirm":
         kb = InlineKeyboardMarkup([[
@@ -628,9 +4063,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text("Подтвердите удаление всей статистики (это необратимо).", reply_markup=kb)
 
     elif data == "traffic_clear:do":
-        async with aiosqlite.connect(TRAFFIC_DB_PATH) as db:
+        async with DB.transaction() as db:
             await db.execute("DELETE FROM traffic_stats")
-            await db.commit()
+            await db.execute("DROP TABLE IF EXISTS traffic_stats_v1")
+            for table, _, _ in ROLLUPS:
+                await db.execute(f"DELETE FROM {table}")
+        REPORT_CACHE.clear()
         await q.edit_message_text("Статистика удалена.", reply_markup=kb_traffic(0))
 
     elif data == "menu:home":
@@ -648,6 +4086,8 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
+    # ожидаемый ответ (поиск, новое имя) отменяется любой кнопкой меню
+    pending = context.user_data.pop("pending", None)
 
     if text == "🖥 Включить сервер":
         return await wol(update, context)
@@ -661,46 +4101,589 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "📊 Трафик":
         return await show_traffic(update, context, 0)
 
+    if text == "⚡ Сейчас":
+        return await show_live(update, context)
+
     if text == "📋 Устройства":
         return await list_devices(update, context)
 
     if text == "📜 Логи":
         return await show_logs(update, context)
 
+    if pending and pending[0] == "log_filter":
+        return await log_input(update, context, text)
+    if pending:
+        return await device_input(update, context, pending, text)
+
     return await update.message.reply_text("Неизвестная команда. Нажми /start для меню.")
 
 
+# ---------------------------------------------------------------------
+# Выгрузка и загрузка истории трафика
+# ---------------------------------------------------------------------
+
+# уровень → (таблица, колонка времени, порядок первичного ключа)
+EXPORT_LEVELS = {
+    "raw": ("traffic_stats", "ts", "device_id, ts"),
+    "hourly": ("traffic_hourly", "hour", "hour, device_id"),
+    "daily": ("traffic_daily", "day", "day, device_id"),
+    "monthly": ("traffic_monthly", "month", "month, device_id"),
+}
+# устройство — по MAC / IP / имени, а не по id: файл переносится между базами
+EXPORT_COLUMNS = ("level", "ts", "mac", "ip", "name", "rx_bytes", "tx_bytes")
+EXPORT_FORMATS = {"csv": ".csv.gz", "parquet": ".parquet"}
+EXPORT_CHUNK = 10000
+# предел Bot API для отправки документа
+EXPORT_MAX_DOCUMENT = 50 * 1024 * 1024
+EXPORT_USAGE = (
+    "/export [raw|hourly|daily|monthly|all] [csv|parquet] [период] [устройство ...]\n"
+    "Период: 2025, 2025-03, 2025-03-01 или 2025-01..2025-03. "
+    "Устройство — имя, IP или MAC. По умолчанию — все уровни, csv, всё время."
+)
+
+
+def _period(text: str) -> Tuple[int, int]:
+    """"2025" / "2025-03" / "2025-03-01" → [начало, конец) в epoch-секундах UTC."""
+    parts = [int(x) for x in text.split("-")]
+    start = datetime(*parts, *[1] * (3 - len(parts)))
+    if len(parts) == 1:
+        end = start + relativedelta(years=1)
+    elif len(parts) == 2:
+        end = start + relativedelta(months=1)
+    else:
+        end = start + timedelta(days=1)
+    return calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple())
+
+
+_PERIOD_RE = re.compile(r"^\d{4}(-\d{2}){0,2}(\.\.\d{4}(-\d{2}){0,2})?$")
+
+
+def find_device(spec: str):
+    """Устройство по точному имени, IP или MAC (без учёта регистра)."""
+    q = spec.strip().lower()
+    mac_q = q.replace("-", ":")
+    for d in DEVICES.sorted():
+        if q == (d["name"] or "").lower() or q == d["ip"] or mac_q == (d["mac"] or ""):
+            return d
+    return None
+
+
+def parse_export_args(args: List[str]) -> dict:
+    """Аргументы /export и `export` в любом порядке; ValueError — с текстом для пользователя."""
+    opts = {"levels": list(EXPORT_LEVELS), "fmt": "csv", "start": 0, "end": 2 ** 62, "device_ids": None}
+    names = ["all", "all"]
+    for arg in args:
+        a = arg.lower()
+        if a in EXPORT_LEVELS or a == "all":
+            opts["levels"] = list(EXPORT_LEVELS) if a == "all" else [a]
+            names[0] = a
+        elif a in EXPORT_FORMATS:
+            opts["fmt"] = a
+        elif _PERIOD_RE.match(a):
+            first, _, last = a.partition("..")
+            try:
+                opts["start"], opts["end"] = _period(first)[0], _period(last or first)[1]
+            except ValueError:
+                raise ValueError(f"Неверный период: {arg}")
+            names[1] = a.replace("..", "_")
+        else:
+            d = find_device(arg)
+            if d is None:
+                raise ValueError(f"Устройство не найдено: {arg}")
+            opts["device_ids"] = (opts["device_ids"] or []) + [d["id"]]
+    opts["filename"] = f"traffic_{names[0]}_{names[1]}{EXPORT_FORMATS[opts['fmt']]}"
+    return opts
+
+
+class CsvExportWriter:
+    """gzip CSV с заголовком EXPORT_COLUMNS."""
+
+    def __init__(self, path: str):
+        self.file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        self.csv = csv.writer(self.file)
+        self.csv.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: List[tuple]):
+        self.csv.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    """Колоночный Parquet (нужен pyarrow): группа строк на каждую порцию выборки."""
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("level", pa.string()), ("ts", pa.int64()), ("mac", pa.string()), ("ip", pa.string()),
+            ("name", pa.string()), ("rx_bytes", pa.int64()), ("tx_bytes", pa.int64()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows: List[tuple]):
+        columns = [self.pa.array(col, type=field.type) for col, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+@METRICS.timed("wolbot_query_seconds", query="export_traffic")
+async def export_traffic(path: str, levels: List[str], fmt: str = "csv", start: int = 0, end: int = 2 ** 62,
+                         device_ids: List[int] = None, **_) -> int:
+    """
+    Выгрузка в файл path потоком: курсор по первичному ключу таблицы
+    (без сортировки), порции по EXPORT_CHUNK строк — память не зависит от
+    объёма истории. Сжатие и запись порции — в потоке. Возвращает число строк.
+    """
+    writer = await asyncio.to_thread(ParquetExportWriter if fmt == "parquet" else CsvExportWriter, path)
+    total = 0
+    try:
+        for level in levels:
+            table, bucket, order = EXPORT_LEVELS[level]
+            where, params = f"t.{bucket} >= ? AND t.{bucket} < ?", [start, end]
+            if device_ids:
+                where += f" AND t.device_id IN ({', '.join('?' * len(device_ids))})"
+                params += device_ids
+            # CROSS JOIN — таблица трафика снаружи, в порядке своего ключа
+            q = f"""
+                SELECT ?, t.{bucket}, d.mac, d.ip, d.name, t.rx_bytes, t.tx_bytes
+                FROM {table} t CROSS JOIN devices d ON d.id = t.device_id
+                WHERE {where}
+                ORDER BY {', '.join('t.' + c.strip() for c in order.split(','))}
+            """
+            async with DB.reader.execute(q, [level] + params) as cur:
+                while True:
+                    rows = await cur.fetchmany(EXPORT_CHUNK)
+                    if not rows:
+                        break
+                    await asyncio.to_thread(writer.write, rows)
+                    total += len(rows)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return total
+
+
+def read_export(path: str):
+    """Порции строк EXPORT_COLUMNS из файла выгрузки (.csv.gz / .csv / .parquet)."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=EXPORT_CHUNK, columns=list(EXPORT_COLUMNS)):
+            yield list(zip(*(batch.column(c).to_pylist() for c in EXPORT_COLUMNS)))
+        return
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        if tuple(next(reader, ())) != EXPORT_COLUMNS:
+            raise ValueError("не файл выгрузки трафика: другой заголовок")
+        chunk = []
+        for level, ts, mac, ip, name, rx, tx in reader:
+            chunk.append((level, int(ts), mac or None, ip, name or None, int(rx), int(tx)))
+            if len(chunk) >= EXPORT_CHUNK:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+async def _import_devices(db, rows: List[tuple]) -> Dict[str, int]:
+    """Устройства порции: неизвестные добавляются (по MAC, без MAC — по IP)."""
+    keys = {}
+    for _, _, mac, ip, name, _, _ in rows:
+        keys.setdefault(mac or ip, (mac, ip, name))
+    missing = [v for k, v in keys.items() if k not in DEVICE_IDS]
+    if missing:
+        await db.executemany("""
+            INSERT INTO devices (mac, ip, name) VALUES (?, ?, ?)
+            ON CONFLICT(mac) WHERE mac IS NOT NULL DO NOTHING
+        """, [v for v in missing if v[0]])
+        await db.executemany("""
+            INSERT INTO devices (ip, name) VALUES (?, ?)
+            ON CONFLICT(ip) WHERE mac IS NULL DO NOTHING
+        """, [v[1:] for v in missing if not v[0]])
+    return await resolve_device_ids(db, keys)
+
+
+async def _raw_deltas(db, values: List[tuple], deltas: Dict[tuple, list]):
+    """
+    Разница между загружаемыми сырыми замерами и теми, что они заменят,
+    накопленная по корзинам агрегатов: ((таблица, корзина, id) → [rx, tx]).
+    """
+    await db.execute("DELETE FROM import_raw")
+    await db.executemany("INSERT INTO import_raw (ts, device_id, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)", values)
+    cur = await db.execute("""
+        SELECT i.ts, i.device_id,
+               i.rx_bytes - COALESCE(s.rx_bytes, 0), i.tx_bytes - COALESCE(s.tx_bytes, 0)
+        FROM import_raw i LEFT JOIN traffic_stats s ON s.device_id = i.device_id AND s.ts = i.ts
+    """)
+    for ts, device_id, rx, tx in await cur.fetchall():
+        for table, _, width in ROLLUPS:
+            d = deltas.setdefault((table, bucket_start(ts, width), device_id), [0, 0])
+            d[0] += rx
+            d[1] += tx
+
+
+@METRICS.timed("wolbot_db_write_seconds", op="import")
+async def import_traffic(path: str) -> Dict[str, int]:
+    """
+    Загрузка файла выгрузки одной транзакцией: при ошибке в любой строке
+    база остаётся как была. Строки за уже существующие корзины заменяются,
+    поэтому повторная загрузка того же файла ничего не удваивает.
+    Агрегаты, которых в файле нет, сдвигаются на разницу загруженных сырых
+    замеров — иначе отчёты их бы не увидели. Возвращает число строк по уровням.
+    """
+    chunks = read_export(path)
+    counts = {}
+    deltas: Dict[tuple, list] = {}
+    try:
+        async with DB.transaction() as db:
+            await db.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS import_raw (
+                    ts INTEGER, device_id INTEGER, rx_bytes INTEGER, tx_bytes INTEGER
+                )
+            """)
+            while True:
+                rows = await asyncio.to_thread(next, chunks, None)
+                if rows is None:
+                    break
+                ids = await _import_devices(db, rows)
+                by_level: Dict[str, list] = {}
+                for level, ts, mac, ip, _, rx, tx in rows:
+                    by_level.setdefault(level, []).append((ts, ids[mac or ip], rx, tx))
+                for level, values in by_level.items():
+                    if level not in EXPORT_LEVELS:
+                        raise ValueError(f"неизвестный уровень: {level}")
+                    table, bucket, _ = EXPORT_LEVELS[level]
+                    if level == "raw":
+                        await _raw_deltas(db, values, deltas)
+                    await db.executemany(f"""
+                        INSERT INTO {table} ({bucket}, device_id, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)
+                        ON CONFLICT({bucket}, device_id) DO UPDATE SET
+                            rx_bytes = excluded.rx_bytes,
+                            tx_bytes = excluded.tx_bytes
+                    """, values)
+                    counts[level] = counts.get(level, 0) + len(values)
+
+            # уровни из файла уже точные; остальные досчитываем из сырых
+            for table, bucket, _ in ROLLUPS:
+                if any(EXPORT_LEVELS[level][0] == table for level in counts):
+                    continue
+                await db.executemany(f"""
+                    INSERT INTO {table} ({bucket}, device_id, rx_bytes, tx_bytes) VALUES (?, ?, ?, ?)
+                    ON CONFLICT({bucket}, device_id) DO UPDATE SET
+                        rx_bytes = rx_bytes + excluded.rx_bytes,
+                        tx_bytes = tx_bytes + excluded.tx_bytes
+                """, [(start, device_id, rx, tx)
+                      for (t, start, device_id), (rx, tx) in deltas.items() if t == table])
+            await db.execute("DROP TABLE import_raw")
+    except BaseException:
+        # id устройств из отменённой транзакции недействительны
+        DEVICE_IDS.clear()
+        raise
+    finally:
+        chunks.close()
+
+    await DEVICES.load()
+    REPORT_CACHE.clear()
+    return counts
+
+
+@METRICS.timed("wolbot_handler_seconds", handler="export")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export — выгрузка истории трафика файлом (см. EXPORT_USAGE)."""
+    if not is_allowed(update.effective_user.id):
+        return await update.message.reply_text("Доступ запрещён.")
+
+    try:
+        opts = parse_export_args(context.args or [])
+    except ValueError as e:
+        m = await update.message.reply_text(f"{e}\n\n{EXPORT_USAGE}")
+        return await record(context, m)
+
+    msg = await update.message.reply_text("📦 Готовлю выгрузку...")
+    await record(context, msg)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, opts["filename"])
+        try:
+            rows = await export_traffic(path, **opts)
+        except ImportError:
+            return await msg.edit_text("Для Parquet установите pyarrow: pip install pyarrow")
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_DOCUMENT:
+            return await msg.edit_text(
+                f"Файл {fmt(size)} больше предела Telegram; выгрузите через "
+                "`python wol_bot_conntrack.py export ...` или сузьте период."
+            )
+        with open(path, "rb") as f:
+            m = await update.message.reply_document(f, filename=opts["filename"])
+        await record(context, m)
+    await msg.edit_text(f"📦 Выгружено строк: {rows}, {fmt(size)}.")
+
+
+# ---------------------------------------------------------------------
+# Вебхук: приём обновлений от Telegram по HTTP
+# ---------------------------------------------------------------------
+
+# обновления Telegram — единицы килобайт
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+
+def webhook_handler(app, secret: str):
+    """
+    Обработчик соединений для asyncio.start_server: POST WEBHOOK_PATH
+    с заголовком X-Telegram-Bot-Api-Secret-Token == secret и JSON Update
+    в теле. Update кладётся в очередь приложения — дальше те же
+    обработчики, что и при polling; ответ 200 уходит сразу, не дожидаясь их.
+    """
+    expected = secret.encode()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, headers, body = await read_http_request(reader, WEBHOOK_MAX_BODY)
+            except ValueError:
+                status = "400 Bad Request"
+            else:
+                token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+                if path != WEBHOOK_PATH:
+                    status = "404 Not Found"
+                elif method != "POST":
+                    status = "405 Method Not Allowed"
+                elif not hmac.compare_digest(token, expected):
+                    status = "403 Forbidden"
+                else:
+                    try:
+                        payload = json.loads(body)
+                        # de_json ждёт объект: на [1, 2] или числе он падает с AttributeError
+                        update = Update.de_json(payload, app.bot) if isinstance(payload, dict) else None
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        update = None
+                    if update is None:
+                        status = "400 Bad Request"
+                    else:
+                        await app.update_queue.put(update)
+                        status = "200 OK"
+            METRICS.inc("wolbot_webhook_requests_total", labels=(("status", status.split()[0]),))
+            await write_http_response(writer, status)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def start_webhook(app):
+    """Слушаем WEBHOOK_LISTEN:WEBHOOK_PORT и регистрируем WEBHOOK_URL в Telegram."""
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = await asyncio.start_server(webhook_handler(app, secret), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    print(f"Вебхук: http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=secret,
+            allowed_updates=["message", "callback_query"],
+        )
+        print(f"Вебхук зарегистрирован: {urlparse(WEBHOOK_URL).netloc}{WEBHOOK_PATH}")
+    else:
+        print("WEBHOOK_URL не задан — вебхук в Telegram не регистрируется")
+        if not WEBHOOK_SECRET:
+            print("WEBHOOK_SECRET не задан — локальные запросы получат 403")
+    return server
+
+
 # ---------------------------------------------------------------------
 # Запуск бота и периодические задачи
 # ---------------------------------------------------------------------
 
 async def periodic_setup(app):
-    await init_db()
+    await DEVICES.load()
+    for router in ROUTERS:
+        await router.tracker.load(router.name)
+    spawn(migrate_legacy_samples())
     if TRAFFIC_COLLECTION_ENABLED:
-        app.job_queue.run_repeating(lambda ctx: asyncio.create_task(collect_conntrack(ctx)), interval=TRAFFIC_COLLECTION_INTERVAL, first=10)
+        app.job_queue.run_repeating(
+            COLLECTOR.tick,
+            interval=TRAFFIC_COLLECTION_INTERVAL,
+            first=10 + random.uniform(0, TRAFFIC_COLLECTION_JITTER),
+            job_kwargs={"jitter": TRAFFIC_COLLECTION_JITTER} if TRAFFIC_COLLECTION_JITTER else None,
+        )
+        if TRAFFIC_EVENTS_ENABLED:
+            for router in ROUTERS:
+                router.events.start()
+            app.job_queue.run_repeating(flush_events, interval=TRAFFIC_EVENTS_FLUSH_INTERVAL, first=TRAFFIC_EVENTS_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(retention_job, interval=TRAFFIC_PRUNE_INTERVAL, first=120)
+    if LOG_MAX_BYTES:
+        app.job_queue.run_repeating(log_rotate_job, interval=LOG_ROTATE_INTERVAL, first=5)
+
+
+def process_uptime():
+    """
+    Секунды с запуска процесса (вместе с импортами) по /proc;
+    None, если /proc недоступен.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # поле 22 — starttime в тиках с загрузки; имя процесса в скобках может содержать пробелы
+            start = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start / os.sysconf("SC_CLK_TCK")
+
+
+def build_application():
+    builder = ApplicationBuilder().token(TG_BOT_TOKEN)
+    if METRICS_ENABLED:
+        # свой request заменяет пул ApplicationBuilder целиком — размер задаём сами,
+        # иначе у HTTPXRequest одно соединение на все вызовы
+        builder = builder.request(TimedRequest(connection_pool_size=TG_POOL_SIZE))
+    if TG_RATE_GLOBAL > 0:
+        builder = builder.rate_limiter(OutboundLimiter())
+    if BOT_STATE_INTERVAL > 0:
+        builder = builder.persistence(BotStatePersistence(BOT_STATE_INTERVAL))
+    return builder.build()
 
 
 async def main():
-    app = ApplicationBuilder().token(TG_BOT_TOKEN).build()
+    if not TG_BOT_TOKEN:
+        print("ERROR: TG_BOT_TOKEN not set")
+        sys.exit(1)
+
+    app = build_application()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("export", export_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     app.add_handler(CallbackQueryHandler(callback_handler))
 
-    app.post_init.append(periodic_setup)
+    # Ждём Ctrl+C или SIGTERM от systemd
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
 
     print("Запуск бота...")
+    # БД нужна до initialize: оттуда читается сохранённое состояние бота
+    await DB.open()
+    await init_db()
     await app.initialize()
+    await periodic_setup(app)
     await app.start()
-    await app.updater.start_polling()
+    webhook_server = None
+    if BOT_MODE == "webhook":
+        webhook_server = await start_webhook(app)
+    else:
+        # start_polling сам снимает ранее установленный вебхук
+        await app.updater.start_polling()
+    started = process_uptime()
+    if started is not None:
+        METRICS.set("wolbot_startup_seconds", started)
+        print(f"Бот запущен за {started:.2f} с")
+
+    metrics_server = None
+    if METRICS_ENABLED and METRICS_PORT:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_BIND, METRICS_PORT)
+        print(f"Метрики: http://{METRICS_BIND}:{METRICS_PORT}/metrics")
     try:
-        await app.idle()
+        await stop.wait()
     finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if webhook_server is not None:
+            webhook_server.close()
+        for router in ROUTERS:
+            router.events.stop()
+        if app.updater.running:
+            await app.updater.stop()
         await app.stop()
+        await app.shutdown()
+        await flush_events(None)
+        await DB.close()
+        SSH_POOL.close_all()
+        COLLECT_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        if _CHART_POOL is not None:
+            _CHART_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+async def migrate_cli():
+    """
+    python wol_bot_conntrack.py migrate
+
+    Перевод БД на схему v2 целиком, без запуска бота, с VACUUM в конце.
+    """
+    await DB.open()
+    try:
+        await init_db()
+        moved = await migrate_legacy_samples(batch=50000, pause=0)
+        print(f"Схема v{SCHEMA_VERSION}, перенесено замеров: {moved}. VACUUM...")
+        await DB.writer.execute("VACUUM")
+    finally:
+        await DB.close()
+
+
+async def export_cli(args: List[str]):
+    """
+    python wol_bot_conntrack.py export [уровень] [csv|parquet] [период] [устройство ...] [-o файл]
+
+    То же, что /export, но в файл на диске и без предела размера.
+    """
+    out = None
+    if "-o" in args:
+        i = args.index("-o")
+        out, args = args[i + 1:i + 2], args[:i] + args[i + 2:]
+    await DB.open()
+    try:
+        await init_db()
+        await DEVICES.load()
+        try:
+            opts = parse_export_args(args)
+        except ValueError as e:
+            print(f"{e}\n{EXPORT_USAGE}")
+            return
+        path = out[0] if out else opts["filename"]
+        rows = await export_traffic(path, **opts)
+        print(f"{path}: строк {rows}, {fmt(os.path.getsize(path))}")
+    finally:
+        await DB.close()
+
+
+async def import_cli(args: List[str]):
+    """
+    python wol_bot_conntrack.py import ФАЙЛ
+
+    Загрузка выгрузки (/export или `export`) одной транзакцией — перенос
+    на другой сервер или восстановление после очистки статистики.
+    """
+    if len(args) != 1:
+        print("python wol_bot_conntrack.py import ФАЙЛ")
+        return
+    await DB.open()
+    try:
+        await init_db()
+        counts = await import_traffic(args[0])
+        print("Загружено: " + (", ".join(f"{k} {v}" for k, v in counts.items()) or "0 строк"))
+    finally:
+        await DB.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if sys.argv[1:2] == ["migrate"]:
+            asyncio.run(migrate_cli())
+        elif sys.argv[1:2] == ["export"]:
+            asyncio.run(export_cli(sys.argv[2:]))
+        elif sys.argv[1:2] == ["import"]:
+            asyncio.run(import_cli(sys.argv[2:]))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("Завершение работы.")